@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import fastx, seqpack, registry
+
+# Site x sequence abundance matrix written beside the frequency filtered and denoised fasta files,
+# so OTU tables don't have to be rebuilt by parsing every fasta header.
+#
+# The matrix is CSR (one row per site) in a directory of plain .npy files, which np.load can
+# memory map (load_matrix does):
+#   - sites.txt: site name of each row.
+#   - indptr.npy: int64, the entries of row i are indptr[i]:indptr[i + 1].
+#   - indices.npy: int64 column of each entry, increasing within a row.
+#   - data.npy: int64 read count of each entry.
+#   - ids.npy: int64 sequence id of each column. With a registry (see registry.py) these are its
+#       stable ids (-1 for a sequence it doesn't hold), otherwise ids only valid within the run.
+#   - keys.npy, key_offsets.npy: 2-bit packed key (see seqpack.py) of each column's sequence,
+#       column j's key is keys[key_offsets[j]:key_offsets[j + 1]].
+# scipy.sparse.csr_matrix((data, indices, indptr)) turns it into the usual sparse matrix.
+
+matrix_dir_name = "abundance"
+
+# Streamed arrays: .npy name -> dtype
+streamed = {"indices": np.int64, "data": np.int64, "ids": np.int64, "keys": np.uint8, "key_offsets": np.int64}
+
+
+class matrix_writer():
+    """
+    Write a matrix one site (row) at a time and its columns in batches, streaming everything
+    but the row pointers to disk so a large matrix never has to be held in memory.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.sites = []
+        self.indptr = [0]
+        self.key_bytes = 0
+        self.files = {name: open(f"{path}/{name}.tmp", "wb") for name in streamed}
+
+    def add_site(self, site:str, columns, counts):
+        """
+        Add the next row: the columns a site has reads in and their counts (any order).
+        """
+
+        columns = np.asarray(columns, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        order = np.argsort(columns, kind="stable")
+        columns[order].tofile(self.files["indices"])
+        counts[order].tofile(self.files["data"])
+
+        self.sites.append(site)
+        self.indptr.append(self.indptr[-1] + len(columns))
+
+    def add_sequences(self, ids, keys:list):
+        """
+        Add the next columns: their sequence ids and packed keys.
+        """
+
+        np.asarray(ids, dtype=np.int64).tofile(self.files["ids"])
+        self.files["keys"].write(b"".join(keys))
+
+        offsets = self.key_bytes + np.cumsum(np.fromiter(map(len, keys), dtype=np.int64, count=len(keys)))
+        offsets.tofile(self.files["key_offsets"])
+        if len(keys):
+            self.key_bytes = int(offsets[-1])
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+        with open(f"{self.path}/sites.txt", "w") as sites_file:
+            sites_file.write("".join(f"{site}\n" for site in self.sites))
+        np.save(f"{self.path}/indptr.npy", np.array(self.indptr, dtype=np.int64))
+
+        # Raw streams to .npy, copied through memory maps. key_offsets gets its leading 0 here.
+        for name, dtype in streamed.items():
+            raw_path = f"{self.path}/{name}.tmp"
+            size = os.path.getsize(raw_path) // np.dtype(dtype).itemsize
+            start = 1 if name == "key_offsets" else 0
+
+            array = np.lib.format.open_memmap(f"{self.path}/{name}.npy", mode="w+", dtype=dtype, shape=(size + start,))
+            if start:
+                array[0] = 0
+            if size:
+                array[start:] = np.memmap(raw_path, dtype=dtype, mode="r")
+            array.flush()
+            del array
+
+            os.remove(raw_path)
+
+
+def load_matrix(path:str, mmap:bool=True) -> dict:
+    """
+    Load a matrix written by matrix_writer.
+
+    Inputs:
+        - path: the matrix directory (e.g. {data_dir}/freq_filtered/abundance).
+        - mmap: memory map the arrays instead of reading them, so loading takes no time whatever the size.
+
+    Outputs:
+        - Dict with "sites" (list of names) and the arrays named like their .npy files.
+    """
+
+    with open(f"{path}/sites.txt") as sites_file:
+        matrix = {"sites": sites_file.read().splitlines()}
+
+    for name in ["indptr"] + list(streamed):
+        matrix[name] = np.load(f"{path}/{name}.npy", mmap_mode="r" if mmap else None)
+
+    return matrix
+
+
+def column_sequences(matrix:dict, columns=None) -> list:
+    """
+    Sequences (bytes) of the given columns of a loaded matrix, all columns if None.
+    """
+
+    if columns is None:
+        columns = range(len(matrix["ids"]))
+
+    keys = matrix["keys"]
+    offsets = matrix["key_offsets"]
+    return seqpack.decode_many([keys[offsets[column]:offsets[column + 1]].tobytes() for column in columns])
+
+
+def matrix_from_fastas(fasta_paths:list, sites:list, out_path:str, registry_path:str=None):
+    """
+    Write the matrix of a set of per-site fasta files with ";size=N" abundances (e.g. denoised output).
+
+    Inputs:
+        - fasta_paths: one fasta per site, in row order.
+        - sites: site name of each file.
+        - out_path: matrix directory to write.
+        - registry_path: if given, columns are keyed by the registry's sequence ids.
+
+    Details:
+        Every file is parsed once in blocks (the reads and ids themselves have to come from the
+        text, the external denoisers only write fasta). Columns are numbered in first seen order,
+        or sorted by registry id with unknown sequences last.
+    """
+
+    columns = {} # packed key -> column
+    site_entries = []
+
+    for path in fasta_paths:
+        site_counts = {}
+        for block in fastx.record_blocks(path):
+            headers, seqs = fastx.fasta_block(block)
+            for key, header in zip(seqpack.encode_many(seqs), headers):
+                site_counts[key] = site_counts.get(key, 0) + fastx.abundance(header)
+
+        site_entries.append((np.fromiter((columns.setdefault(key, len(columns)) for key in site_counts), dtype=np.int64, count=len(site_counts)),
+                             np.fromiter(site_counts.values(), dtype=np.int64, count=len(site_counts))))
+
+    keys = list(columns)
+    ids = np.arange(len(keys), dtype=np.int64)
+    order = ids
+
+    if registry_path is not None:
+        connection = registry.connect(registry_path)
+        ids = np.array([-1 if id is None else id for id in registry.sequence_ids(connection, keys)], dtype=np.int64)
+        connection.close()
+
+        # Registry id order, unknown sequences last
+        order = np.lexsort((ids, ids < 0))
+        ids = ids[order]
+
+    # Old column -> position in the written order
+    renumber = np.empty(len(keys), dtype=np.int64)
+    renumber[order] = np.arange(len(keys))
+
+    writer = matrix_writer(out_path)
+    for site, (site_columns, counts) in zip(sites, site_entries):
+        writer.add_site(site, renumber[site_columns], counts)
+    writer.add_sequences(ids, [keys[column] for column in order.tolist()])
+    writer.close()
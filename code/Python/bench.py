@@ -0,0 +1,297 @@
+import os, sys, json, math, time, shutil, subprocess
+import pipeline, runner, metrics
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/for fun?")
+from random_squence import random_sequence
+
+# Each stage with the external tool it needs (None for in-process stages), and the folder and
+# file pattern of its input files, used to count the reads going in.
+STAGES = {"merge_pairs": ("vsearch", "input", "_R1.fastq"),
+          "trim_primers": ("cutadapt", "merged", ".fastq"),
+          "quality_filter": ("vsearch", "trimmed", ".fastq"),
+          "length_filter": (None, "quality_filtered", ".fastq"),
+          "chimera_filter": ("vsearch", "length_filtered", ".fasta"),
+          "frequency_filter": (None, "chimera_filtered", ".fasta"),
+          "denoise": (None, "freq_filtered", ".fasta"),
+          "check_seqs": (None, "freq_filtered", ".fasta")}
+
+# Conserved codon positions for check_seqs, same as benchmarking_main.py
+conserved_codons = [[60, 61, 62], [69, 70, 71], [96, 97, 98]]
+
+results_dir_name = "results"
+
+
+def stage_input_files(data_dir:str, stage:str) -> list:
+    _, in_dir, pattern = STAGES[stage]
+    if not os.path.exists(f"{data_dir}/{in_dir}"):
+        return []
+    return sorted(f"{data_dir}/{in_dir}/{file}" for file in os.listdir(f"{data_dir}/{in_dir}") if pattern in file)
+
+
+def run_stage(stage:str, data_dir:str) -> dict:
+    """
+    Run one stage on a prepared data directory and time it. Meant to run in its own
+    python process (see measure) so the peak memory belongs to this stage only.
+
+    Outputs:
+        - Dict with wall_s of the stage call and reads_in.
+    """
+
+    reads_in = sum(metrics.count_reads(path) for path in stage_input_files(data_dir, stage))
+
+    start = time.perf_counter()
+
+    if stage == "merge_pairs":
+        pipeline.merge_pairs(data_dir)
+    elif stage == "trim_primers":
+        pipeline.trim_primers(data_dir)
+    elif stage == "quality_filter":
+        pipeline.quality_filter(data_dir)
+    elif stage == "length_filter":
+        pipeline.length_filter(data_dir, amplicon_length=142)
+    elif stage == "chimera_filter":
+        pipeline.chimera_filter(data_dir)
+    elif stage == "frequency_filter":
+        pipeline.frequency_filter(data_dir, min_seq_count=3, min_site_occurance=3)
+    elif stage == "denoise":
+        # Native unoise, its exponent shows how the candidate search scales with unique sequences
+        pipeline.denoise(f"{data_dir}/freq_filtered", f"{data_dir}/denoised", option="unoise_native", Unoise_args=["1", "2"])
+    elif stage == "check_seqs":
+        import true_errors
+        for fasta in stage_input_files(data_dir, stage):
+            true_errors.check_seqs(f"{data_dir}/freq_filtered", os.path.basename(fasta), *conserved_codons)
+
+    return {"wall_s": time.perf_counter() - start, "reads_in": reads_in}
+
+
+def measure(stage:str, data_dir:str) -> dict:
+    """
+    Run a stage in a fresh python process and collect its wall time, cpu time and peak memory.
+
+    Outputs:
+        - Dict with reads, wall_s, cpu_s, max_rss_mb, reads_per_s. None if the stage failed.
+    """
+
+    call = [sys.executable, os.path.abspath(__file__), "run", stage, data_dir]
+    proc = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = proc.stdout.read()
+    returncode, cpu, max_rss = runner.wait_with_usage(proc)
+
+    result_lines = [line for line in output.splitlines() if line.startswith("BENCH ")]
+    if returncode != 0 or not result_lines:
+        print(f"\nError benchmarking {stage}:\n{output[-2000:]}\n")
+        return None
+
+    result = json.loads(result_lines[-1][len("BENCH "):])
+    return {"reads": result["reads_in"],
+            "wall_s": round(result["wall_s"], 4),
+            "cpu_s": round(cpu, 4),
+            "max_rss_mb": round(max_rss, 1),
+            "reads_per_s": round(result["reads_in"] / result["wall_s"]) if result["wall_s"] > 0 else 0}
+
+
+def scaling_exponent(runs:list) -> float:
+    """
+    Slope of log(wall time) against log(reads) over the runs (least squares).
+    About 1 for a stage that scales linearly, 2 for quadratic.
+    """
+
+    points = [(math.log(run["reads"]), math.log(run["wall_s"])) for run in runs if run["reads"] > 0 and run["wall_s"] > 0]
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+
+    return round(sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x, 3)
+
+
+def make_data(bench_dir:str, reads:int, n_sites:int=4, seed:int=516) -> dict:
+    """
+    Simulate (or reuse) the benchmark data for one input size.
+
+    Outputs:
+        - Dict with "tools": data dir with raw read pairs for the external tool stages,
+                and "native": data dir with merged, trimmed reads for the in-process stages,
+                so they can be measured without vsearch and cutadapt installed.
+    """
+
+    dirs = {}
+    for kind in ["tools", "native"]:
+        data_dir = f"{bench_dir}/data/{reads}/{kind}"
+        dirs[kind] = data_dir
+        if os.path.exists(f"{data_dir}/truth/site_composition.csv"):
+            continue
+
+        if os.path.exists(data_dir):
+            shutil.rmtree(data_dir)
+
+        random_sequence(seed=seed).simulate(data_dir, n_sites=n_sites, reads_per_site=reads // n_sites,
+                                            amplicons_only=(kind == "native"))
+
+    return dirs
+
+
+def current_commit() -> str:
+    """
+    Short hash of the checked out commit, with "-dirty" if there are uncommitted changes.
+    """
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD", "--", "."]).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+def benchmark(bench_dir:str="../../data/benchmarks", sizes:list=[10000, 100000, 1000000], stages:list=list(STAGES)) -> dict:
+    """
+    Run every stage on growing synthetic inputs and store the results for the current commit.
+
+    Inputs:
+        - bench_dir: folder for the simulated data and the results.
+        - sizes: total number of reads (read pairs for the raw data) of each run.
+        - stages: stages to benchmark, in pipeline order.
+
+    Outputs:
+        - {bench_dir}/results/{commit}.json with, per stage, one run per size
+            (reads, wall_s, cpu_s, max_rss_mb, reads_per_s) and the scaling exponent.
+        - Returns the same dict.
+
+    Details:
+        Stages run in pipeline order, each on the previous stage's output. External tool stages
+        run on raw simulated pairs and are skipped if their tool isn't installed. In-process stages
+        run on simulated merged and trimmed reads (see make_data). If the tool stages are skipped,
+        the missing chimera_filtered input is a copy of length_filtered.
+        Every stage runs in a fresh python process, so peak memory isn't carried over between stages.
+    """
+
+    results = {"commit": current_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "sizes": sizes,
+               "stages": {stage: {"runs": []} for stage in stages}}
+
+    for stage in stages:
+        tool = STAGES[stage][0]
+        if tool is not None and shutil.which(tool) is None:
+            results["stages"][stage] = {"skipped": f"{tool} not found"}
+        elif stage == "check_seqs":
+            try:
+                import true_errors
+            except ImportError as e:
+                results["stages"][stage] = {"skipped": f"true_errors can't be imported ({e})"}
+
+    for reads in sizes:
+        dirs = make_data(bench_dir, reads)
+
+        for stage in stages:
+            if "skipped" in results["stages"].get(stage, {}):
+                continue
+
+            data_dir = dirs["native"] if STAGES[stage][0] is None else dirs["tools"]
+
+            # Without vsearch the in-process chain goes straight from length_filtered to frequency_filter
+            if stage == "frequency_filter" and not os.path.exists(f"{data_dir}/chimera_filtered"):
+                shutil.copytree(f"{data_dir}/length_filtered", f"{data_dir}/chimera_filtered", ignore=shutil.ignore_patterns("log"))
+
+            # The tool chain needs length filtered reads for the chimera filter
+            if stage == "chimera_filter":
+                pipeline.length_filter(data_dir, amplicon_length=142)
+
+            run = measure(stage, data_dir)
+            if run is None:
+                results["stages"][stage] = {"skipped": "failed"}
+                continue
+
+            results["stages"][stage]["runs"].append(run)
+            print(f"\n{stage} on {run['reads']} reads: {run['wall_s']} s, {run['reads_per_s']} reads/s, {run['max_rss_mb']} MB peak.\n")
+
+    for stage, stage_results in results["stages"].items():
+        if "runs" in stage_results:
+            stage_results["exponent"] = scaling_exponent(stage_results["runs"])
+
+    os.makedirs(f"{bench_dir}/{results_dir_name}", exist_ok=True)
+    with open(f"{bench_dir}/{results_dir_name}/{results['commit']}.json", "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    report(results)
+    return results
+
+
+def report(results:dict):
+    """
+    Print reads/s and peak memory of every stage and size, with the scaling exponent.
+    """
+
+    print(f"\nBenchmark of {results['commit']} ({results['time']})")
+    print(f"{'stage':<20}{'reads':>12}{'wall (s)':>12}{'reads/s':>12}{'peak MB':>10}{'exponent':>10}")
+    for stage, stage_results in results["stages"].items():
+        if "skipped" in stage_results:
+            print(f"{stage:<20}  skipped: {stage_results['skipped']}")
+            continue
+        for i, run in enumerate(stage_results["runs"]):
+            exponent = stage_results["exponent"] if i == 0 and stage_results["exponent"] is not None else ""
+            print(f"{stage:<20}{run['reads']:>12}{run['wall_s']:>12.3f}{run['reads_per_s']:>12}{run['max_rss_mb']:>10.0f}{exponent:>10}")
+
+
+def compare(old_commit:str, new_commit:str, bench_dir:str="../../data/benchmarks", threshold:float=0.1) -> list:
+    """
+    Compare the stored benchmarks of two commits.
+
+    Inputs:
+        - old_commit, new_commit: names of result files in {bench_dir}/results (without .json).
+        - threshold: relative change counted as a regression, 0.1 flags stages that lost more
+                than 10% of their reads/s or grew their peak memory by more than 10%.
+
+    Outputs:
+        - List of (stage, reads, metric, old value, new value) for every regression.
+    """
+
+    with open(f"{bench_dir}/{results_dir_name}/{old_commit}.json") as old_file:
+        old = json.load(old_file)
+    with open(f"{bench_dir}/{results_dir_name}/{new_commit}.json") as new_file:
+        new = json.load(new_file)
+
+    regressions = []
+    print(f"\n{'stage':<20}{'reads':>12}{'reads/s old':>14}{'reads/s new':>14}{'MB old':>10}{'MB new':>10}")
+    for stage, new_stage in new["stages"].items():
+        old_stage = old["stages"].get(stage, {})
+        if "runs" not in new_stage or "runs" not in old_stage:
+            continue
+
+        old_runs = {run["reads"]: run for run in old_stage["runs"]}
+        for run in new_stage["runs"]:
+            if run["reads"] not in old_runs:
+                continue
+            old_run = old_runs[run["reads"]]
+
+            flags = []
+            if run["reads_per_s"] < old_run["reads_per_s"] * (1 - threshold):
+                regressions.append((stage, run["reads"], "reads_per_s", old_run["reads_per_s"], run["reads_per_s"]))
+                flags.append("slower")
+            if run["max_rss_mb"] > old_run["max_rss_mb"] * (1 + threshold):
+                regressions.append((stage, run["reads"], "max_rss_mb", old_run["max_rss_mb"], run["max_rss_mb"]))
+                flags.append("more memory")
+
+            flag = f"  REGRESSION ({', '.join(flags)})" if flags else ""
+            print(f"{stage:<20}{run['reads']:>12}{old_run['reads_per_s']:>14}{run['reads_per_s']:>14}{old_run['max_rss_mb']:>10.0f}{run['max_rss_mb']:>10.0f}{flag}")
+
+    print(f"\n{len(regressions)} regression(s) beyond {threshold:.0%} from {old_commit} to {new_commit}.")
+    return regressions
+
+
+if __name__ == "__main__":
+    # python bench.py                               benchmark the current commit
+    # python bench.py compare <old> <new> [0.1]     compare two stored commits
+    # python bench.py run <stage> <data_dir>        (used by measure) run one stage
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        print("BENCH " + json.dumps(run_stage(sys.argv[2], sys.argv[3])))
+    elif len(sys.argv) > 1 and sys.argv[1] == "compare":
+        regressions = compare(sys.argv[2], sys.argv[3], threshold=float(sys.argv[4]) if len(sys.argv) > 4 else 0.1)
+        exit(1 if regressions else 0)
+    else:
+        benchmark()
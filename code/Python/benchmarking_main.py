@@ -23,26 +23,42 @@ c1 = [60, 61, 62]
 c2 = [69, 70, 71]
 c3 = [96, 97, 98]
 
+alphas = [1, 3, 5, 7, 9, 11, 13]
+
+# The external DnoisE and usearch are what is benchmarked. native = True benchmarks the in-process
+# reimplementations instead (dnoise.py, unoise.py), swept over every alpha at once (see sweep.py).
+# They are not the same algorithms (no uchime3 step after unoise, entropies over unique sequences
+# rather than reads), so they go to their own *_native_alpha_N directories and plots.
+native = False
+
+if native:
+    options = ["dnoise_native", "unoise_native"]
+
+    for option in options:
+        output_dirs = {alpha: f"{output_path}/{option}_alpha_{alpha}" for alpha in alphas}
+
+        if not all(os.path.exists(output_dir) for output_dir in output_dirs.values()):
+            pipeline.denoise_sweep(data_dir=path_to_data,
+                                   output_dirs=output_dirs,
+                                   option=option,
+                                   Unoise_args=["1", str(alphas[0])],
+                                   DnoisE_args=[str(alphas[0]), "3", "1", "-y"])
+else:
+    options = ["dnoise", "unoise"]
+
+    for option in options:
+        for alpha in alphas:
+            if not os.path.exists(f"{output_path}/{option}_alpha_{alpha}"):
+                pipeline.denoise(data_dir=path_to_data,
+                                 output_dir=f"{output_path}/{option}_alpha_{alpha}",
+                                 option=option,
+                                 DnoisE_args=[str(alpha), "3", "1", "-y"],
+                                 Unoise_args=["1", str(alpha)])
+
 # Run through combinations of denoising parameters
 all_stats = []
-for option in ["dnoise", "unoise"]:
-    for alpha in [1, 3, 5, 7, 9, 11, 13]:
-        dnoise_args = [str(alpha), "3", "1", "-y"] 
-        unoise_args = ["1", str(alpha)]
-
-        # Denoise with each parameter
-#        if option == "dnoise":
-#            pipeline.denoise(data_dir=path_to_data, 
-#                             output_dir=f"{output_path}/{option}_alpha_{alpha}", 
-#                             option=option,
-#                             DnoisE_args=dnoise_args)
-
-#        if option == "unoise":
-#            pipeline.denoise(data_dir=path_to_data, 
-#                             output_dir=f"{output_path}/{option}_alpha_{alpha}", 
-#                             option=option,
-#                             Unoise_args=unoise_args)
-
+for option in options:
+    for alpha in alphas:
         avg_err_rate, avg_seq_counts, avg_err_counts = true_errors.get_method_avgs(denoised_dir = output_path,
                                                                                    o = option,
                                                                                    a = alpha,
@@ -54,4 +70,5 @@ for option in ["dnoise", "unoise"]:
 
 
 true_errors.make_plot(stat = "error rate",
-                      stats = all_stats)
+                      stats = all_stats,
+                      label = "native" if native else None)
@@ -0,0 +1,285 @@
+import os, json, time, shutil
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import pipeline, runner, scheduler, stage_cache, fastx
+
+# Per-sample stages in order, with their output folder and log subfolder.
+SAMPLE_STAGES = [("merge_pairs", "merged", "merge_logs"),
+                 ("trim_primers", "trimmed", "logs"),
+                 ("quality_filter", "quality_filtered", "logs"),
+                 ("length_filter", "length_filtered", "log"),
+                 ("chimera_filter", "chimera_filtered", "logs")]
+
+
+def run_graph(nodes:dict, n_jobs:int=1, cores:int=None) -> dict:
+    """
+    Run a graph of tasks, starting each one as soon as its dependencies are done.
+
+    Inputs:
+        - nodes: dict of node id -> dict with:
+            - "func": callable with no arguments, returns True on success.
+            - "deps": list of node ids that have to finish first.
+            - "barrier" (optional): if True the node runs once its dependencies have finished,
+                    even if some failed (like frequency_filter running on the samples that made it).
+                    Otherwise a failed dependency skips the node.
+            - "priority" (optional): ready nodes with a higher priority start first. Giving later stages
+                    a higher priority pushes samples through to the end instead of running stage by stage.
+            - "threads" (optional): cores the node uses, 1 if not given.
+        - n_jobs: maximum number of nodes running at the same time.
+        - cores: if given, nodes only start while the threads of the running nodes fit in it
+                (a node wider than cores still runs, on its own).
+
+    Outputs:
+        - Dict of node id -> {"start", "end", "wall", "status"}. Times are seconds from the start of the graph,
+            status is "done", "failed" or "skipped".
+    """
+
+    timings = {}
+    status = {}
+    waiting = set(nodes)
+    running = {}
+    graph_start = time.perf_counter()
+
+    def timed(node_id):
+        start = time.perf_counter() - graph_start
+        try:
+            success = nodes[node_id]["func"]()
+        except Exception as e:
+            print(f"\nError running {node_id}: {e}\n")
+            success = False
+        end = time.perf_counter() - graph_start
+        return success, start, end
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+        while waiting or running:
+            # Skip nodes behind a failed (or skipped) dependency
+            for node_id in sorted(waiting):
+                node = nodes[node_id]
+                if not node.get("barrier") and any(status.get(dep) in ("failed", "skipped") for dep in node["deps"]):
+                    status[node_id] = "skipped"
+                    timings[node_id] = {"start": None, "end": None, "wall": None, "status": "skipped"}
+                    waiting.discard(node_id)
+
+            ready = [node_id for node_id in waiting if all(dep in status for dep in nodes[node_id]["deps"])]
+            ready.sort(key=lambda node_id: -nodes[node_id].get("priority", 0))
+
+            busy = sum(nodes[node_id].get("threads", 1) for node_id in running.values())
+            for node_id in ready[:max(0, n_jobs - len(running))]:
+                threads = nodes[node_id].get("threads", 1)
+                # Wait for cores rather than start a lower priority node in front of this one
+                if cores and running and busy + threads > cores:
+                    break
+                waiting.discard(node_id)
+                running[pool.submit(timed, node_id)] = node_id
+                busy += threads
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node_id = running.pop(future)
+                success, start, end = future.result()
+                status[node_id] = "done" if success else "failed"
+                timings[node_id] = {"start": round(start, 3),
+                                    "end": round(end, 3),
+                                    "wall": round(end - start, 3),
+                                    "status": status[node_id]}
+
+    return timings
+
+
+def critical_path(nodes:dict, timings:dict) -> list:
+    """
+    Chain of nodes that decided the total wall-clock time.
+
+    Starting from the node that finished last, repeatedly step back to the dependency that
+    finished last. Returns node ids in run order.
+    """
+
+    finished = [node_id for node_id in timings if timings[node_id]["end"] is not None]
+    if not finished:
+        return []
+
+    path = [max(finished, key=lambda node_id: timings[node_id]["end"])]
+    while True:
+        deps = [dep for dep in nodes[path[-1]]["deps"] if timings.get(dep, {}).get("end") is not None]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda dep: timings[dep]["end"]))
+
+    return path[::-1]
+
+
+def run_tool_node(build_job, cache:bool) -> bool:
+    """
+    Run one pipeline job as a graph node, checking and recording the stage cache if asked.
+    The job is built (build_job()) when the node starts, so it finds the previous stage's
+    output in whichever compression that stage wrote.
+    """
+
+    job = build_job()
+    if cache and stage_cache.check_job(job):
+        return True
+
+    success = runner.run_job(job)
+    stage_cache.record_jobs([job], [success])
+    return success
+
+
+def run_frequency_filter(data_dir:str, min_seq_count:int, min_site_occurance:int, cache:bool, n_jobs:int=1, compress:str=None) -> bool:
+    # Every sample is done by now, so the workers can all go to splitting the site files
+    pipeline.frequency_filter(data_dir, min_seq_count, min_site_occurance, cache=cache, n_jobs=n_jobs, compress=compress)
+    return True
+
+
+def run_pipeline_dag(data_dir:str,
+                     amplicon_length:int,
+                     min_seq_count:int,
+                     min_site_occurance:int,
+                     merge_args:list=["99", "16", "25", "--fastq_allowmergestagger"],
+                     primer_option:int=1,
+                     quality_args:list=[1, 0],
+                     chimera_args:list=["1.4", "8", "3", "1.2", "0.2"],
+                     fused:bool=False,
+                     native_quality:bool=False,
+                     dereplicate:bool=False,
+                     n_jobs:int=1,
+                     cores:int=None,
+                     cache:bool=False,
+                     compress:str=None) -> dict:
+    """
+    Run merge -> trim -> quality -> length -> chimera per sample, then frequency_filter over all sites.
+
+    Inputs:
+        - data_dir: path to the data directory with the raw input fastq files.
+        - amplicon_length: see pipeline.length_filter.
+        - min_seq_count, min_site_occurance: see pipeline.frequency_filter.
+        - merge_args, primer_option, quality_args, chimera_args: the tool arguments of each stage,
+                see the pipeline function of the same stage.
+        - fused: merge, trim and quality filter in one piped step per sample (see pipeline.preprocess).
+        - native_quality: quality and length filter in one in-process pass per sample instead of
+                vsearch + length_filter (see pipeline.native_quality_filter). Ignored when fused.
+        - dereplicate: collapse each sample to unique sequences with ";size=N" in the length filter
+                step, chimera and frequency filter then work on unique sequences (see pipeline.length_filter).
+        - n_jobs: maximum number of per-sample steps running at the same time.
+        - cores: total core budget. If given, it replaces n_jobs: each stage's tool threads are planned
+                like the stage functions do (see scheduler.plan_stage, recorded in data_dir/schedule.jsonl),
+                and steps only start while the threads of the running steps fit in cores.
+        - cache: skip up to date samples per stage (see stage_cache.py).
+        - compress: write the per-sample intermediates compressed, ".gz" or ".zst" (see pipeline.merge_pairs).
+
+    Outputs:
+        - Same output folders as running the pipeline functions one after the other.
+        - dag_timings.jsonl in the data directory: one line per node with its sample, stage,
+            start/end/wall time (seconds), status and whether it is on the critical path.
+        - Returns the timings dict (see run_graph).
+
+    Details:
+        Each sample moves through its stages on its own, so one huge sample stuck in merge_pairs
+        no longer holds up chimera_filter for every other sample. The only barrier is
+        frequency_filter, which needs every site for its site occurance rule.
+        A sample whose step fails is dropped from the rest of its chain, the others carry on.
+    """
+
+    names = sorted(pipeline.get_sample_names(data_dir))
+
+    stages = SAMPLE_STAGES
+    if fused:
+        stages = [("preprocess", "quality_filtered", "logs")] + SAMPLE_STAGES[3:]
+
+        # No intermediate files in fused mode, clear old ones like pipeline.preprocess does
+        for stage_dir in ["merged", "trimmed"]:
+            if not cache and stage_dir in os.listdir(data_dir):
+                shutil.rmtree(f"{data_dir}/{stage_dir}/")
+
+    elif native_quality:
+        stages = SAMPLE_STAGES[0:2] + [("quality_length_filter", "length_filtered", "log")] + SAMPLE_STAGES[4:]
+
+        if not cache and "quality_filtered" in os.listdir(data_dir):
+            shutil.rmtree(f"{data_dir}/quality_filtered/")
+
+    # Set up every output folder up front, samples run through them in any order
+    for _, stage_dir, log_dir in stages:
+        if not cache and stage_dir in os.listdir(data_dir):
+            shutil.rmtree(f"{data_dir}/{stage_dir}/")
+        os.makedirs(f"{data_dir}/{stage_dir}/{log_dir}/", exist_ok=True)
+        if cache:
+            stage_cache.prune(f"{data_dir}/{stage_dir}", names)
+
+    # Threads of each stage's tool calls out of the core budget. The later stages' inputs don't
+    # exist yet, so every stage is sized on the raw reads (fused mode on its merge step, like
+    # pipeline.preprocess). In-process stages use one thread each.
+    stage_threads = {stage: 1 for stage, _, _ in stages}
+    if cores:
+        raw_reads = [fastx.find(f"{data_dir}/input", f"{name}_R1.fastq") for name in names]
+        for stage, _, _ in stages:
+            profile = "merge_pairs" if stage == "preprocess" else stage
+            if profile in scheduler.STAGE_PROFILES:
+                plan = scheduler.plan_stage(profile, raw_reads, cores)
+                plan["stage"] = stage
+                scheduler.record_plan(plan, f"{data_dir}/schedule.jsonl")
+                stage_threads[stage] = plan["threads"]
+
+        # As many steps as the narrowest stage fits, the running steps' threads keep it within cores
+        n_jobs = max(1, min(cores // min(stage_threads.values()), len(names)))
+        print(f"\nRunning up to {n_jobs} steps at a time with {stage_threads} threads per stage ({cores} cores).\n")
+
+    def threads(stage, tool_stage=None):
+        return scheduler.thread_args(tool_stage or stage, stage_threads.get(stage, 1)) if cores else []
+
+    nodes = {}
+    for name in names:
+        sample_funcs = {"merge_pairs": partial(run_tool_node, partial(pipeline.merge_job, data_dir, name, merge_args, threads("merge_pairs"), compress), cache),
+                        "trim_primers": partial(run_tool_node, partial(pipeline.trim_job, data_dir, name, primer_option, threads("trim_primers"), compress), cache),
+                        "quality_filter": partial(run_tool_node, partial(pipeline.quality_job, data_dir, name, quality_args, threads("quality_filter"), compress), cache),
+                        "preprocess": partial(run_tool_node, partial(pipeline.preprocess_job, data_dir, name, merge_args, primer_option, quality_args,
+                                                                     merge_threads=threads("preprocess", "merge_pairs"),
+                                                                     trim_threads=threads("preprocess", "trim_primers"), compress=compress), cache),
+                        "length_filter": partial(pipeline.length_filter_sample, data_dir, name, amplicon_length, cache, compress, dereplicate=dereplicate),
+                        "quality_length_filter": partial(pipeline.native_quality_sample, data_dir, name, quality_args, amplicon_length, cache, compress, dereplicate),
+                        "chimera_filter": partial(run_tool_node, partial(pipeline.chimera_job, data_dir, name, chimera_args, threads("chimera_filter"), compress, dereplicate), cache)}
+
+        previous = None
+        for priority, (stage, _, _) in enumerate(stages):
+            node_id = f"{name}:{stage}"
+            nodes[node_id] = {"func": sample_funcs[stage],
+                              "deps": [previous] if previous else [],
+                              "priority": priority,
+                              "threads": stage_threads[stage],
+                              "sample": name,
+                              "stage": stage}
+            previous = node_id
+
+    nodes["all:frequency_filter"] = {"func": partial(run_frequency_filter, data_dir, min_seq_count, min_site_occurance, cache, cores or n_jobs, compress),
+                                     "deps": [f"{name}:{stages[-1][0]}" for name in names],
+                                     "barrier": True,
+                                     "threads": cores or n_jobs,
+                                     "sample": "all",
+                                     "stage": "frequency_filter"}
+
+    timings = run_graph(nodes, n_jobs, cores)
+    path = critical_path(nodes, timings)
+
+    with open(f"{data_dir}/dag_timings.jsonl", "w") as timing_file:
+        for node_id, node_timing in timings.items():
+            timing_file.write(json.dumps({"node": node_id,
+                                          "sample": nodes[node_id]["sample"],
+                                          "stage": nodes[node_id]["stage"],
+                                          **node_timing,
+                                          "critical_path": node_id in path}) + "\n")
+
+    # Samples that took the longest, summed over their stages
+    sample_walls = {}
+    for node_id, node_timing in timings.items():
+        if node_timing["wall"] is not None and nodes[node_id]["sample"] != "all":
+            sample_walls[nodes[node_id]["sample"]] = sample_walls.get(nodes[node_id]["sample"], 0) + node_timing["wall"]
+
+    print("\nCritical path:")
+    for node_id in path:
+        print(f"    {node_id}: {timings[node_id]['wall']} s")
+    print("Slowest samples:")
+    for name, wall in sorted(sample_walls.items(), key=lambda item: -item[1])[:5]:
+        print(f"    {name}: {round(wall, 3)} s")
+
+    return timings
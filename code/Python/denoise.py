@@ -1,11 +1,15 @@
-import os, subprocess, shutil
+import os, shutil
+import runner
 
 
 def denoise(data_dir:str, 
             output_dir:str, 
             option:str="dnoise", 
             Unoise_args:list=["1", "2"], 
-            DnoisE_args:list=["2", "1", "3", "-y"]):
+            DnoisE_args:list=["2", "1", "3", "-y"],
+            n_jobs:int=1,
+            timeout:float=None,
+            retries:int=None):
     """
     Denoise using Antich's DnoisE algorithm or Edgar's Unoise3 algorithm.
 
@@ -13,6 +17,9 @@ def denoise(data_dir:str,
         - data_dir: Path to data directory.
         - output_dir: Path to output directory.
         - option: "unoise" or "dnoise"
+        - n_jobs: maximum number of sites denoised at the same time.
+        - timeout: seconds before a site's dnoise/usearch call is killed (runner.default_timeout if None).
+        - retries: extra attempts for a site that failed or timed out (runner.default_retries if None).
 
     DnoisE_args:
         - [0] --alpha: alpha value for Unoise distance calculation.
@@ -42,6 +49,7 @@ def denoise(data_dir:str,
     # make log subdirectory
     os.makedirs(f"{output_dir}/logs/")
 
+    jobs = []
     for file in os.listdir(f"{data_dir}/"):
 
         if option == "dnoise":
@@ -54,12 +62,10 @@ def denoise(data_dir:str,
                             "-y"]
             
             if ".fasta" in file:
-                with open(f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log", "a") as log:
-                    try:
-                        subprocess.run(DnoisE_call, stdout=log, stderr=log, check=True)
-                        print(f"\nDenoised {file} successfully with DnoisE.\n")
-                    except subprocess.CalledProcessError as e:
-                        print(f"\nError processing {file}: {e}\n")
+                jobs.append({"call": DnoisE_call,
+                             "log": f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log",
+                             "name": file,
+                             "message": f"Denoised {file} successfully with DnoisE."})
             
         if option == "unoise":
             Unoise_call = ["usearch",
@@ -70,13 +76,14 @@ def denoise(data_dir:str,
                            ]
 
             if ".fasta" in file:
-                with open(f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log", "a") as log:
-                    try:
-                        subprocess.run(Unoise_call, stdout=log, stderr=log, check=True)
-                        print(f"\nDenoised {file} successfully with Unoise.\n")
-                    except subprocess.CalledProcessError as e:
-                        print(f"\nError processing {file}: {e}\n")
-                
+                jobs.append({"call": Unoise_call,
+                             "log": f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log",
+                             "name": file,
+                             "message": f"Denoised {file} successfully with Unoise."})
+
+    # A hung usearch/dnoise call is killed at the timeout without stopping the other sites
+    runner.run_jobs(jobs, n_jobs, timeout, retries)
+
     # DnoisE fasta output gets stupid names, fix
     stupid_suffix = ".fasta_Adcorr_denoised_ratio_d.fasta"
     if option == "dnoise":
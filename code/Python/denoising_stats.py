@@ -1,8 +1,47 @@
 import os, re
+from functools import partial
 import matplotlib.pyplot as plt
+import fastx_index
 import alignments
 
-def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list)->list:
+def check_block(codon_1:list, codon_2:list, codon_3:list, block:bytes) -> list:
+    """
+    Number of errors and number of lines in a block of whole fasta records, see check_seqs.
+    """
+
+    codon_dict = {"H": [b"CAC", b"CAT"], "G": [b"GGA", b"GGT", b"GGC", b"GGG"], "N": [b"AAC", b"AAT"]}
+    stop_seqs = [b"TAA", b"TGA", b"TAG"]
+
+    lines = block.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+
+    num_errors = 0
+    for rawline in lines:
+        if (rawline.strip()) and (b">" not in rawline):
+            # Two N's added to match reading frame
+            seq = b"NN" + rawline.rstrip()
+            first_codon = bytes([seq[i] for i in codon_1])
+            second_codon = bytes([seq[i] for i in codon_2])
+            third_codon = bytes([seq[i] for i in codon_3])
+
+            if first_codon not in codon_dict["H"]:
+                num_errors += 1
+
+            if second_codon not in codon_dict["G"]:
+                num_errors += 1
+
+            if third_codon not in codon_dict["N"]:
+                num_errors += 1
+
+            for i in range(0, len(seq), 3):
+                if seq[i:i+3] in stop_seqs:
+                    num_errors += 1
+
+    return [num_errors, len(lines)]
+
+
+def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list, n_jobs:int=1)->list:
     """
     Get number of errors and total sequences in a fasta file.
 
@@ -10,6 +49,7 @@ def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list
         - data_dir: path to directory
         - fasta: Name of fasta (no path)
         - codon_1, 2, & 3: Lists of three base positions of each codon.
+        - n_jobs: worker processes splitting the file between them (see fastx_index.map_blocks).
 
     Outputs:
         - List containing: 
@@ -18,51 +58,23 @@ def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list
             [2]: error_rate
     """
 
-    codon_dict = {"H": ["CAC", "CAT"], "G": ["GGA", "GGT", "GGC", "GGG"], "N": ["AAC", "AAT"]}
-    stop_seqs = ["TAA", "TGA", "TAG"]
-
-    with open(f"{data_dir}/{fasta}") as file:
-        num_errors = 0
-        num_seqs = 0
-        for rawline in file.readlines():
-            num_seqs += 1
-            if (rawline.strip()) and (">" not in rawline):
-                # Two N's added to match reading frame
-                seq = "NN" + rawline.rstrip()
-                first_codon = "".join([seq[i] for i in codon_1])
-                second_codon = "".join([seq[i] for i in codon_2])
-                third_codon = "".join([seq[i] for i in codon_3])
-
-                if ((first_codon != codon_dict["H"][0]) and 
-                    (first_codon != codon_dict["H"][1])):
-                    num_errors += 1
-
-                if ((second_codon != codon_dict["G"][0]) and 
-                    (second_codon != codon_dict["G"][1]) and
-                    (second_codon != codon_dict["G"][2]) and
-                    (second_codon != codon_dict["G"][3])):
-                    num_errors += 1
-
-                if ((third_codon != codon_dict["N"][0]) and 
-                    (third_codon != codon_dict["N"][1])):
-                    num_errors += 1
-                
-                for codon in [seq[i:i+3] for i in range(0, len(seq), 3)]:
-                    if (codon == stop_seqs[0] or 
-                        codon == stop_seqs[1] or 
-                        codon == stop_seqs[2]):
-                        num_errors += 1
+    num_errors = 0
+    num_seqs = 0
+    for block_errors, block_lines in fastx_index.map_blocks(partial(check_block, codon_1, codon_2, codon_3),
+                                                            f"{data_dir}/{fasta}", n_jobs):
+        num_errors += block_errors
+        num_seqs += block_lines
 
-        error_rate = num_errors / num_seqs
+    error_rate = num_errors / num_seqs
 
-        return [num_errors, num_seqs, error_rate]
+    return [num_errors, num_seqs, error_rate]
     
 
 def get_method_avgs(denoised_dir, o, a, c1, c2, c3):
     method_stats = []
     for file in os.listdir(f"{denoised_dir}/{o}_alpha_{a}"):
 
-        if (".csv" not in file) and ("log" not in file):
+        if (".csv" not in file) and ("log" not in file) and os.path.isfile(f"{denoised_dir}/{o}_alpha_{a}/{file}"):
             file_stats = check_seqs(data_dir=f"{denoised_dir}/{o}_alpha_{a}", 
                                                      fasta=file, 
                                                      codon_1=c1, 
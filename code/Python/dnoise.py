@@ -0,0 +1,326 @@
+import numpy as np
+import fastx, unoise, kmer_index
+
+# Native DnoisE (Antich et al. 2021) for amplicons that all have the same length, in place of the
+# external dnoise program (pipeline.denoise with option="dnoise_native").
+#
+# Like unoise.py, unique sequences are visited from the most abundant down and a sequence Q is
+# noise of a more abundant correct sequence (a "mother") M at distance d if
+#     size(Q) / size(M) <= 1 / 2^(alpha * d + 1)
+# With several possible mothers Q joins the one with the lowest size(Q) / size(M) * 2^(alpha * d + 1)
+# (DnoisE's ratio_d criterion), and its reads are added to that mother's size in the output.
+#
+# With the entropy correction (DnoisE -y) d weighs each difference by its codon position:
+# a difference at codon position k counts 3 * e_k / (e_1 + e_2 + e_3), where e_k is the mean
+# Shannon entropy of the site's columns at position k. Third positions vary the most between
+# real haplotypes, so a difference there is less likely to be an error and weighs more.
+
+default_alpha = 2.0
+default_min_abund = 1
+
+nucleotides = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def codon_positions(length:int, first_position:int=1) -> np.ndarray:
+    """
+    Codon position (1, 2 or 3) of every base, the first base being at first_position (DnoisE -x).
+    """
+    return (first_position - 1 + np.arange(length)) % 3 + 1
+
+
+def codon_entropies(letters:np.ndarray, positions:np.ndarray) -> np.ndarray:
+    """
+    Mean Shannon entropy (bits) of the columns at codon position 1, 2 and 3, over unique sequences.
+
+    Inputs:
+        - letters: uint8 array (sequences, length) of bases.
+        - positions: codon position of each column (see codon_positions).
+    """
+
+    # Base counts per column, anything but A, C, G, T counted as one more symbol
+    counts = np.stack([(letters == base).sum(axis=0) for base in nucleotides])
+    counts = np.vstack([counts, len(letters) - counts.sum(axis=0)])
+
+    frequencies = counts / max(1, len(letters))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        column_entropy = -np.where(frequencies > 0, frequencies * np.log2(frequencies), 0).sum(axis=0)
+
+    return np.array([column_entropy[positions == position].mean() if (positions == position).any() else 0
+                     for position in (1, 2, 3)])
+
+
+def position_masks(positions:np.ndarray, words:int) -> np.ndarray:
+    """
+    For each codon position, uint64 masks over packed words (see unoise.packed_words) selecting the
+    difference flag (low bit of the 2-bit code) of every base at that position.
+
+    Outputs:
+        - uint64 array (3, words).
+    """
+
+    masks = np.zeros((3, words * 8), dtype=np.uint8)
+    for i, position in enumerate(positions.tolist()):
+        # seqpack puts the first base of a byte in its top bits
+        masks[position - 1, i // 4] |= 1 << (6 - 2 * (i % 4))
+
+    return masks.view(np.uint64)
+
+
+def weighted_distances(words:np.ndarray, letters:np.ndarray, ambiguous:np.ndarray, masks:np.ndarray,
+                       positions:np.ndarray, weights:np.ndarray, queries:np.ndarray, targets:np.ndarray) -> np.ndarray:
+    """
+    Codon position weighted Hamming distances between query and target sequences (row numbers).
+
+    Inputs:
+        - masks: position_masks of the codon positions.
+        - positions: codon position of each column, weights: weight of a difference at each codon position.
+
+    Outputs:
+        - float64 array (queries, targets).
+
+    Details:
+        Differences are counted per codon position and weighed afterwards, so equal distances
+        come out exactly equal and ties go to the most abundant mother.
+    """
+
+    differences = words[queries][:, None, :] ^ words[targets][None, :, :]
+    flags = (differences | (differences >> np.uint64(1))) & unoise.low_bits
+    counts = np.stack([unoise.popcount(flags & masks[position]).sum(axis=2, dtype=np.int64) for position in range(3)])
+
+    # Ambiguous sequences letter by letter, like unoise.distances
+    rows = np.flatnonzero(ambiguous[queries])
+    columns = np.flatnonzero(ambiguous[targets])
+    for position in range(3):
+        at_position = positions == position + 1
+        if len(rows):
+            counts[position, rows] = (letters[queries[rows]][:, None, at_position] != letters[targets][None, :, at_position]).sum(axis=2)
+        if len(columns):
+            counts[position][:, columns] = (letters[queries][:, None, at_position] != letters[targets[columns]][None, :, at_position]).sum(axis=2)
+
+    return weights[0] * counts[0] + weights[1] * counts[1] + weights[2] * counts[2]
+
+
+def weighted_pair_distances(words:np.ndarray, letters:np.ndarray, ambiguous:np.ndarray, masks:np.ndarray,
+                            positions:np.ndarray, weights:np.ndarray, queries:np.ndarray, targets:np.ndarray) -> np.ndarray:
+    """
+    Distances between queries[i] and targets[i] (row numbers), like weighted_distances for a list of pairs.
+    """
+
+    differences = words[queries] ^ words[targets]
+    flags = (differences | (differences >> np.uint64(1))) & unoise.low_bits
+    counts = np.stack([unoise.popcount(flags & masks[position]).sum(axis=1, dtype=np.int64) for position in range(3)])
+
+    pairs = np.flatnonzero(ambiguous[queries] | ambiguous[targets])
+    for position in range(3):
+        at_position = positions == position + 1
+        if len(pairs):
+            counts[position, pairs] = (letters[queries[pairs]][:, at_position] != letters[targets[pairs]][:, at_position]).sum(axis=1)
+
+    return weights[0] * counts[0] + weights[1] * counts[1] + weights[2] * counts[2]
+
+
+def distance_weights(words:np.ndarray, letters:np.ndarray, first_position:int=1, entropy:bool=True) -> tuple:
+    """
+    Everything weighted_distances needs besides the sequences (see unoise.packed_words).
+
+    Outputs:
+        - Codon position of each column.
+        - Mean entropy of codon positions 1, 2 and 3.
+        - Weight of a difference at codon position 1, 2 and 3.
+        - position_masks.
+        - The smallest distance a difference can make, to limit the candidate mothers of a batch.
+    """
+
+    positions = codon_positions(letters.shape[1], first_position)
+    entropies = codon_entropies(letters, positions)
+
+    # Mean weight 1, so alpha means the same as without the correction
+    weights = 3 * entropies / entropies.sum() if entropy and entropies.sum() > 0 else np.ones(3)
+    masks = position_masks(positions, words.shape[1])
+    min_weight = max(weights[np.unique(positions) - 1].min(), 1e-12) if len(positions) else 1
+
+    return positions, entropies, weights, masks, min_weight
+
+
+def dnoise(seqs:list, sizes:np.ndarray, alpha:float=default_alpha, min_abund:int=default_min_abund,
+           first_position:int=1, entropy:bool=True, index:bool=True) -> tuple:
+    """
+    Denoise unique sequences, see the top of the module.
+
+    Inputs:
+        - seqs: unique sequences (bytes), all the same length.
+        - sizes: their abundances.
+        - alpha: DnoisE --alpha.
+        - min_abund: sequences less abundant than this are discarded (DnoisE --min_abund).
+        - first_position: codon position of the first base (DnoisE -x).
+        - entropy: weigh differences by codon position entropy (DnoisE -y).
+        - index: look up candidate mothers in a kmer_index.pigeonhole_index.
+
+    Outputs:
+        - int64 array, for each sequence the row of its mother (its own row for a correct sequence),
+            -1 for discarded sequences.
+        - Mean entropy of codon positions 1, 2 and 3.
+
+    Details:
+        Batched like unoise.unoise: a batch of queries is compared in one vectorized pass against
+        the correct sequences found so far that are abundant enough to be a mother of its least
+        abundant query (or, with the index, the ones sharing a pigeonhole block with it), keeping
+        each query's best ratio_d score. Queries with no mother are resolved in order against the
+        correct sequences their own batch adds, then the others are compared with those too, so the
+        result is the same as visiting every query in turn.
+    """
+
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(seqs):
+        return np.zeros(0, dtype=np.int64), np.zeros(3)
+
+    words, letters, ambiguous = unoise.packed_words(seqs)
+    positions, entropies, weights, masks, min_weight = distance_weights(words, letters, first_position, entropy)
+
+    order = np.argsort(-sizes, kind="stable")
+    order = order[sizes[order] >= min_abund]
+
+    assignment = np.full(len(seqs), -1, dtype=np.int64)
+    mothers = np.empty(len(order), dtype=np.int64)
+    n_mothers = 0
+
+    def distance(queries:np.ndarray, targets:np.ndarray) -> np.ndarray:
+        return weighted_distances(words, letters, ambiguous, masks, positions, weights, queries, targets)
+
+    # Differences far enough to need a check: up to the ones the rarest query could be at from the most abundant
+    if index and len(order) and alpha > 0:
+        reach = (np.log2(sizes[order[0]] / sizes[order[-1]]) - 1) / (alpha * min_weight)
+        mother_index = kmer_index.pigeonhole_index(letters, kmer_index.index_distance(letters.shape[1], reach))
+    else:
+        mother_index = None
+
+    for start in range(0, len(order), unoise.batch_size):
+        batch = order[start:start + unoise.batch_size]
+        batch_sizes = sizes[batch]
+        best_mother = np.full(len(batch), -1, dtype=np.int64)
+        best_score = np.full(len(batch), np.inf)
+        dense = np.ones(len(batch), dtype=bool)
+
+        # Mothers abundant enough for the least abundant query at the smallest possible distance
+        mother_sizes = sizes[mothers[0:n_mothers]]
+        limit = np.searchsorted(-mother_sizes, -batch_sizes.min() * 2 ** (alpha * min_weight + 1), side="right")
+        step = max(1, unoise.block_elements // (len(batch) * words.shape[1] * 3))
+
+        # Queries that can only have mothers within the index's number of differences, through the index
+        if mother_index is not None and limit:
+            reach = (np.log2(mother_sizes[0] / batch_sizes) - 1) / (alpha * min_weight)
+            rows = np.flatnonzero(np.floor(reach + 1e-9) <= mother_index.max_distance)
+            pairs = mother_index.candidates(batch[rows], limit, max_pairs=len(rows) * limit // 4) if len(rows) else None
+            if pairs is not None:
+                query_index, numbers = pairs
+                targets = mothers[numbers]
+                distance_pairs = weighted_pair_distances(words, letters, ambiguous, masks, positions, weights,
+                                                         batch[rows[query_index]], targets)
+                score = np.log2(batch_sizes[rows[query_index]] / sizes[targets]) + alpha * distance_pairs + 1
+                takes = np.flatnonzero(score <= 0)
+
+                # The lowest score of each query, ties to the lowest numbered (most abundant) mother
+                pick = takes[np.lexsort((numbers[takes], score[takes], query_index[takes]))]
+                hit_rows, first = np.unique(query_index[pick], return_index=True)
+                best_mother[rows[hit_rows]] = targets[pick[first]]
+                best_score[rows[hit_rows]] = score[pick[first]]
+                dense[rows] = False
+
+        dense_rows = np.flatnonzero(dense)
+        for chunk in range(0, limit if len(dense_rows) else 0, step):
+            targets = mothers[chunk:min(chunk + step, limit)]
+            distance_block = distance(batch[dense_rows], targets)
+
+            # ratio_d: log2 of size(Q) / size(M) / beta(d), a mother when <= 0, the lowest wins
+            score = np.log2(batch_sizes[dense_rows][:, None] / sizes[targets][None, :]) + alpha * distance_block + 1
+            score[score > 0] = np.inf
+            chunk_best = score.argmin(axis=1)
+            chunk_score = score[np.arange(len(dense_rows)), chunk_best]
+
+            better = chunk_score < best_score[dense_rows]
+            best_score[dense_rows[better]] = chunk_score[better]
+            best_mother[dense_rows[better]] = targets[chunk_best[better]]
+
+        # Queries left against each other, in order: one with no possible mother among the earlier
+        # ones left is correct, the others join the lowest scoring earlier one that turned out correct
+        inside = distance(batch, batch)
+        left = np.flatnonzero(best_mother < 0)
+        left_scores = np.log2(batch_sizes[left][:, None] / batch_sizes[left][None, :]) + alpha * inside[left][:, left] + 1
+        left_scores[(left_scores > 0) | ~np.tri(len(left), k=-1, dtype=bool)] = np.inf
+
+        correct = np.isinf(left_scores).all(axis=1)
+        for i in np.flatnonzero(~correct).tolist():
+            earlier = np.flatnonzero(np.isfinite(left_scores[i]) & correct)
+            if len(earlier):
+                j = earlier[left_scores[i, earlier].argmin()]
+                best_mother[left[i]] = batch[left[j]]
+                best_score[left[i]] = left_scores[i, j]
+            else:
+                correct[i] = True
+
+        new = left[correct]
+        best_mother[new] = batch[new]
+        best_score[new] = -np.inf
+        mothers[n_mothers:n_mothers + len(new)] = batch[new]
+        n_mothers += len(new)
+
+        # Queries that found a mother among the earlier ones may have a better one among these
+        # (a mother has to be more abundant, so only the ones before them in the batch qualify)
+        rows = np.flatnonzero(best_mother != batch)
+        if len(new) and len(rows):
+            score = np.log2(batch_sizes[rows][:, None] / batch_sizes[new][None, :]) + alpha * inside[rows][:, new] + 1
+            score[score > 0] = np.inf
+            new_best = score.argmin(axis=1)
+            new_score = score[np.arange(len(rows)), new_best]
+
+            better = new_score < best_score[rows]
+            best_score[rows[better]] = new_score[better]
+            best_mother[rows[better]] = batch[new[new_best[better]]]
+
+        if mother_index is not None:
+            mother_index.add(mothers[mother_index.size:n_mothers])
+        assignment[batch] = best_mother
+
+    return assignment, entropies
+
+
+def write_mothers(out_path:str, headers:list, seqs:list, sizes:np.ndarray, assignment:np.ndarray) -> dict:
+    """
+    Write the correct sequences of an assignment (see dnoise), most abundant first, with their input
+    headers and their joined reads added to ";size=".
+
+    Outputs:
+        - Dict with the number of unique sequences, discarded ones and correct ones, for the log.
+    """
+
+    kept = assignment >= 0
+    totals = np.bincount(assignment[kept], weights=sizes[kept], minlength=len(seqs)).astype(np.int64)
+
+    mothers = np.flatnonzero(assignment == np.arange(len(seqs)))
+    mothers = mothers[np.argsort(-totals[mothers], kind="stable")]
+
+    def header(row:int) -> bytes:
+        size = b";size=%d" % totals[row]
+        if fastx.size_pattern.search(headers[row]):
+            return fastx.size_pattern.sub(size, headers[row], count=1)
+        return headers[row] + size + b";"
+
+    with open(out_path, "wb") as out_file:
+        out_file.write(b"".join(b">%s\n%s\n" % (header(row), seqs[row]) for row in mothers.tolist()))
+
+    return {"uniques": len(seqs), "discarded": int((~kept).sum()), "correct": len(mothers)}
+
+
+def dnoise_fasta(in_path:str, out_path:str, alpha:float=default_alpha, min_abund:int=default_min_abund,
+                 first_position:int=1, entropy:bool=True) -> dict:
+    """
+    Denoise a ";size=N" annotated fasta file (e.g. frequency_filter output) into a fasta of its correct
+    sequences (see write_mothers).
+
+    Outputs:
+        - Dict of write_mothers plus the codon position entropies, for the log.
+    """
+
+    headers, seqs, sizes = unoise.read_uniques(in_path)
+    assignment, entropies = dnoise(seqs, sizes, alpha, min_abund, first_position, entropy)
+    return {**write_mothers(out_path, headers, seqs, sizes, assignment), "entropies": entropies.tolist()}
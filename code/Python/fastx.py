@@ -0,0 +1,385 @@
+import os, io, re, gzip, shutil, subprocess
+
+# Compressed fastq/fasta support shared by every stage.
+#
+# Inputs can be plain, .gz or .zst. Intermediate outputs are compressed when a stage is given
+# compress=".gz" or ".zst". Compression and decompression go through pigz / zstd (multi-threaded,
+# block parallel) when they are installed, with python's gzip as the fallback.
+
+compression_suffixes = [".gz", ".zst"]
+
+# Compressed formats each external tool reads and writes by itself
+native_formats = {"vsearch": [".gz"], "cutadapt": [".gz", ".zst"]}
+
+# Threads given to pigz/zstd when the caller doesn't set them. Stages run several samples at once,
+# so each pipe gets one thread unless the job builders hand it a share of a core budget.
+compress_threads = 1
+
+# vsearch style abundance annotation of dereplicated records
+size_pattern = re.compile(rb";size=(\d+)")
+
+
+def compression(path:str) -> str:
+    """
+    Compression suffix of a path (".gz" or ".zst"), "" for a plain file.
+    """
+    for suffix in compression_suffixes:
+        if path.endswith(suffix):
+            return suffix
+    return ""
+
+
+def strip_compression(file:str) -> str:
+    return file[0:len(file) - len(compression(file))]
+
+
+def sample_name(file:str, suffix:str) -> str:
+    """
+    Sample name of a stage file, e.g. sample_name("A_merged.fastq.gz", "_merged.fastq") -> "A".
+    """
+    return strip_compression(file)[0:-len(suffix)]
+
+
+def is_fastx(file:str, extension:str) -> bool:
+    """
+    True for plain or compressed files with the extension (".fastq" or ".fasta").
+    """
+    return strip_compression(file).endswith(extension)
+
+
+def find(directory:str, stem:str, prefer:str="") -> str:
+    """
+    Path of {directory}/{stem} in whichever compression is on disk, trying prefer ("", ".gz" or ".zst")
+    first. If none is on disk (yet), the path with prefer.
+    """
+    for suffix in [prefer] + [suffix for suffix in [""] + compression_suffixes if suffix != prefer]:
+        if os.path.exists(f"{directory}/{stem}{suffix}"):
+            return f"{directory}/{stem}{suffix}"
+    return f"{directory}/{stem}{prefer}"
+
+
+def sample_names(directory:str, suffix:str) -> list:
+    """
+    Sorted sample names of the stage files in a directory, each once even if it is on disk in
+    several compressions (e.g. left by a cached run with another compress). Pick each one's file with find.
+    """
+    return sorted({sample_name(file, suffix) for file in os.listdir(directory) if is_fastx(file, suffix)})
+
+
+def remove_other_compressions(path:str):
+    """
+    Remove the copies of a file in the other compressions, so later stages only find the one just written.
+    """
+    stem = strip_compression(path)
+    for suffix in [""] + compression_suffixes:
+        if f"{stem}{suffix}" != path and os.path.exists(f"{stem}{suffix}"):
+            os.remove(f"{stem}{suffix}")
+
+
+def compressor_call(suffix:str, threads:int=None) -> list:
+    """
+    Command compressing stdin to stdout in the given format, with threads threads (compress_threads if None).
+    """
+
+    threads = str(threads or compress_threads)
+
+    if suffix == ".gz":
+        if shutil.which("pigz"):
+            return ["pigz", "-c", "-p", threads]
+        return ["gzip", "-c"]
+
+    if suffix == ".zst":
+        return ["zstd", "-q", "-c", f"-T{threads}"]
+
+    raise ValueError(f"Unknown compression {suffix}")
+
+
+def decompressor_call(suffix:str, threads:int=None) -> list:
+    """
+    Command decompressing a file (appended to the command) to stdout. pigz gets threads threads
+    (compress_threads if None) for its reading, writing and checking, the others use one.
+    """
+
+    if suffix == ".gz":
+        if shutil.which("pigz"):
+            return ["pigz", "-dc", "-p", str(threads or compress_threads)]
+        if shutil.which("igzip"):
+            return ["igzip", "-dc"]
+        return ["gzip", "-dc"]
+
+    if suffix == ".zst":
+        return ["zstd", "-dcq"]
+
+    raise ValueError(f"Unknown compression {suffix}")
+
+
+class piped_file():
+    """
+    File object over a compression tool's stdin or stdout. Closing it waits for the tool
+    and raises if it failed, so a broken archive isn't read as a short file.
+    """
+
+    def __init__(self, proc:subprocess.Popen, file, path:str):
+        self.proc = proc
+        self.file = file
+        self.path = path
+
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.proc.wait() != 0:
+            raise OSError(f"{self.proc.args[0]} exited with {self.proc.returncode} on {self.path}")
+
+
+def open_fastx(path:str, mode:str="r", threads:int=None):
+    """
+    Open a plain, .gz or .zst fastq/fasta file for streaming.
+
+    Inputs:
+        - path: file path, compression is taken from the suffix.
+        - mode: "r", "rb", "w", "wb" or "a" (append only for plain files).
+        - threads: threads of the pigz/zstd process (compress_threads if None).
+
+    Outputs:
+        - File object (text unless mode has "b").
+
+    Details:
+        Compressed files are read from / written to a pigz or zstd process through a pipe, so
+        (de)compression runs on other cores while python works on the records.
+        Without pigz, gz files fall back to python's gzip module.
+    """
+
+    suffix = compression(path)
+    binary = "b" in mode
+    writing = "w" in mode or "a" in mode
+
+    if not suffix:
+        return open(path, mode)
+
+    if "a" in mode:
+        raise ValueError(f"Can't append to compressed file {path}")
+
+    if suffix == ".gz" and not shutil.which("pigz" if writing else "gzip"):
+        return gzip.open(path, mode if binary else f"{mode[0]}t")
+
+    if writing:
+        out_file = open(path, "wb")
+        proc = subprocess.Popen(compressor_call(suffix, threads), stdin=subprocess.PIPE, stdout=out_file)
+        out_file.close()
+        file = proc.stdin if binary else io.TextIOWrapper(proc.stdin)
+    else:
+        proc = subprocess.Popen(decompressor_call(suffix, threads) + [path], stdout=subprocess.PIPE)
+        file = proc.stdout if binary else io.TextIOWrapper(proc.stdout)
+
+    return piped_file(proc, file, path)
+
+
+def fastq_chunks(path:str, block_size:int=1 << 22):
+    """
+    Stream a fastq file (plain or compressed) as chunks of whole records, in constant memory.
+
+    Inputs:
+        - path: fastq file.
+        - block_size: bytes read at a time.
+
+    Outputs:
+        - Yields (headers, sequences, qualities): lists of bytes lines without newlines,
+            one entry per record, for all complete records in the block read so far.
+
+    Details:
+        Reads big binary blocks and splits them into lines in one go, so the per-record
+        python work is just slicing the line list. Lines of an unfinished last record are
+        carried over to the next block. Assumes the usual 4-line records (no wrapped sequences).
+    """
+
+    rest = b""
+    with open_fastx(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            lines = (rest + block).split(b"\n")
+
+            # The last line is partial (or empty after a final newline), so whole records
+            # are the first multiple of 4 lines before it
+            complete = (len(lines) - 1) // 4 * 4
+            rest = b"\n".join(lines[complete:])
+
+            if complete:
+                yield lines[0:complete:4], lines[1:complete:4], lines[3:complete:4]
+
+    lines = rest.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+
+    if len(lines) % 4:
+        raise ValueError(f"{path} ends in the middle of a fastq record")
+
+    if lines:
+        yield lines[0::4], lines[1::4], lines[3::4]
+
+
+def fastq_records(path:str, block_size:int=1 << 22):
+    """
+    Stream a fastq file one (header, sequence, quality) record at a time, see fastq_chunks.
+    """
+    for headers, seqs, quals in fastq_chunks(path, block_size):
+        yield from zip(headers, seqs, quals)
+
+
+def last_record_start(data:bytes, fasta:bool) -> int:
+    """
+    Byte position in data where its last record starts (0 if no record starts after position 0).
+    """
+
+    if fasta:
+        return data.rfind(b"\n>") + 1
+
+    # A line starting with "@" can also be a quality line. It's a header if the line
+    # two below it is the "+" separator (a quality line has a sequence line there).
+    position = len(data)
+    while True:
+        position = data.rfind(b"\n@", 0, position)
+        if position < 0:
+            return 0
+
+        line = position + 1
+        for _ in range(2):
+            line = data.find(b"\n", line) + 1
+            if not line:
+                break
+
+        if line and data.startswith(b"+", line):
+            return position + 1
+
+
+def record_blocks(path:str, block_size:int=1 << 22):
+    """
+    Stream a fastq or fasta file (plain or compressed) as raw blocks of whole records.
+
+    Outputs:
+        - Yields bytes, each starting at a record and ending where the next one starts
+            (the last one at the end of the file). Parse them with fastq_block / fasta_block.
+
+    Details:
+        Only the tail of each block read is searched for the last record start, the bytes
+        before it go out with the carried over start of the block's first record.
+    """
+
+    fasta = is_fastx(path, ".fasta")
+
+    rest = b""
+    with open_fastx(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            start = last_record_start(block, fasta)
+
+            if start:
+                yield rest + block[0:start]
+                rest = block[start:]
+            else:
+                rest += block
+
+    if rest:
+        yield rest
+
+
+def fastq_block(block:bytes):
+    """
+    Split a block of whole fastq records into (headers, sequences, qualities) lists of bytes.
+    """
+
+    lines = block.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+
+    if len(lines) % 4:
+        raise ValueError("fastq block ends in the middle of a record")
+
+    return lines[0::4], lines[1::4], lines[3::4]
+
+
+def fasta_block(block:bytes):
+    """
+    Split a block of whole fasta records into (headers, sequences) lists of bytes.
+    Headers lose their ">", sequences wrapped over several lines are joined.
+    """
+
+    # Skip blank lines before the first record (like the denoise output fix leaves)
+    block = block.lstrip(b"\n")
+
+    # One line sequences: if the odd lines hold no header, the even lines are all of them
+    lines = block.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    if len(lines) == 2 * block.count(b">") and b">" not in b"".join(lines[1::2]):
+        return [header[1:] for header in lines[0::2]], lines[1::2]
+
+    headers = []
+    seqs = []
+    for record in block[1:].split(b"\n>"):
+        header, _, seq = record.partition(b"\n")
+        headers.append(header)
+        seqs.append(seq.replace(b"\n", b""))
+
+    return headers, seqs
+
+
+def abundance(header:bytes) -> int:
+    """
+    Read count of a record from its ";size=N" annotation, 1 if it has none.
+    """
+    size = size_pattern.search(header)
+    return int(size.group(1)) if size else 1
+
+
+def tool_input(path:str, tool:str, fifo_dir:str, threads:int=None):
+    """
+    Input path to give an external tool, and the feed decompressing it (with threads threads) if the tool can't.
+
+    Outputs:
+        - path for the tool's command line.
+        - None, or a feed for runner.run_jobs: {"call": decompressor, "fifo": named pipe the tool reads}.
+    """
+
+    suffix = compression(path)
+    if not suffix or suffix in native_formats.get(tool, []):
+        return path, None
+
+    fifo = f"{fifo_dir}/.{os.path.basename(strip_compression(path))}.fifo"
+    return fifo, {"call": decompressor_call(suffix, threads) + [path], "fifo": fifo}
+
+
+def tool_job(call:list, output:str, feeds:list=[], threads:int=None) -> dict:
+    """
+    Job calls for a tool writing output. A compressed output is written by the tool to stdout
+    ("-" in its call, see tool_output) and piped through pigz/zstd (with threads threads) into the file.
+
+    Outputs:
+        - Dict with "call" or "calls" (+ "stdout"), and "feeds" if any, to merge into a job.
+    """
+
+    job = {"call": call}
+
+    suffix = compression(output)
+    if suffix:
+        job = {"calls": [call, compressor_call(suffix, threads)], "stdout": output}
+
+    feeds = [feed for feed in feeds if feed is not None]
+    if feeds:
+        job["feeds"] = feeds
+
+    return job
+
+
+def tool_output(output:str) -> str:
+    return "-" if compression(output) else output
@@ -0,0 +1,185 @@
+import os, mmap, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fastx
+
+# Record-offset index of plain fastq/fasta files, for splitting one big file between processes.
+#
+# The index holds the byte offset of every index_stride-th record and is saved as
+# .index/{file}.npz beside the file (like stage_cache's .cache/). It is rebuilt when the
+# file's size or modification time changes. Compressed files can't be seeked into, so
+# they are never indexed and map_blocks reads them in one process.
+
+index_dir_name = ".index"
+index_stride = 4096
+
+# Bytes of the file scanned at a time while building an index
+scan_size = 1 << 26
+
+
+def index_path(path:str) -> str:
+    return f"{os.path.dirname(path) or '.'}/{index_dir_name}/{os.path.basename(path)}.npz"
+
+
+def build_index(path:str, stride:int=None) -> np.ndarray:
+    """
+    Byte offsets of every stride-th record (index_stride if None) of a plain fastq/fasta file.
+
+    Outputs:
+        - int64 array starting at 0 and ending with the file size.
+
+    Details:
+        The file is memory mapped and scanned in windows with numpy. fastq records start
+        after every 4th newline. fasta records start at a ">" that begins a line, so wrapped
+        sequences are fine.
+    """
+
+    stride = stride or index_stride
+    fasta = fastx.is_fastx(path, ".fasta")
+    size = os.path.getsize(path)
+
+    starts = [np.zeros(1, dtype=np.int64)]
+    lines_before = 0 # fastq: newlines before the current window
+    records_before = 1 # fasta: record starts before the current window (the one at 0)
+
+    if size:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+
+        for window in range(0, size, scan_size):
+            chunk = data[window:window + scan_size]
+
+            if fasta:
+                # ">" right after a newline, the window's first byte looks back one byte
+                previous = data[window - 1:window + len(chunk) - 1] if window else np.concatenate(([0], chunk[:-1]))
+                record_starts = np.flatnonzero((chunk == ord(">")) & (previous == ord("\n"))) + window
+                numbers = np.arange(records_before, records_before + len(record_starts))
+                records_before += len(record_starts)
+            else:
+                newlines = np.flatnonzero(chunk == ord("\n"))
+                line_numbers = np.arange(lines_before + 1, lines_before + len(newlines) + 1)
+                lines_before += len(newlines)
+                on_record = line_numbers % 4 == 0
+                record_starts = newlines[on_record] + window + 1
+                numbers = line_numbers[on_record] // 4
+
+            starts.append(record_starts[numbers % stride == 0].astype(np.int64))
+
+    offsets = np.concatenate(starts)
+    # The start of a record after the last newline is the end of the file
+    offsets = offsets[offsets < size]
+    return np.append(offsets, size)
+
+
+def load_index(path:str, stride:int=None) -> np.ndarray:
+    """
+    Record offsets of a plain fastq/fasta file (see build_index), read from beside the file
+    if it is still up to date, built and saved otherwise.
+    """
+
+    stride = stride or index_stride
+
+    stat = os.stat(path)
+    saved = index_path(path)
+
+    if os.path.exists(saved):
+        with np.load(saved) as index:
+            if (int(index["size"]) == stat.st_size and int(index["mtime_ns"]) == stat.st_mtime_ns
+                and int(index["stride"]) == stride):
+                return index["offsets"]
+
+    offsets = build_index(path, stride)
+
+    # A read-only data folder just means rebuilding the index next time
+    try:
+        os.makedirs(os.path.dirname(saved), exist_ok=True)
+        with open(f"{saved}.tmp", "wb") as index_file:
+            np.savez(index_file, offsets=offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns, stride=stride)
+        os.replace(f"{saved}.tmp", saved)
+    except OSError:
+        pass
+
+    return offsets
+
+
+def block_ranges(path:str, block_bytes:int) -> list:
+    """
+    Record aligned (start, end) byte ranges of about block_bytes covering a plain fastq/fasta file.
+    """
+
+    offsets = load_index(path)
+    size = int(offsets[-1])
+
+    # Nearest indexed record at or after each multiple of block_bytes
+    targets = np.arange(block_bytes, size, block_bytes)
+    bounds = np.unique(np.concatenate(([0], offsets[np.searchsorted(offsets, targets)], [size])))
+
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def read_block(path:str, start:int, end:int) -> bytes:
+    """
+    Bytes start:end of a file through a memory map, so workers share the page cache
+    instead of each streaming the file.
+    """
+
+    if end <= start:
+        return b""
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return mapped[start:end]
+
+
+def run_block(func, path:str, block_range:tuple):
+    # The worker's CPU time goes back with the result, the parent's clock doesn't see it
+    cpu_start = time.process_time()
+    result = func(read_block(path, *block_range))
+    return result, time.process_time() - cpu_start
+
+
+def map_blocks(func, path:str, n_jobs:int=1, block_bytes:int=1 << 25, worker_cpu:list=None):
+    """
+    Apply func to every block of whole records of a fastq/fasta file, in parallel over one file.
+
+    Inputs:
+        - func: called with a bytes block of whole records (see fastx.fastq_block / fastx.fasta_block).
+                Has to be picklable (a module level function or a partial of one) for n_jobs > 1.
+        - path: plain or compressed fastq/fasta file.
+        - n_jobs: worker processes.
+        - block_bytes: approximate size of a block given to a worker (and at most the read size
+                of the in-process path, so a small value also bounds its memory).
+        - worker_cpu: if given, the CPU seconds worker processes spent on each block are appended
+                to it (blocks read in this process count towards the caller's own thread_time).
+
+    Outputs:
+        - Yields func's results in file order.
+
+    Details:
+        Plain files are split into record aligned byte ranges with the offset index (see load_index)
+        and the workers read their range straight from the file. At most 2 * n_jobs blocks are in flight
+        so results waiting to be merged don't pile up in memory.
+        Compressed files, small files and n_jobs = 1 are read in this process with fastx.record_blocks.
+    """
+
+    if n_jobs <= 1 or fastx.compression(path) or os.path.getsize(path) <= block_bytes:
+        for block in fastx.record_blocks(path, min(block_bytes, 1 << 22)):
+            yield func(block)
+        return
+
+    ranges = block_ranges(path, block_bytes)
+
+    def result(future):
+        block_result, cpu = future.result()
+        if worker_cpu is not None:
+            worker_cpu.append(cpu)
+        return block_result
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for block_range in ranges:
+            pending.append(pool.submit(run_block, func, path, block_range))
+            if len(pending) >= 2 * n_jobs:
+                yield result(pending.popleft())
+
+        while pending:
+            yield result(pending.popleft())
@@ -1,15 +1,310 @@
+import os, math, random, itertools
+from collections import Counter
+
+# Example COI amplicon from the study (alignments.align_amplicon) without the two
+# leading N's used there to get the reading frame. 142 bp, the first base is codon position 3.
+reference_amplicon = "CTTATCATCTGGAATTGCCCATGCCGGGGCTTCCGTTGATTTAGCAATTTTTTCACTTCACCTAGCAGGAATTTCATCTATTCTAGGGGCTGTAAATTTTATTACTACAATTATTAATATACGATCTAATGGAATTACTTTT"
+
+# EPTDr2n main primers, same as pipeline.primer_args(primer_option=1)
+fwd_primer = "GGDACWGGWTGAACWGTWTAYCCHCC"
+rvs_primer = "CAAACAAATARDGGTATTCGDTY"
+
+# Illumina read 1 / read 2 adapters, sequenced into reads shorter than the insert
+fwd_adapter = "AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC"
+rvs_adapter = "AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT"
+
+complement = str.maketrans("ACGTN", "TGCAN")
+
+iupac = {"A": "A", "C": "C", "G": "G", "T": "T",
+         "R": "AG", "Y": "CT", "W": "AT", "S": "CG", "K": "GT", "M": "AC",
+         "D": "AGT", "H": "ACT", "B": "CGT", "V": "ACG", "N": "ACGT"}
+
+stop_codons = {"TAA", "TAG", "TGA"}
+
+
+def reverse_complement(seq:str) -> str:
+    return seq.translate(complement)[::-1]
 
 
 class random_sequence():
+    """
+    Simulate paired-end amplicon reads from a community of COI haplotypes.
+
+    Inputs:
+        - amplicon_length: length of the amplicon between the primers.
+        - frame_start: codon position (1, 2 or 3) of the first amplicon base, like DnoisE -x.
+        - read_length: length of each read of the pair.
+        - base_error: substitution probability at the start of a read. It rises towards the
+                end of the read like Illumina qualities do (4x at the last base).
+        - codon_weights: relative chance of a haplotype mutation hitting codon position 1, 2 and 3.
+                Mostly 3rd positions, like real COI variation.
+        - seed: random seed, the same seed gives the same files.
+
+    Details:
+        Haplotypes are made from the reference amplicon with codon aware mutations (no stop codons).
+        Each read pair comes from an insert of: 0-3 random spacer bases + forward primer +
+        haplotype + reverse complement of the reverse primer, with the degenerate primer bases
+        drawn at random. R1 reads the insert forwards, R2 the reverse complement, both run into
+        the adapter if the insert is shorter than the read.
+        A chimera is the start of one haplotype joined to the end of another at a random breakpoint.
+    """
+
+    def __init__(self, amplicon_length:int=142, frame_start:int=3, read_length:int=150,
+                 base_error:float=0.002, codon_weights:list=[0.15, 0.05, 0.8], seed:int=None):
+
+        self.rng = random.Random(seed)
+        self.frame_start = frame_start
+        self.read_length = read_length
+        self.base_error = base_error
+        self.codon_weights = codon_weights
+
+        # Repeat/cut the reference to the requested amplicon length
+        self.reference = (reference_amplicon * (amplicon_length // len(reference_amplicon) + 1))[0:amplicon_length]
+        self.codon_positions = self.get_codons(amplicon_length)
+
+        # Per read position error probability, quality string and the thinning ceiling
+        self.error_probs = [base_error * (1 + 3 * (i / max(1, read_length - 1)) ** 2) for i in range(read_length)]
+        self.max_error = max(self.error_probs)
+        self.quality = "".join(chr(min(41, int(-10 * math.log10(p))) + 33) for p in self.error_probs)
+        self.log_keep = math.log(1 - self.max_error)
+
+        # Pre-drawn primer variants, drawing every degenerate base per read is the slowest part otherwise
+        self.fwd_variants = [self.realize(fwd_primer) for _ in range(256)]
+        self.rvs_variants = [reverse_complement(self.realize(rvs_primer)) for _ in range(256)]
+
+    def get_codons(self, length:int=None) -> list:
+        """
+        Codon position (1, 2 or 3) of every base in the amplicon.
+        """
+        length = length if length is not None else len(self.reference)
+        return [(self.frame_start - 1 + i) % 3 + 1 for i in range(length)]
+
+    def get_entropy(self, sequences:list) -> dict:
+        """
+        Average Shannon entropy (bits) of each codon position over a set of equal length sequences.
+        Useful to check the simulated haplotypes have most variation at 3rd positions.
+        """
+
+        entropies = {1: [], 2: [], 3: []}
+        for i, codon_position in enumerate(self.get_codons(len(sequences[0]))):
+            counts = Counter(seq[i] for seq in sequences)
+            total = sum(counts.values())
+            entropies[codon_position].append(-sum(n / total * math.log2(n / total) for n in counts.values()))
+
+        return {position: sum(values) / len(values) if values else 0 for position, values in entropies.items()}
+
+    def has_stop(self, seq:str) -> bool:
+        # First complete codon starts where codon position 1 first occurs
+        start = (4 - self.frame_start) % 3
+        return any(seq[i:i + 3] in stop_codons for i in range(start, len(seq) - 2, 3))
+
+    def mutate(self, seq:str, n_mutations:int) -> str:
+        """
+        Apply codon aware substitutions, picking the codon position by codon_weights and
+        rejecting any change that makes a stop codon.
+        """
+
+        seq = list(seq)
+        by_position = {position: [i for i, p in enumerate(self.codon_positions) if p == position] for position in (1, 2, 3)}
+
+        done = 0
+        tries = 0
+        while done < n_mutations and tries < 100 * n_mutations:
+            tries += 1
+            position = self.rng.choices([1, 2, 3], weights=self.codon_weights)[0]
+            i = self.rng.choice(by_position[position])
+            old = seq[i]
+            seq[i] = self.rng.choice([base for base in "ACGT" if base != old])
+            if self.has_stop("".join(seq)):
+                seq[i] = old
+                continue
+            done += 1
+
+        return "".join(seq)
+
+    def make_haplotypes(self, n_haplotypes:int, mutations:int=6) -> list:
+        """
+        Make a tree-like set of haplotypes: each new one is a mutated copy of a random earlier one
+        (the first is a mutated reference), so there are close relatives and distant ones.
+        """
+        haplotypes = [self.mutate(self.reference, mutations)]
+        while len(haplotypes) < n_haplotypes:
+            parent = self.rng.choice(haplotypes)
+            child = self.mutate(parent, self.rng.randint(1, mutations))
+            if child not in haplotypes:
+                haplotypes.append(child)
+        return haplotypes
+
+    def realize(self, primer:str) -> str:
+        # Draw one concrete sequence for a degenerate primer
+        return "".join(self.rng.choice(iupac[base]) for base in primer)
+
+    def make_insert(self, amplicon:str) -> str:
+        spacer = "".join(self.rng.choices("ACGT", k=self.rng.randint(0, 3)))
+        return spacer + self.rng.choice(self.fwd_variants) + amplicon + self.rng.choice(self.rvs_variants)
+
+    def add_errors(self, read:str):
+        """
+        Add position dependent substitution errors to a read.
+
+        Outputs:
+            - read with errors, quality string, number of errors.
+
+        Details:
+            Candidate positions are drawn with geometric skips at the highest error rate and kept
+            with probability error_probs[i] / max_error, so the cost is per error, not per base.
+            Error bases get a low quality score, like a real base caller would give them.
+        """
+
+        quality = self.quality
+        i = -1
+        errors = []
+        while True:
+            i += 1 + int(math.log(1 - self.rng.random()) / self.log_keep)
+            if i >= len(read):
+                break
+            if self.rng.random() * self.max_error < self.error_probs[i]:
+                errors.append(i)
+
+        if not errors:
+            return read, quality, 0
+
+        read = list(read)
+        quality = list(quality)
+        for i in errors:
+            # About 1 in 100 errors is an uncalled base
+            read[i] = "N" if self.rng.random() < 0.01 else self.rng.choice([base for base in "ACGT" if base != read[i]])
+            quality[i] = chr(self.rng.randint(2, 15) + 33)
+
+        return "".join(read), "".join(quality), len(errors)
+
+    def read_pair(self, amplicon:str):
+        """
+        R1 and R2 sequence and quality for one template, plus the total number of errors.
+        """
+
+        insert = self.make_insert(amplicon)
+        r1 = (insert + fwd_adapter)[0:self.read_length]
+        r2 = (reverse_complement(insert) + rvs_adapter)[0:self.read_length]
+        r1, q1, e1 = self.add_errors(r1)
+        r2, q2, e2 = self.add_errors(r2)
+        return r1, q1, r2, q2, e1 + e2
+
+    def draw_template(self, haplotypes:list, present:list, cum_weights:list, chimera_rate:float):
+        """
+        Pick the template of one read: a haplotype of the site by abundance, or a chimera of two.
+
+        Outputs:
+            - template sequence, label (haplotype id or idA+idB@breakpoint).
+        """
+
+        hap = self.rng.choices(present, cum_weights=cum_weights)[0]
+        template = haplotypes[hap]
+        label = f"hap_{hap}"
+
+        if self.rng.random() < chimera_rate:
+            other = self.rng.choices(present, cum_weights=cum_weights)[0]
+            breakpoint = self.rng.randint(20, len(template) - 20)
+            if other != hap:
+                template = template[0:breakpoint] + haplotypes[other][breakpoint:]
+                label = f"hap_{hap}+hap_{other}@{breakpoint}"
+
+        return template, label
+
+    def amplicon_read(self, amplicon:str):
+        """
+        Merged and primer trimmed read for one template, like the quality filtered reads.
+        About 2% lose or gain a base at the end (primer trimming slop) so the length filter has work to do.
+        """
+
+        read, quality, errors = self.add_errors(amplicon)
+        if self.rng.random() < 0.02:
+            if self.rng.random() < 0.5:
+                read, quality = read[0:-1], quality[0:-1]
+            else:
+                read, quality = read + self.rng.choice("ACGT"), quality + quality[-1]
+        return read, quality, errors
+
+    def simulate(self, out_dir:str, n_sites:int=10, n_haplotypes:int=50, haplotypes_per_site:int=10,
+                 reads_per_site:int=1000, chimera_rate:float=0.02, mutations:int=6, chunk_size:int=10000,
+                 amplicons_only:bool=False):
+        """
+        Write a simulated run in the layout the pipeline expects.
+
+        Inputs:
+            - out_dir: data directory to write to.
+            - n_sites: number of sites (samples).
+            - n_haplotypes: size of the haplotype pool the sites draw from.
+            - haplotypes_per_site: haplotypes present at each site.
+            - reads_per_site: read pairs per site. Reads are written in chunks of chunk_size,
+                    so memory doesn't grow with the run size (10k to 100M reads).
+            - chimera_rate: fraction of read pairs that come from a chimeric template.
+            - mutations: maximum mutations between a haplotype and its parent.
+            - amplicons_only: skip the raw pairs and write merged, primer trimmed reads straight
+                    to quality_filtered/, for running the in-process stages without vsearch and cutadapt.
+
+        Outputs:
+            - {out_dir}/input/site_<i>_R1.fastq and _R2.fastq (or {out_dir}/quality_filtered/site_<i>.fastq).
+                Read headers carry the truth:
+                @site_<i>_<n> hap=<haplotype id or idA+idB@breakpoint> errors=<n>
+            - {out_dir}/truth/haplotypes.fasta: every haplotype in the pool.
+            - {out_dir}/truth/site_composition.csv: site, haplotype, read pairs (chimeras as their own rows).
+        """
+
+        read_dir = "quality_filtered" if amplicons_only else "input"
+        os.makedirs(f"{out_dir}/{read_dir}", exist_ok=True)
+        os.makedirs(f"{out_dir}/truth", exist_ok=True)
+
+        haplotypes = self.make_haplotypes(n_haplotypes, mutations)
+
+        with open(f"{out_dir}/truth/haplotypes.fasta", "w") as hap_file:
+            for i, haplotype in enumerate(haplotypes):
+                hap_file.write(f">hap_{i}\n{haplotype}\n")
+
+        composition = open(f"{out_dir}/truth/site_composition.csv", "w")
+        composition.write("site,haplotype,reads\n")
+
+        for site in range(1, n_sites + 1):
+            name = f"site_{site}"
+            present = self.rng.sample(range(len(haplotypes)), min(haplotypes_per_site, len(haplotypes)))
+            # Skewed (log-normal) abundances, a few dominant haplotypes and a tail of rare ones
+            cum_weights = list(itertools.accumulate(self.rng.lognormvariate(0, 1.5) for _ in present))
+
+            counts = Counter()
+            if amplicons_only:
+                out_files = [open(f"{out_dir}/quality_filtered/{name}.fastq", "w")]
+            else:
+                out_files = [open(f"{out_dir}/input/{name}_R1.fastq", "w"), open(f"{out_dir}/input/{name}_R2.fastq", "w")]
+
+            for chunk_start in range(0, reads_per_site, chunk_size):
+                chunks = [[] for _ in out_files]
+                for n in range(chunk_start, min(reads_per_site, chunk_start + chunk_size)):
+                    template, label = self.draw_template(haplotypes, present, cum_weights, chimera_rate)
+                    counts[label] += 1
+
+                    if amplicons_only:
+                        read, quality, errors = self.amplicon_read(template)
+                        chunks[0].append(f"@{name}_{n + 1} hap={label} errors={errors}\n{read}\n+\n{quality}\n")
+                    else:
+                        r1, q1, r2, q2, errors = self.read_pair(template)
+                        header = f"{name}_{n + 1} hap={label} errors={errors}"
+                        chunks[0].append(f"@{header}\n{r1}\n+\n{q1}\n")
+                        chunks[1].append(f"@{header}\n{r2}\n+\n{q2}\n")
+
+                for out_file, chunk in zip(out_files, chunks):
+                    out_file.write("".join(chunk))
+
+            for out_file in out_files:
+                out_file.close()
+
+            for label, count in counts.most_common():
+                composition.write(f"{name},{label},{count}\n")
 
-    def __init__(self):
-        pass
+            print(f"\nSimulated {reads_per_site} reads for {name}.\n")
 
-    def get_codons():
-        #for the gene fragement get codon positions
-        pass
+        composition.close()
 
-    def get_entropy():
-        #from a set of original sequences for an OTU claculate the entropy for each codon posistion
-        pass
 
+if __name__ == "__main__":
+    simulator = random_sequence(seed=516)
+    simulator.simulate(out_dir="../../../data/simulated", n_sites=10, reads_per_site=10000)
@@ -0,0 +1,281 @@
+import os, math, zlib, heapq, struct
+from collections import Counter
+import numpy as np
+import fastx, fastx_index, seqpack, abundance
+
+# Out-of-core frequency filter (pipeline.frequency_filter with a memory budget).
+#
+# 1. Every site is streamed in blocks and each block's counts are hash-partitioned by sequence
+#    into bucket files on disk, so all sites' counts of a sequence end up in the same bucket.
+# 2. Each bucket is counted on its own (one bucket in memory at a time), the keep/drop rule is
+#    applied, and its entries are written back sorted by (site, count descending, first seen).
+# 3. The sorted bucket runs are merged, streaming each site's fasta and log lines in the same
+#    order as the in-memory path.
+# Buckets hold disjoint sequences, so the abundance matrix columns (see abundance.py) are
+# numbered bucket by bucket in pass 2 and its rows are streamed in pass 3.
+
+# Pass 1 record: site, count, first seen (record number within the site), key length, then the key
+count_record = struct.Struct("<IQQH")
+
+# Sorted run record: site, count, first seen, kept, sites the sequence is too rare at, abundance matrix column,
+# key length, then the key
+run_record = struct.Struct("<IQQBQQH")
+
+# Rough memory per counted (site, sequence) entry, dict and tuple overhead included
+entry_bytes = 300
+
+max_buckets = 512
+
+
+def bucket_count(in_files:list, memory_budget_mb:float) -> int:
+    """
+    Number of buckets so one bucket's counts fit in the memory budget, sized from the input files.
+    """
+
+    # Compressed inputs are sized as uncompressed (about 4x), like scheduler.py.
+    # A fasta record is ~150-200 bytes on disk, about one table entry at worst.
+    input_bytes = sum(os.path.getsize(file) * (4 if fastx.compression(file) else 1) for file in in_files)
+    return min(max_buckets, max(1, math.ceil(input_bytes * entry_bytes / 150 / (memory_budget_mb * 1e6))))
+
+
+def bucket_of(key:bytes, n_buckets:int) -> int:
+    # crc32 rather than hash() so worker processes agree on the buckets
+    return zlib.crc32(key) % n_buckets
+
+
+def first_counts_block(block:bytes) -> tuple:
+    """
+    Counts of a block of fasta records with the record number each sequence is first seen at.
+
+    Outputs:
+        - (list of (packed key, count, first record in the block), number of records)
+    """
+
+    headers, seqs = fastx.fasta_block(block)
+    sized = b";size=" in block
+
+    seq_counts = Counter()
+    first = {}
+    for i, (header, seq) in enumerate(zip(headers, seqs)):
+        if seq not in first:
+            first[seq] = i
+        seq_counts[seq] += fastx.abundance(header) if sized else 1
+
+    keys = seqpack.encode_many(list(seq_counts))
+    return [(key, count, first[seq]) for key, (seq, count) in zip(keys, seq_counts.items())], len(seqs)
+
+
+def write_buckets(in_files:list, spill_dir:str, n_buckets:int, memory_budget_mb:float, n_jobs:int=1) -> list:
+    """
+    Pass 1: stream every site into the bucket files.
+
+    Outputs:
+        - Paths of the bucket files (some may not exist if no sequence hashed to them).
+
+    Details:
+        Parsing and packing a block takes about 10 times its size in python objects and numpy
+        arrays, so blocks are kept to a sixteenth of the budget.
+    """
+
+    block_bytes = int(min(max(memory_budget_mb * 1e6 / 16, 1 << 18), 1 << 22))
+
+    bucket_paths = [f"{spill_dir}/bucket_{bucket}.bin" for bucket in range(n_buckets)]
+    buffers = [[] for _ in range(n_buckets)]
+    buffered = 0
+
+    def flush():
+        for bucket, buffer in enumerate(buffers):
+            if buffer:
+                with open(bucket_paths[bucket], "ab") as bucket_file:
+                    bucket_file.write(b"".join(buffer))
+                buffer.clear()
+
+    for site, in_file in enumerate(in_files):
+        records_before = 0
+        for block_counts, n_records in fastx_index.map_blocks(first_counts_block, in_file, n_jobs, block_bytes):
+            for key, count, first in block_counts:
+                record = count_record.pack(site, count, records_before + first, len(key)) + key
+                buffers[bucket_of(key, n_buckets)].append(record)
+                buffered += len(record)
+            records_before += n_records
+
+            # Buffered records cost several times their bytes as python objects
+            if buffered * 4 > memory_budget_mb * 1e6:
+                flush()
+                buffered = 0
+
+    flush()
+    return bucket_paths
+
+
+def read_records(path:str, record:struct.Struct, read_size:int=1 << 20):
+    """
+    Stream (fields..., key) tuples from a bucket or run file.
+    """
+
+    with open(path, "rb") as file:
+        data = b""
+        for block in iter(lambda: file.read(read_size), b""):
+            data += block
+            position = 0
+            while position + record.size <= len(data):
+                fields = record.unpack_from(data, position)
+                end = position + record.size + fields[-1]
+                if end > len(data):
+                    break
+                yield fields[0:-1] + (data[position + record.size:end],)
+                position = end
+            data = data[position:]
+
+
+def sort_bucket(bucket_path:str, run_path:str, min_seq_count:int, min_site_occurance:int, column_start:int=0,
+                writer:abundance.matrix_writer=None) -> int:
+    """
+    Pass 2: count one bucket, apply the keep rule and write its entries as a sorted run.
+
+    Outputs:
+        - Number of matrix columns (sequences kept at one site or more) the bucket takes, numbered
+            from column_start. Their keys go to the writer if given.
+    """
+
+    # key -> site -> [count, first seen]
+    table = {}
+    for site, count, first, key in read_records(bucket_path, count_record):
+        site_counts = table.setdefault(key, {})
+        if site in site_counts:
+            site_counts[site][0] += count
+            site_counts[site][1] = min(site_counts[site][1], first)
+        else:
+            site_counts[site] = [count, first]
+
+    entries = []
+    column_keys = []
+    for key, site_counts in table.items():
+        site_occurances = sum(1 for count, _ in site_counts.values() if count < min_seq_count)
+        column = column_start + len(column_keys)
+        kept_anywhere = False
+        for site, (count, first) in site_counts.items():
+            keep = site_occurances >= min_site_occurance or count >= min_seq_count
+            kept_anywhere = kept_anywhere or keep
+            entries.append((site, -count, first, keep, site_occurances, column, key))
+        if kept_anywhere:
+            column_keys.append(key)
+
+    entries.sort()
+
+    with open(run_path, "wb") as run_file:
+        run_file.write(b"".join(run_record.pack(site, -count, first, keep, site_occurances, column, len(key)) + key
+                                for site, count, first, keep, site_occurances, column, key in entries))
+
+    if writer is not None:
+        writer.add_sequences(np.arange(column_start, column_start + len(column_keys)), column_keys)
+
+    return len(column_keys)
+
+
+def merge_runs(run_paths:list, sites:list, out_dir:str, log_path:str, min_seq_count:int, memory_budget_mb:float,
+               writer:abundance.matrix_writer=None, batch_size:int=10000):
+    """
+    Pass 3: merge the sorted runs and write each site's fasta and log lines, and each site's matrix row
+    to the writer if given.
+    """
+
+    # Every run is read at the same time, their read buffers share a quarter of the budget
+    read_size = int(min(max(memory_budget_mb * 1e6 / 4 / max(1, len(run_paths)), 1 << 14), 1 << 20))
+
+    runs = [((site, -count, first, keep, site_occurances, column, key)
+             for site, count, first, keep, site_occurances, column, key in read_records(path, run_record, read_size))
+            for path in run_paths if os.path.exists(path)]
+
+    with open(log_path, "a") as log_file:
+        current = None
+        out_file = None
+        kept = []
+        dropped = []
+        i = 1
+        row_columns = []
+        row_counts = []
+
+        def write_rows(up_to:int):
+            # Matrix rows of every site before up_to, sites without entries get empty rows
+            for site in range(len(writer.sites), up_to):
+                writer.add_site(sites[site], row_columns if site == current else [], row_counts if site == current else [])
+            row_columns.clear()
+            row_counts.clear()
+
+        def write_batch():
+            nonlocal i
+            for seq, count in zip(seqpack.decode_many([key for key, _ in kept]), [count for _, count in kept]):
+                out_file.write(b">id=%s_%d;size=%d;\n%s\n" % (sites[current].encode(), i, count, seq))
+                i += 1
+            for seq, site_occurances in zip(seqpack.decode_many([key for key, _ in dropped]), [occurances for _, occurances in dropped]):
+                log_file.write(f"{seq.decode()}\n occured less than {min_seq_count} times at {sites[current]} and present at {site_occurances - 1} other sites.\n")
+            kept.clear()
+            dropped.clear()
+
+        for site, negative_count, _, keep, site_occurances, column, key in heapq.merge(*runs):
+            if site != current:
+                if out_file is not None:
+                    write_batch()
+                    out_file.close()
+                if writer is not None:
+                    write_rows(site)
+                current = site
+                out_file = open(f"{out_dir}/{sites[site]}.fasta", "wb")
+                i = 1
+
+            if keep:
+                kept.append((key, -negative_count))
+                if writer is not None:
+                    row_columns.append(column)
+                    row_counts.append(-negative_count)
+            else:
+                dropped.append((key, site_occurances))
+
+            if len(kept) + len(dropped) >= batch_size:
+                write_batch()
+
+        if out_file is not None:
+            write_batch()
+            out_file.close()
+        if writer is not None:
+            write_rows(len(sites))
+
+    # Sites with nothing left still get their (empty) fasta, like the in-memory path
+    for site in sites:
+        if not os.path.exists(f"{out_dir}/{site}.fasta"):
+            open(f"{out_dir}/{site}.fasta", "wb").close()
+
+
+def spill_frequency_filter(in_files:list, sites:list, out_dir:str, log_path:str, min_seq_count:int, min_site_occurance:int,
+                           memory_budget_mb:float, n_jobs:int=1, matrix_path:str=None):
+    """
+    Frequency filter with peak memory set by memory_budget_mb rather than the data, see the top of the module.
+    Writes the same fasta files and log as the in-memory path of pipeline.frequency_filter, and the
+    abundance matrix to matrix_path if given (its columns in bucket order).
+    """
+
+    spill_dir = f"{out_dir}/spill"
+    os.makedirs(spill_dir, exist_ok=True)
+
+    n_buckets = bucket_count(in_files, memory_budget_mb)
+    bucket_paths = write_buckets(in_files, spill_dir, n_buckets, memory_budget_mb, n_jobs)
+
+    writer = abundance.matrix_writer(matrix_path) if matrix_path is not None else None
+
+    run_paths = []
+    columns = 0
+    for bucket, bucket_path in enumerate(bucket_paths):
+        if os.path.exists(bucket_path):
+            run_paths.append(f"{spill_dir}/run_{bucket}.bin")
+            columns += sort_bucket(bucket_path, run_paths[-1], min_seq_count, min_site_occurance, columns, writer)
+            os.remove(bucket_path)
+
+    merge_runs(run_paths, sites, out_dir, log_path, min_seq_count, memory_budget_mb, writer)
+
+    if writer is not None:
+        writer.close()
+
+    for run_path in run_paths:
+        os.remove(run_path)
+    os.rmdir(spill_dir)
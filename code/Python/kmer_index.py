@@ -0,0 +1,102 @@
+from bisect import bisect_left
+import numpy as np
+
+# Pigeonhole index for finding the sequences within d mismatches of a query without comparing
+# it with all of them (unoise.unoise and dnoise.dnoise, for their candidate parents).
+#
+# Sequences of one length are cut into d + 1 blocks. Two sequences at most d mismatches apart
+# can't have a mismatch in every block, so they share at least one block exactly. One hash table
+# per block (block letters -> sequences added with them) then gives every sequence within d of a
+# query, plus a few more that share a block but are further away, which the caller's exact
+# distances drop. Blocks are letters, not 2-bit codes, so ambiguous sequences are found like any other.
+
+# Shorter blocks are shared by too many unrelated sequences to narrow anything down
+min_block_length = 12
+
+
+def index_distance(length:int, max_distance:float) -> int:
+    """
+    The largest distance worth indexing for sequences of this length: max_distance, or less if
+    the blocks would get shorter than min_block_length.
+    """
+    return int(max(0, min(max_distance, length // min_block_length - 1)))
+
+
+class pigeonhole_index():
+    """
+    Sequences (rows of a letters array) added over time, numbered in the order they are added,
+    and looked up by query rows.
+    """
+
+    def __init__(self, letters:np.ndarray, max_distance:int):
+        """
+        Inputs:
+            - letters: uint8 array (sequences, length) of every sequence that may be added or queried.
+            - max_distance: every added sequence within this many mismatches of a query is found.
+        """
+
+        self.letters = letters
+        self.max_distance = max_distance
+        self.bounds = np.linspace(0, letters.shape[1], max_distance + 2).round().astype(int)
+        self.tables = [{} for _ in range(max_distance + 1)]
+        self.size = 0
+
+    def block_keys(self, rows:np.ndarray) -> list:
+        # Each block's letters as one bytes key per row
+        return [np.ascontiguousarray(self.letters[rows, start:end]).view(f"V{end - start}").ravel().tolist()
+                for start, end in zip(self.bounds[0:-1], self.bounds[1:])]
+
+    def add(self, rows:np.ndarray):
+        """
+        Add sequences, numbered from the current size on.
+        """
+
+        for table, keys in zip(self.tables, self.block_keys(rows)):
+            for position, key in enumerate(keys, start=self.size):
+                table.setdefault(key, []).append(position)
+        self.size += len(rows)
+
+    def candidates(self, rows:np.ndarray, limit:int=None, max_pairs:int=None) -> tuple:
+        """
+        Added sequences sharing a block with each query.
+
+        Inputs:
+            - rows: query rows.
+            - limit: only sequences numbered below this.
+            - max_pairs: give up (return None) past this many pairs, when comparing with
+                    everything is cheaper.
+
+        Outputs:
+            - Query index (into rows) and number of every candidate pair, each pair once,
+                sorted by query then number.
+        """
+
+        limit = self.size if limit is None else limit
+
+        # Numbers are added in order, so the ones below limit start each list
+        found = []
+        for table, keys in zip(self.tables, self.block_keys(rows)):
+            table_found = []
+            for i, key in enumerate(keys):
+                numbers = table.get(key)
+                if numbers and numbers[0] < limit:
+                    table_found.append((i, numbers if numbers[-1] < limit else numbers[:bisect_left(numbers, limit)]))
+            found.append(table_found)
+
+        # Count before collecting, giving up then costs no more than the lookups
+        if max_pairs is not None and sum(len(numbers) for table_found in found for i, numbers in table_found) > max_pairs * len(self.tables):
+            return None
+
+        query_index = []
+        positions = []
+        for table_found in found:
+            for i, numbers in table_found:
+                query_index += [i] * len(numbers)
+                positions += numbers
+
+        pairs = np.unique(np.array(query_index, dtype=np.int64) * max(1, self.size) + np.array(positions, dtype=np.int64))
+        query_index, positions = np.divmod(pairs, max(1, self.size))
+
+        if max_pairs is not None and len(pairs) > max_pairs:
+            return None
+        return query_index, positions
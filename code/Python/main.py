@@ -1,18 +1,47 @@
-import pipeline
+import os
+import dag, runner
 
 path_to_data = "../../data/test_data"
 
-pipeline.merge_pairs(data_dir=path_to_data)
+# Core budget shared between concurrent samples and the tools' own threads
+cores = os.cpu_count()
 
-pipeline.trim_primers(data_dir=path_to_data)
+# Skip samples whose inputs and arguments haven't changed since the last run
+cache = True
 
-pipeline.quality_filter(data_dir=path_to_data)
+# Kill any tool call still running after 6 hours and give failed samples one more try
+runner.default_timeout = 6 * 3600
+runner.default_retries = 1
 
-pipeline.length_filter(data_dir=path_to_data, amplicon_length=142)
+# Each sample moves through merge -> trim -> quality -> length -> chimera on its own,
+# frequency_filter waits for all sites. Timings and the critical path go to dag_timings.jsonl.
+dag.run_pipeline_dag(data_dir=path_to_data,
+                     amplicon_length=142,
+                     min_seq_count=3,
+                     min_site_occurance=3,
+                     cores=cores,
+                     cache=cache,
+                     compress=None, # ".gz" or ".zst" to keep the intermediates compressed
+                     dereplicate=False) # True to collapse reads to unique sequences after the length filter
 
-pipeline.chimera_filter(data_dir=path_to_data)
+# Stage at a time instead (every sample finishes a stage before the next one starts, needs import pipeline):
+#pipeline.merge_pairs(data_dir=path_to_data, cores=cores, cache=cache)
 
-pipeline.frequency_filter(data_dir=path_to_data, min_seq_count=3, min_site_occurance=3)
+#pipeline.trim_primers(data_dir=path_to_data, cores=cores, cache=cache)
+
+#pipeline.quality_filter(data_dir=path_to_data, cores=cores, cache=cache)
+
+# Or quality and length filter in one numpy pass, without vsearch (replaces length_filter too):
+#pipeline.native_quality_filter(data_dir=path_to_data, amplicon_length=142, n_jobs=cores, cache=cache)
+
+# Or stream merge -> trim -> quality filter through pipes without the intermediate files:
+#pipeline.preprocess(data_dir=path_to_data, cores=cores, cache=cache)
+
+#pipeline.length_filter(data_dir=path_to_data, amplicon_length=142, cache=cache, n_jobs=cores)
+
+#pipeline.chimera_filter(data_dir=path_to_data, cores=cores, cache=cache)
+
+#pipeline.frequency_filter(data_dir=path_to_data, min_seq_count=3, min_site_occurance=3, cache=cache, n_jobs=cores)
 
 #translation_filter()
 
@@ -0,0 +1,138 @@
+import os, sys, json, time, resource
+import fastx
+
+# One json line per sample and stage, in {stage_dir}/metrics.jsonl:
+#   stage, sample, status, wall_s, cpu_s, max_rss_mb, bytes_read, bytes_written, reads_in, reads_out
+# For tool stages cpu_s and max_rss_mb are the child process's (summed cpu and largest peak
+# for piped calls). For in-process stages cpu_s is the calling thread's cpu time plus that of
+# the worker processes it split the work between, and max_rss_mb the peak of the whole python
+# process so far.
+
+metrics_file_name = "metrics.jsonl"
+
+
+def count_reads(path:str) -> int:
+    """
+    Count the records in a fastq (4 lines per record) or fasta (">" headers) file, plain or compressed.
+    Reads in big binary blocks, so it is cheap next to the tool that wrote the file.
+    """
+
+    if not os.path.isfile(path):
+        return 0
+
+    fastq = ".fastq" in path or ".fq" in path
+    target = b"\n" if fastq else b">"
+
+    count = 0
+    last = b"\n"
+    try:
+        with fastx.open_fastx(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 22), b""):
+                count += block.count(target)
+                last = block[-1:]
+    except (OSError, EOFError):
+        # Unreadable (e.g. truncated by a failed step), the step's status already says so
+        return 0
+
+    # A fastq missing its final newline still has a complete last record
+    if fastq:
+        if last != b"\n":
+            count += 1
+        return count // 4
+
+    return count
+
+
+def file_stats(inputs:list, outputs:list) -> dict:
+    """
+    Bytes and reads going into and out of a step.
+    Reads are counted over every input (R2 files are skipped, their pairs are already counted in R1)
+    and over the first output (the others are copies such as kept intermediates).
+    """
+
+    return {"bytes_read": sum(os.path.getsize(path) for path in inputs if os.path.isfile(path)),
+            "bytes_written": sum(os.path.getsize(path) for path in outputs if os.path.isfile(path)),
+            "reads_in": sum(count_reads(path) for path in inputs if "_R2." not in os.path.basename(path)),
+            "reads_out": count_reads(outputs[0]) if outputs else 0}
+
+
+def record(stage_dir:str, entry:dict):
+    """
+    Append one metrics record to the stage's metrics file.
+    """
+
+    os.makedirs(stage_dir, exist_ok=True)
+    with open(f"{stage_dir}/{metrics_file_name}", "a") as metrics_file:
+        metrics_file.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), **entry}) + "\n")
+
+
+def children_cpu() -> float:
+    """
+    CPU seconds (user + system) of this process's finished child processes, e.g. the workers of
+    a ProcessPoolExecutor once it has shut down.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def record_step(stage:str, stage_dir:str, sample:str, success:bool, usage:dict, inputs:list, outputs:list):
+    """
+    Record one sample's step: usage from the runner (wall_s, cpu_s, max_rss_mb) plus file stats.
+    """
+
+    record(stage_dir, {"stage": stage,
+                       "sample": sample,
+                       "status": "done" if success else "failed",
+                       **{key: round(value, 3) for key, value in usage.items()},
+                       **file_stats(inputs, outputs)})
+
+
+def load(data_dir:str) -> list:
+    """
+    Read every metrics record found under the data directory.
+    """
+
+    entries = []
+    for root, _, files in os.walk(data_dir):
+        if metrics_file_name in files:
+            with open(f"{root}/{metrics_file_name}") as metrics_file:
+                entries += [json.loads(line) for line in metrics_file if line.strip()]
+    return entries
+
+
+def summarize(data_dir:str, top:int=10):
+    """
+    Print the stages ranked by total wall time and the slowest single sample steps.
+
+    Inputs:
+        - data_dir: data directory the pipeline ran in.
+        - top: number of slowest sample steps to list.
+    """
+
+    entries = load(data_dir)
+    if not entries:
+        print(f"No {metrics_file_name} found under {data_dir}.")
+        return
+
+    stages = {}
+    for entry in entries:
+        stage = stages.setdefault(entry["stage"], {"wall_s": 0, "cpu_s": 0, "max_rss_mb": 0, "reads_in": 0, "samples": 0})
+        stage["wall_s"] += entry["wall_s"]
+        stage["cpu_s"] += entry["cpu_s"]
+        stage["max_rss_mb"] = max(stage["max_rss_mb"], entry["max_rss_mb"])
+        stage["reads_in"] += entry["reads_in"]
+        stage["samples"] += 1
+
+    print(f"\n{'stage':<20}{'samples':>8}{'wall (s)':>12}{'cpu (s)':>12}{'peak MB':>10}{'reads/s':>12}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]["wall_s"]):
+        reads_per_s = stage["reads_in"] / stage["wall_s"] if stage["wall_s"] else 0
+        print(f"{name:<20}{stage['samples']:>8}{stage['wall_s']:>12.1f}{stage['cpu_s']:>12.1f}{stage['max_rss_mb']:>10.0f}{reads_per_s:>12.0f}")
+
+    print(f"\nSlowest {top} sample steps:")
+    for entry in sorted(entries, key=lambda entry: -entry["wall_s"])[:top]:
+        print(f"    {entry['stage']:<20}{entry['sample']:<30}{entry['wall_s']:>10.1f} s  {entry['reads_in']} reads in, {entry['reads_out']} out")
+
+
+if __name__ == "__main__":
+    # python metrics.py path/to/data_dir
+    summarize(sys.argv[1] if len(sys.argv) > 1 else "../../data/test_data")
@@ -1,16 +1,94 @@
-import os, re, subprocess, shutil
-from itertools import pairwise
+import os, re, shutil, time, resource
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from collections import Counter
+import numpy as np
+import runner, scheduler, stage_cache, metrics, fastx, fastx_index, quality, seqpack, freq_spill, registry, abundance, unoise, dnoise, sweep, pooled
 
 
 ###### MERGE ######
-def merge_pairs(data_dir:str, vsearch_args:list=["99", "16", "25", "--fastq_allowmergestagger"]):
+def get_sample_names(data_dir:str) -> set:
+    """
+    Get the sample names of the paired raw reads in the input subfolder of the data directory.
+
+    Input:
+        - data_dir: string providing the path to the data directory.
+
+    Output:
+        - Set of sample names (file names with the _R1.fastq/_R2.fastq suffix stripped).
+            Reads can be plain or compressed (.fastq.gz, .fastq.zst).
+    """
+
+    data_files = os.listdir(f"{data_dir}/input")
+
+    # get file names of forward and reverse reads, strip suffix
+    fwd_files = [fname for fname in data_files if re.search(pattern = r"_R1\.fastq(\.gz|\.zst)?$", string = fname)]
+    rvs_files = [fname for fname in data_files if re.search(pattern = r"_R2\.fastq(\.gz|\.zst)?$", string = fname)]
+
+    # Check that all reads are paired 
+    fwd_bare_names = set([fastx.sample_name(name, "_R1.fastq") for name in fwd_files])
+    rvs_bare_names = set([fastx.sample_name(name, "_R2.fastq") for name in rvs_files])
+
+    if fwd_bare_names != rvs_bare_names:
+        print("Not all reads are paired!")
+        exit()
+
+    return fwd_bare_names
+
+
+def merge_job(data_dir:str, name:str, vsearch_args:list, threads:list=[], compress:str=None) -> dict:
+    """
+    Job (see runner.run_jobs) merging the paired reads of one sample. See merge_pairs for the arguments.
+    """
+
+    fwd_reads = fastx.find(f"{data_dir}/input", f"{name}_R1.fastq")
+    rvs_reads = fastx.find(f"{data_dir}/input", f"{name}_R2.fastq")
+    out_path = f"{data_dir}/merged/{name}_merged.fastq{compress or ''}"
+
+    # vsearch reads gz itself, other compressions are decompressed into a named pipe,
+    # the pipes get the call's share of the core budget
+    pipe_threads = scheduler.thread_count(threads)
+    fwd_input, fwd_feed = fastx.tool_input(fwd_reads, "vsearch", f"{data_dir}/merged", pipe_threads)
+    rvs_input, rvs_feed = fastx.tool_input(rvs_reads, "vsearch", f"{data_dir}/merged", pipe_threads)
+
+    vsearch_merge_call = ["vsearch", 
+                            "--fastq_mergepairs", fwd_input, 
+                            "--reverse", rvs_input, 
+                            "--fastqout", fastx.tool_output(out_path),
+                            "--fastq_maxdiffs", f"{vsearch_args[0]}", 
+                            "--fastq_minovlen", f"{vsearch_args[1]}",
+                            "--fastq_maxdiffpct", f"{vsearch_args[2]}",
+                            f"{vsearch_args[3]}"]
+
+    return {**fastx.tool_job(vsearch_merge_call + threads, out_path, [fwd_feed, rvs_feed], pipe_threads),
+            "log": f"{data_dir}/merged/merge_logs/{name}.log",
+            "name": name,
+            "message": f"Merged {name} successfully.",
+            "stage": "merge_pairs",
+            "stage_dir": f"{data_dir}/merged",
+            "sample": name,
+            "inputs": [fwd_reads, rvs_reads],
+            "outputs": [out_path],
+            "args": vsearch_merge_call,
+            "tools": ["vsearch"]}
+
+
+def merge_pairs(data_dir:str, vsearch_args:list=["99", "16", "25", "--fastq_allowmergestagger"], n_jobs:int=1, cores:int=None, cache:bool=False, compress:str=None):
     """
     Merges paired fastq reads using the vsearch algorithm.
 
     Input:
 
         - data_dir: string providing the path to the data directory with raw input fastq files.
+        - n_jobs: maximum number of samples merged at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and the vsearch --threads
+                for each call, and records the split in data_dir/schedule.jsonl.
+        - cache: keep the merged folder and skip samples whose inputs, vsearch arguments and
+                vsearch version haven't changed since they were last merged (see stage_cache.py).
+        - compress: write the merged reads compressed, ".gz" or ".zst" (plain fastq if None).
+                Raw reads can be plain, .gz or .zst, and every later stage finds its input in whichever
+                compression is on disk, so compress only sets each stage's output.
 
     vsearch arguments:
 
@@ -33,74 +111,53 @@ def merge_pairs(data_dir:str, vsearch_args:list=["99", "16", "25", "--fastq_allo
         print(f"merge_pairs vsearch_args must be list of length 4, {len(vsearch_args)} were provided. Exiting.")
         exit()
 
-    data_files = os.listdir(f"{data_dir}/input")
-
-    fastq_suffix = "_RX.fastq"
-
-    # get file names of forward and reverse reads, strip suffix
-    fwd_files = [fname for fname in data_files if re.search(pattern = "_R1.fastq", string = fname)]
-    rvs_files = [fname for fname in data_files if re.search(pattern = "_R2.fastq", string = fname)]
-
-    # Check that all reads are paired 
-    fwd_bare_names = set([name[0:-len(fastq_suffix)] for name in fwd_files])
-    rvs_bare_names = set([name[0:-len(fastq_suffix)] for name in rvs_files])
+    fwd_bare_names = get_sample_names(data_dir)
 
-    if fwd_bare_names != rvs_bare_names:
-        print("Not all reads are paired!")
-        exit()
-
-    # Remove old directory and files
-    if "merged" in os.listdir(data_dir):
+    # Remove old directory and files (only outputs of removed samples when caching)
+    if not cache and "merged" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/merged/")
 
     # make output directory for merged files
-    os.makedirs(f"{data_dir}/merged/")
+    os.makedirs(f"{data_dir}/merged/", exist_ok=True)
 
     #Make output directory for logs
-    if "logs" not in os.listdir(f"{data_dir}/merged/"):
-        os.makedirs(f"{data_dir}/merged/merge_logs/") 
+    os.makedirs(f"{data_dir}/merged/merge_logs/", exist_ok=True)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/merged", fwd_bare_names)
+
+    # Split the core budget between samples and vsearch threads
+    n_jobs, threads = scheduler.schedule("merge_pairs",
+                                         [fastx.find(f"{data_dir}/input", f"{name}_R1.fastq") for name in fwd_bare_names],
+                                         cores, n_jobs, f"{data_dir}/schedule.jsonl")
 
     # Use VSEARCH fastq_mergepairs function
+    jobs = []
     for name in fwd_bare_names:
+        job = merge_job(data_dir, name, vsearch_args, threads, compress)
 
-        vsearch_merge_call = ["vsearch", 
-                                "--fastq_mergepairs", f"{data_dir}/{name}_R1.fastq", 
-                                "--reverse", f"{data_dir}/{name}_R2.fastq", 
-                                "--fastqout", f"{data_dir}/merged/{name}_merged.fastq",
-                                "--fastq_maxdiffs", f"{vsearch_args[0]}", 
-                                "--fastq_minovlen", f"{vsearch_args[1]}",
-                                "--fastq_maxdiffpct", f"{vsearch_args[2]}",
-                                f"{vsearch_args[3]}"]
+        if cache and stage_cache.check_job(job):
+            continue
 
-        with open(f"{data_dir}/merged/merge_logs/{name}.log", "a") as log:
-            try:
-                subprocess.run(vsearch_merge_call, stdout=log, stderr=log, check=True)
-                print(f"\nMerged {name} successfully.\n")
-            except subprocess.CalledProcessError as e:
-                print(f"\nError processing {name}: {e}\n")
+        jobs.append(job)
+
+    results = runner.run_jobs(jobs, n_jobs)
+    stage_cache.record_jobs(jobs, results)
 
 
 ###### TRIM ######
-def trim_primers(data_dir: str, primer_option:int=1):
+def primer_args(primer_option:int=1) -> list:
     """
+    cutadapt primer arguments for a primer set (see trim_primers for details).
+
     Inputs:
-        - data_dir: String specifying data directory
         - primer_option: Integer specifying the primer set to use
             - 1 = invertebrate COI
             - Anything else: not supported yet
-        
-    cutadapt arguments:
-        - [0] -g: The 5' primer sequence. I anchor the fwd primer with ^
-        - [1] -a: The 3' primer sequence. Not anchored
-        - [2] --discard_untrimmed: Get rid of sequences with no matching primer
-        - [3] -n: Number of times to repeat. Cutadapt only removes one primer at a time.
-            Repeat twice to remove fwd and rvs primers.
-        - [4] -o: output file
-        - [5] --error-rate: What fraction of bases can not match the primer sequence.
-                        Set to 0.1 in line with JAMP.
-    
+
     Outputs:
-        - Trimmed sequences output in sub-folder of data directory in fastq format.
+        - List of cutadapt arguments: the anchored 5' primers (-g), the reverse complemented
+            3' primers (-a), --discard-untrimmed, -n 2 and --error-rate 0.1
     """
 
     # Complementary base pairings for making the reverse complement of a primer sequence.
@@ -115,8 +172,6 @@ def trim_primers(data_dir: str, primer_option:int=1):
                   "W":"W",
                   "D":"H",
                   "H":"D"} 
-    
-    merged_suffix = "_merged.fastq"
 
     # default primer option uses the EPTDr2n COI primer set.
     # Check with Jared about which are necessary (seems like only main primers required for filtering)
@@ -139,52 +194,149 @@ def trim_primers(data_dir: str, primer_option:int=1):
         rv_comp_2 = "".join(complement.get(base, base) for base in reversed(rvs_primer_2))
         rv_comp_3 = "".join(complement.get(base, base) for base in reversed(rvs_primer_3))
         rv_comp_4 = "".join(complement.get(base, base) for base in reversed(rvs_primer_4))
+
+    return ["-g", f"^{fwd_main}", 
+            "-g", f"^{fwd_primer_1}", 
+            "-g", f"^{fwd_primer_2}", 
+            "-g", f"^{fwd_primer_3}", 
+            "-g", f"^{fwd_primer_4}", 
+            "-a", f"{rv_comp_main}",
+            "-a", f"{rv_comp_1}", 
+            "-a", f"{rv_comp_2}", 
+            "-a", f"{rv_comp_3}", 
+            "-a", f"{rv_comp_4}", 
+            "--discard-untrimmed",
+            "-n", "2",
+            "--error-rate", "0.1"]
+
+
+def trim_job(data_dir:str, name:str, primer_option:int=1, threads:list=[], compress:str=None) -> dict:
+    """
+    Job (see runner.run_jobs) trimming the primers of one merged sample. See trim_primers for the arguments.
+    cutadapt reads and writes gz/zst itself (by file extension), using more cores with -j.
+    """
+
+    in_path = fastx.find(f"{data_dir}/merged", f"{name}_merged.fastq", compress or "")
+    out_path = f"{data_dir}/trimmed/{name}_trimmed.fastq{compress or ''}"
+
+    cutadapt_call = ["cutadapt"] + primer_args(primer_option) + [
+                     "-o", out_path,
+                     in_path]
+
+    return {"call": cutadapt_call[:-1] + threads + cutadapt_call[-1:],
+            "log": f"{data_dir}/trimmed/logs/{name}.log",
+            "name": f"{name}_merged.fastq",
+            "message": f"Trimmed {name}_merged.fastq successfully.",
+            "stage": "trim_primers",
+            "stage_dir": f"{data_dir}/trimmed",
+            "sample": name,
+            "inputs": [in_path],
+            "outputs": [out_path],
+            "args": cutadapt_call,
+            "tools": ["cutadapt"]}
+
+
+def trim_primers(data_dir: str, primer_option:int=1, n_jobs:int=1, cores:int=None, cache:bool=False, compress:str=None):
+    """
+    Inputs:
+        - data_dir: String specifying data directory
+        - primer_option: Integer specifying the primer set to use
+            - 1 = invertebrate COI
+            - Anything else: not supported yet
+        - n_jobs: maximum number of samples trimmed at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and cutadapt -j.
+        - cache: skip samples whose merged input, primers and cutadapt version haven't changed.
+        - compress: write the trimmed reads compressed, ".gz" or ".zst" (see merge_pairs).
+        
+    cutadapt arguments:
+        - [0] -g: The 5' primer sequence. I anchor the fwd primer with ^
+        - [1] -a: The 3' primer sequence. Not anchored
+        - [2] --discard_untrimmed: Get rid of sequences with no matching primer
+        - [3] -n: Number of times to repeat. Cutadapt only removes one primer at a time.
+            Repeat twice to remove fwd and rvs primers.
+        - [4] -o: output file
+        - [5] --error-rate: What fraction of bases can not match the primer sequence.
+                        Set to 0.1 in line with JAMP.
     
-    # Remove old directory and files
-    if "trimmed" in os.listdir(data_dir):
+    Outputs:
+        - Trimmed sequences output in sub-folder of data directory in fastq format.
+    """
+
+    merged_suffix = "_merged.fastq"
+
+    # Remove old directory and files (only outputs of removed samples when caching)
+    if not cache and "trimmed" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/trimmed/")
 
     # make output directory for trimmed files
-    os.makedirs(f"{data_dir}/trimmed/")
+    os.makedirs(f"{data_dir}/trimmed/", exist_ok=True)
 
     # make log subdirectory
-    os.makedirs(f"{data_dir}/trimmed/logs")
+    os.makedirs(f"{data_dir}/trimmed/logs", exist_ok=True)
+
+    names = fastx.sample_names(f"{data_dir}/merged", merged_suffix)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/trimmed", names)
+
+    # Split the core budget between samples and cutadapt cores
+    n_jobs, threads = scheduler.schedule("trim_primers",
+                                         [fastx.find(f"{data_dir}/merged", f"{name}{merged_suffix}", compress or "") for name in names],
+                                         cores, n_jobs, f"{data_dir}/schedule.jsonl")
 
     # cutadapt call to trim files in the "merged" subdirectory
-    for file in os.listdir(f"{data_dir}/merged/"):
-        if ".fastq" in file:
-            cutadapt_call = ["cutadapt", 
-                         "-g", f"^{fwd_main}", 
-                         "-g", f"^{fwd_primer_1}", 
-                         "-g", f"^{fwd_primer_2}", 
-                         "-g", f"^{fwd_primer_3}", 
-                         "-g", f"^{fwd_primer_4}", 
-                         "-a", f"{rv_comp_main}",
-                         "-a", f"{rv_comp_1}", 
-                         "-a", f"{rv_comp_2}", 
-                         "-a", f"{rv_comp_3}", 
-                         "-a", f"{rv_comp_4}", 
-                         "--discard-untrimmed",
-                         "-n", "2",
-                         "-o", f"{data_dir}/trimmed/{file[0:-len(merged_suffix)]}_trimmed.fastq", 
-                         "--error-rate", "0.1",
-                         f"{data_dir}/merged/{file}"]
-        
-            with open(f"{data_dir}/trimmed/logs/{file[0:-len(merged_suffix)]}.log", "a") as log:
-                try:
-                    subprocess.run(cutadapt_call, stdout=log, stderr=log, check=True)
-                    print(f"\nTrimmed {file} successfully.\n")
-                except subprocess.CalledProcessError as e:
-                    print(f"\nError processing {file}: {e}\n")
+    jobs = []
+    for name in names:
+        job = trim_job(data_dir, name, primer_option, threads, compress)
+
+        if cache and stage_cache.check_job(job):
+            continue
+
+        jobs.append(job)
+
+    results = runner.run_jobs(jobs, n_jobs)
+    stage_cache.record_jobs(jobs, results)
 
 
 ###### QUAL. FILTER ######
-def quality_filter(data_dir:str, vsearch_args:list=[1, 0]):
+def quality_job(data_dir:str, name:str, vsearch_args:list, threads:list=[], compress:str=None) -> dict:
+    """
+    Job (see runner.run_jobs) quality filtering one trimmed sample. See quality_filter for the arguments.
+    """
+
+    in_path = fastx.find(f"{data_dir}/trimmed", f"{name}_trimmed.fastq", compress or "")
+    out_path = f"{data_dir}/quality_filtered/{name}.fastq{compress or ''}"
+    tool_input, feed = fastx.tool_input(in_path, "vsearch", f"{data_dir}/quality_filtered", scheduler.thread_count(threads))
+
+    vsearch_ee_filter_call = ["vsearch",
+                              "--fastx_filter", tool_input,
+                              "--fastqout", fastx.tool_output(out_path),
+                              "--fastq_maxee", f"{vsearch_args[0]}",
+                              "--fastq_maxns", f"{vsearch_args[1]}"]
+
+    return {**fastx.tool_job(vsearch_ee_filter_call + threads, out_path, [feed], scheduler.thread_count(threads)),
+            "log": f"{data_dir}/quality_filtered/logs/{name}.log",
+            "name": f"{name}_trimmed.fastq",
+            "message": f"Quality filtered {name}_trimmed.fastq successfully.",
+            "stage": "quality_filter",
+            "stage_dir": f"{data_dir}/quality_filtered",
+            "sample": name,
+            "inputs": [in_path],
+            "outputs": [out_path],
+            "args": vsearch_ee_filter_call,
+            "tools": ["vsearch"]}
+
+
+def quality_filter(data_dir:str, vsearch_args:list=[1, 0], n_jobs:int=1, cores:int=None, cache:bool=False, compress:str=None):
     """
     Filter fastq filters that have already been trimmed.
 
     Input:
         - data_dir: String with main data directory
+        - n_jobs: maximum number of samples filtered at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and the vsearch --threads.
+        - cache: skip samples whose trimmed input, vsearch arguments and vsearch version haven't changed.
+        - compress: write the filtered reads compressed, ".gz" or ".zst" (see merge_pairs).
 
     vsearch_args:
         - [0] --fastq_maxee: Max expected cummulative error.
@@ -202,91 +354,500 @@ def quality_filter(data_dir:str, vsearch_args:list=[1, 0]):
 
     trimmed_suffix = "_trimmed.fastq"
 
-    # Remove old directory and files 
-    if "quality_filtered" in os.listdir(data_dir):
+    # Remove old directory and files (only outputs of removed samples when caching)
+    if not cache and "quality_filtered" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/quality_filtered/")
 
     # Make directory for quality filtered reads
-    os.makedirs(f"{data_dir}/quality_filtered/")
+    os.makedirs(f"{data_dir}/quality_filtered/", exist_ok=True)
 
     # Make subdirectory for logs
-    os.makedirs(f"{data_dir}/quality_filtered/logs/")
+    os.makedirs(f"{data_dir}/quality_filtered/logs/", exist_ok=True)
+
+    names = fastx.sample_names(f"{data_dir}/trimmed", trimmed_suffix)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/quality_filtered", names)
 
-    for file in os.listdir(f"{data_dir}/trimmed/"):
+    # Split the core budget between samples and vsearch threads
+    n_jobs, threads = scheduler.schedule("quality_filter",
+                                         [fastx.find(f"{data_dir}/trimmed", f"{name}{trimmed_suffix}", compress or "") for name in names],
+                                         cores, n_jobs, f"{data_dir}/schedule.jsonl")
+
+    jobs = []
+    for name in names:
         # vsearch call for fastq filtering. See function description for arguments
-        if ".fastq" in file:
-            vsearch_ee_filter_call = ["vsearch",
-                                      "--fastx_filter", f"{data_dir}/trimmed/{file}",
-                                      "--fastqout", f"{data_dir}/quality_filtered/{file[0:-len(trimmed_suffix)]}.fastq",
-                                      "--fastq_maxee", f"{vsearch_args[0]}",
-                                      "--fastq_maxns", f"{vsearch_args[1]}"]
-        
-            with open(f"{data_dir}/quality_filtered/logs/{file[0:-len(trimmed_suffix)]}.log", "a") as log:
-                try:
-                    subprocess.run(vsearch_ee_filter_call, stdout=log, stderr=log, check=True)
-                    print(f"\nQuality filtered {file} successfully.\n")
-                except subprocess.CalledProcessError as e:
-                    print(f"\nError processing {file}: {e}\n")
+        job = quality_job(data_dir, name, vsearch_args, threads, compress)
+
+        if cache and stage_cache.check_job(job):
+            continue
+
+        jobs.append(job)
+
+    results = runner.run_jobs(jobs, n_jobs)
+    stage_cache.record_jobs(jobs, results)
+
+
+###### FUSED PRE-PROCESSING ######
+def preprocess_job(data_dir:str, name:str, merge_args:list, primer_option:int, quality_args:list,
+                   keep_intermediates:bool=False, merge_threads:list=[], trim_threads:list=[], compress:str=None) -> dict:
+    """
+    Job (see runner.run_jobs) piping one sample through merge, trim and quality filter. See preprocess for the arguments.
+    """
+
+    fwd_reads = fastx.find(f"{data_dir}/input", f"{name}_R1.fastq")
+    rvs_reads = fastx.find(f"{data_dir}/input", f"{name}_R2.fastq")
+    out_path = f"{data_dir}/quality_filtered/{name}.fastq{compress or ''}"
+
+    pipe_threads = scheduler.thread_count(merge_threads)
+    fwd_input, fwd_feed = fastx.tool_input(fwd_reads, "vsearch", f"{data_dir}/quality_filtered", pipe_threads)
+    rvs_input, rvs_feed = fastx.tool_input(rvs_reads, "vsearch", f"{data_dir}/quality_filtered", pipe_threads)
+
+    merge_call = ["vsearch",
+                  "--fastq_mergepairs", fwd_input,
+                  "--reverse", rvs_input,
+                  "--fastqout", "-",
+                  "--fastq_maxdiffs", f"{merge_args[0]}",
+                  "--fastq_minovlen", f"{merge_args[1]}",
+                  "--fastq_maxdiffpct", f"{merge_args[2]}",
+                  f"{merge_args[3]}"]
+
+    cutadapt_call = ["cutadapt"] + primer_args(primer_option) + ["-o", "-", "-"]
+
+    quality_call = ["vsearch",
+                    "--fastx_filter", "-",
+                    "--fastqout", fastx.tool_output(out_path),
+                    "--fastq_maxee", f"{quality_args[0]}",
+                    "--fastq_maxns", f"{quality_args[1]}"]
+
+    outputs = [out_path]
+
+    # Thread counts don't change the output, so they only go into the calls that are run
+    threaded_calls = [merge_call + merge_threads, cutadapt_call[:-1] + trim_threads + cutadapt_call[-1:], quality_call]
+
+    if keep_intermediates:
+        outputs += [f"{data_dir}/merged/{name}_merged.fastq", f"{data_dir}/trimmed/{name}_trimmed.fastq"]
+        threaded_calls.insert(2, ["tee", f"{data_dir}/trimmed/{name}_trimmed.fastq"])
+        threaded_calls.insert(1, ["tee", f"{data_dir}/merged/{name}_merged.fastq"])
+
+    job = {"calls": threaded_calls}
+    if fastx.compression(out_path):
+        job = {"calls": threaded_calls + [fastx.compressor_call(fastx.compression(out_path), pipe_threads)], "stdout": out_path}
+
+    feeds = [feed for feed in [fwd_feed, rvs_feed] if feed is not None]
+    if feeds:
+        job["feeds"] = feeds
+
+    return {**job,
+            "log": f"{data_dir}/quality_filtered/logs/{name}.log",
+            "name": name,
+            "message": f"Merged, trimmed and quality filtered {name} successfully.",
+            "stage": "preprocess",
+            "stage_dir": f"{data_dir}/quality_filtered",
+            "sample": name,
+            "inputs": [fwd_reads, rvs_reads],
+            "outputs": outputs,
+            "args": [merge_call, cutadapt_call, quality_call, keep_intermediates],
+            "tools": ["vsearch", "cutadapt"]}
+
+
+def preprocess(data_dir:str,
+               merge_args:list=["99", "16", "25", "--fastq_allowmergestagger"],
+               primer_option:int=1,
+               quality_args:list=[1, 0],
+               keep_intermediates:bool=False,
+               n_jobs:int=1,
+               cores:int=None,
+               cache:bool=False,
+               compress:str=None):
+    """
+    Merge, trim and quality filter in one streaming pass per sample.
+
+    Inputs:
+        - data_dir: string providing the path to the data directory with raw input fastq files.
+        - merge_args: vsearch arguments, see merge_pairs.
+        - primer_option: primer set, see trim_primers.
+        - quality_args: vsearch arguments, see quality_filter.
+        - keep_intermediates: also write the merged and trimmed fastq files (for debugging, always uncompressed).
+        - n_jobs: maximum number of samples processed at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and the threads
+                given to vsearch --fastq_mergepairs and cutadapt.
+        - cache: skip samples whose raw reads, arguments and tool versions haven't changed.
+        - compress: write the quality filtered reads compressed, ".gz" or ".zst" (see merge_pairs).
+
+    Output:
+        - Quality filtered reads in the quality_filtered subfolder, same as quality_filter.
+        - If keep_intermediates, the merged and trimmed subfolders, same as merge_pairs and trim_primers.
+
+    Details:
+        vsearch --fastq_mergepairs, cutadapt and vsearch --fastx_filter are started together
+        for each sample and connected with OS pipes (vsearch and cutadapt read stdin / write stdout with "-"),
+        so reads stream from the raw R1/R2 files straight to the quality filtered fastq.
+        Nothing is written in between unless keep_intermediates is set, in which case
+        the stream is copied to disk with tee.
+    """
+
+    if len(merge_args) != 4:
+        print(f"merge_pairs vsearch_args must be list of length 4, {len(merge_args)} were provided. Exiting.")
+        exit()
+
+    if len(quality_args) != 2:
+        print(f"quality_filter vsearch_args must be list of length two. {len(quality_args)} arguments were provided. Exiting.")
+        exit()
+
+    names = get_sample_names(data_dir)
+
+    # Remove old directories and files (only outputs of removed samples when caching)
+    for sub_dir in ["merged", "trimmed", "quality_filtered"]:
+        if not cache and sub_dir in os.listdir(data_dir):
+            shutil.rmtree(f"{data_dir}/{sub_dir}/")
+
+    # Make directory for quality filtered reads and logs
+    os.makedirs(f"{data_dir}/quality_filtered/logs/", exist_ok=True)
+
+    if keep_intermediates:
+        os.makedirs(f"{data_dir}/merged/", exist_ok=True)
+        os.makedirs(f"{data_dir}/trimmed/", exist_ok=True)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/quality_filtered", names)
+
+    # All three tools run at once, so schedule on the (largest) merge step
+    merge_threads = []
+    trim_threads = []
+    if cores:
+        plan = scheduler.plan_stage("merge_pairs", [fastx.find(f"{data_dir}/input", f"{name}_R1.fastq") for name in names], cores)
+        plan["stage"] = "preprocess"
+        scheduler.record_plan(plan, f"{data_dir}/schedule.jsonl")
+        n_jobs = plan["n_jobs"]
+        merge_threads = scheduler.thread_args("merge_pairs", plan["threads"])
+        trim_threads = scheduler.thread_args("trim_primers", plan["threads"])
+
+    jobs = []
+    for name in names:
+        job = preprocess_job(data_dir, name, merge_args, primer_option, quality_args,
+                             keep_intermediates, merge_threads, trim_threads, compress)
+
+        if cache and stage_cache.check_job(job):
+            continue
+
+        jobs.append(job)
+
+    results = runner.run_jobs(jobs, n_jobs)
+    stage_cache.record_jobs(jobs, results)
 
 
 ###### LENGTH FILTER ######
-def length_filter(data_dir:str, amplicon_length:int):
+def length_filter_block(amplicon_length:int, block:bytes, dereplicate:bool=False):
+    """
+    Fasta records of the reads in a block of fastq records that are amplicon_length long.
+
+    Outputs:
+        - (fasta bytes, number kept, number removed). With dereplicate a Counter of the kept
+            sequences instead of the fasta bytes.
+    """
+
+    headers, seqs, _ = fastx.fastq_block(block)
+
+    if dereplicate:
+        keepers = Counter(seq for seq in seqs if len(seq) == amplicon_length)
+        kept = sum(keepers.values())
+        return keepers, kept, len(seqs) - kept
+
+    keepers = [b">%s\n%s\n" % (header[1:], seq) for header, seq in zip(headers, seqs) if len(seq) == amplicon_length]
+    return b"".join(keepers), len(keepers), len(seqs) - len(keepers)
+
+
+def dereplicated_fasta(name:str, seq_counts:Counter) -> bytes:
+    """
+    Fasta of a sample's unique sequences, most abundant first, with vsearch style ";size=" abundances.
+    """
+    return b"".join(b">%s_%d;size=%d\n%s\n" % (name.encode(), i, count, seq)
+                    for i, (seq, count) in enumerate(seq_counts.most_common(), 1))
+
+
+def length_filter_sample(data_dir:str, name:str, amplicon_length:int, cache:bool=False, compress:str=None, n_jobs:int=1,
+                         dereplicate:bool=False) -> bool:
+    """
+    Length filter the quality filtered reads of one sample. See length_filter for the arguments.
+
+    Outputs:
+        - True once the sample's fasta is written (or was already up to date).
+    """
+
+    in_path = fastx.find(f"{data_dir}/quality_filtered", f"{name}.fastq", compress or "")
+    data_file = os.path.basename(in_path)
+    out_path = f"{data_dir}/length_filtered/{name}.fasta{compress or ''}"
+
+    if cache:
+        key = stage_cache.stage_key([in_path], ["length_filter", amplicon_length, dereplicate])
+        if stage_cache.is_fresh(f"{data_dir}/length_filtered", name, key):
+            print(f"\n{name} is up to date in {data_dir}/length_filtered, skipping.\n")
+            return True
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+
+    rm_counts = 0 # Keep track of removed sequences
+    kepper_counts = 0 # Keep track of kept sequences
+    seq_counts = Counter() # Unique sequences when dereplicating
+    worker_cpu = [] # CPU seconds of the blocks filtered by worker processes
+
+    # Records are streamed in blocks, so memory stays flat whatever the file size,
+    # and the keepers of each block go out as one buffered fasta write.
+    # With n_jobs > 1 the blocks of one file are filtered by worker processes (see fastx_index.map_blocks).
+    with fastx.open_fastx(out_path, "wb", n_jobs) as out_file:
+        for keepers, kept, removed in fastx_index.map_blocks(partial(length_filter_block, amplicon_length, dereplicate=dereplicate),
+                                                             in_path, n_jobs, worker_cpu=worker_cpu):
+            if dereplicate:
+                seq_counts.update(keepers)
+            else:
+                out_file.write(keepers)
+            kepper_counts += kept
+            rm_counts += removed
+
+        if dereplicate:
+            out_file.write(dereplicated_fasta(name, seq_counts))
+
+    with open(f"{data_dir}/length_filtered/log/length_filter.log", "a") as log_file:
+        log_file.write(f"{data_file} had {rm_counts} sequences removed and {kepper_counts} sequences were kept.\n\n")
+        if dereplicate:
+            log_file.write(f"{data_file} kept sequences were dereplicated to {len(seq_counts)} unique sequences.\n\n")
+
+    metrics.record_step("length_filter", f"{data_dir}/length_filtered", name, True,
+                        {"wall_s": time.perf_counter() - start,
+                         "cpu_s": time.thread_time() - cpu_start + sum(worker_cpu),
+                         "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                        [in_path], [out_path])
+
+    if cache:
+        stage_cache.record(f"{data_dir}/length_filtered", name, key, [out_path])
+
+    return True
+
+
+def length_filter(data_dir:str, amplicon_length:int, cache:bool=False, compress:str=None, n_jobs:int=1, dereplicate:bool=False):
     """
     Filter sequences to match amplicon length.
 
     Inputs:
         - data_dir: path to data directory as a string
         - amplicon_length: fixed length of amplicon sequence.
+        - cache: skip samples whose quality filtered input and amplicon_length haven't changed.
+        - compress: write the fasta compressed, ".gz" or ".zst" (see merge_pairs).
+        - n_jobs: worker processes splitting each (plain) file between them.
+        - dereplicate: write each unique sequence once, most abundant first, with its count as
+                ";size=N" in the header (>{sample}_{i};size=N). chimera_filter needs dereplicate=True
+                as well to read and keep the sizes, frequency_filter adds them up.
 
     Outputs:
         - Trimmed sequences as fasta files in subfolder of data directory
+
+    Details:
+        Reads stay separate up to here because the quality filter needs each read's own qualities.
+        The length filter is the first step after it that only looks at the sequence, so it is
+        the earliest point the reads can be collapsed, and chimera_filter, frequency_filter and
+        the denoisers then only see unique sequences.
     """
 
     fastq_suffix = ".fastq"
 
     # Remove old files and make output directory for length-filtered files
-    if "length_filtered" in os.listdir(data_dir):
+    # (only outputs of removed samples when caching)
+    if not cache and "length_filtered" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/length_filtered/")
 
     # make output directory
-    os.makedirs(f"{data_dir}/length_filtered/")
+    os.makedirs(f"{data_dir}/length_filtered/", exist_ok=True)
 
     # make log subdirectory
-    os.makedirs(f"{data_dir}/length_filtered/log")
+    os.makedirs(f"{data_dir}/length_filtered/log", exist_ok=True)
 
+    names = fastx.sample_names(f"{data_dir}/quality_filtered", fastq_suffix)
 
-    for data_file in os.listdir(f"{data_dir}/quality_filtered/"):
-        if "fastq" in data_file:
-            rm_counts = 0 # Keep track of removed sequences
-            kepper_counts = 0 # Keep track of kept sequences
+    if cache:
+        stage_cache.prune(f"{data_dir}/length_filtered", names)
 
-            log_file = open(f"{data_dir}/length_filtered/log/length_filter.log", "a")
-            in_file = open(f"{data_dir}/quality_filtered/{data_file}", "r")
-            out_file = open(f"{data_dir}/length_filtered/{data_file[0:-len(fastq_suffix)]}.fasta", "a")
+    for name in names:
+        length_filter_sample(data_dir, name, amplicon_length, cache, compress, n_jobs, dereplicate)
 
-            lines = in_file.readlines()
 
-            # Iterate over pairs of lines.
-            for i, pair in enumerate(pairwise(lines)):
-                if (i % 4 == 0) and (len(pair[1].rstrip()) == amplicon_length): # if current line is a header and next line is a keeper sequence
-                    out_file.write(f">{pair[0]}") # write header line
-                if i % 4 == 1:
-                    if len(pair[0].rstrip()) == amplicon_length: # if current line is a keeper sequence
-                        out_file.write(f"{pair[0]}") # write keeper sequence
-                        kepper_counts += 1
-                    if len(pair[0]) != 142: # sequence was not correct length, keep track of skipped sequences.
-                        rm_counts += 1
-            out_file.close()
-            in_file.close()
-            log_file.write(f"{data_file} had {rm_counts} sequences removed and {kepper_counts} sequences were kept.\n\n")
-    log_file.close()
+###### NATIVE QUAL. FILTER ######
+def native_quality_sample(data_dir:str, name:str, quality_args:list=[1, 0], amplicon_length:int=None,
+                          cache:bool=False, compress:str=None, dereplicate:bool=False) -> bool:
+    """
+    Quality filter (and length filter) the trimmed reads of one sample in-process. See native_quality_filter for the arguments.
+
+    Outputs:
+        - True once the sample's output is written (or was already up to date).
+    """
+
+    in_path = fastx.find(f"{data_dir}/trimmed", f"{name}_trimmed.fastq", compress or "")
+
+    if amplicon_length is None:
+        stage, stage_dir = "quality_filter_native", f"{data_dir}/quality_filtered"
+        out_path = f"{stage_dir}/{name}.fastq{compress or ''}"
+        log_path = f"{stage_dir}/logs/{name}.log"
+    else:
+        stage, stage_dir = "quality_length_filter", f"{data_dir}/length_filtered"
+        out_path = f"{stage_dir}/{name}.fasta{compress or ''}"
+        log_path = f"{stage_dir}/log/length_filter.log"
+
+    if cache:
+        key = stage_cache.stage_key([in_path], [stage, quality_args[0], quality_args[1], amplicon_length, dereplicate])
+        if stage_cache.is_fresh(stage_dir, name, key):
+            print(f"\n{name} is up to date in {stage_dir}, skipping.\n")
+            return True
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+
+    # Collapsing needs the length filter, the fastq output keeps every read
+    dereplicate = dereplicate and amplicon_length is not None
+
+    kept = 0
+    removed = 0
+    seq_counts = Counter()
+
+    # One read of the trimmed reads: each block's expected errors, N counts (and lengths)
+    # are checked in one numpy pass and the keepers written out in one go.
+    with fastx.open_fastx(out_path, "wb") as out_file:
+        for headers, seqs, quals in fastx.fastq_chunks(in_path):
+            keep = quality.keep_mask(seqs, quals, float(quality_args[0]), int(quality_args[1]), amplicon_length)
+            keepers = keep.nonzero()[0]
+
+            if amplicon_length is None:
+                out_file.write(b"".join(b"%s\n%s\n+\n%s\n" % (headers[i], seqs[i], quals[i]) for i in keepers))
+            elif dereplicate:
+                seq_counts.update(seqs[i] for i in keepers)
+            else:
+                out_file.write(b"".join(b">%s\n%s\n" % (headers[i][1:], seqs[i]) for i in keepers))
+
+            kept += len(keepers)
+            removed += len(seqs) - len(keepers)
+
+        if dereplicate:
+            out_file.write(dereplicated_fasta(name, seq_counts))
+
+    with open(log_path, "a") as log_file:
+        log_file.write(f"{os.path.basename(in_path)} had {removed} sequences removed and {kept} sequences were kept.\n\n")
+        if dereplicate:
+            log_file.write(f"{os.path.basename(in_path)} kept sequences were dereplicated to {len(seq_counts)} unique sequences.\n\n")
+
+    metrics.record_step(stage, stage_dir, name, True,
+                        {"wall_s": time.perf_counter() - start,
+                         "cpu_s": time.thread_time() - cpu_start,
+                         "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                        [in_path], [out_path])
+
+    if cache:
+        stage_cache.record(stage_dir, name, key, [out_path])
+
+    print(f"\nQuality filtered {name} successfully.\n")
+    return True
+
+
+def native_quality_filter(data_dir:str, quality_args:list=[1, 0], amplicon_length:int=None,
+                          n_jobs:int=1, cache:bool=False, compress:str=None, dereplicate:bool=False):
+    """
+    Quality filter trimmed reads without vsearch, optionally length filtering in the same pass.
+
+    Inputs:
+        - data_dir: String with main data directory
+        - quality_args: [0] maximum expected errors (like --fastq_maxee), [1] maximum N's (like --fastq_maxns).
+        - amplicon_length: if given, also drop reads that aren't exactly this long and write fasta
+                straight to length_filtered (replaces quality_filter + length_filter).
+        - n_jobs: number of samples filtered at the same time (worker processes).
+        - cache: skip samples whose trimmed input and arguments haven't changed.
+        - compress: write the output compressed, ".gz" or ".zst" (see merge_pairs).
+        - dereplicate: with amplicon_length, write unique sequences with ";size=N" (see length_filter).
+
+    Output:
+        - quality_filtered/{name}.fastq like quality_filter, or with amplicon_length
+            length_filtered/{name}.fasta like length_filter.
+
+    Details:
+        Reads are streamed in blocks (see fastx.fastq_chunks). For each block the quality strings
+        are joined into one uint8 array, looked up in a Phred -> error probability table and summed
+        per read, the N's are counted the same way, and both thresholds (and the length) are
+        applied to the whole block at once (see quality.py).
+    """
+
+    if len(quality_args) != 2:
+        print(f"quality_filter vsearch_args must be list of length two. {len(quality_args)} arguments were provided. Exiting.")
+        exit()
+
+    trimmed_suffix = "_trimmed.fastq"
+    out_dir = "quality_filtered" if amplicon_length is None else "length_filtered"
+
+    names = fastx.sample_names(f"{data_dir}/trimmed", trimmed_suffix)
+
+    # Remove old directory and files (only outputs of removed samples when caching)
+    if not cache and out_dir in os.listdir(data_dir):
+        shutil.rmtree(f"{data_dir}/{out_dir}/")
+
+    os.makedirs(f"{data_dir}/{out_dir}/{'logs' if amplicon_length is None else 'log'}", exist_ok=True)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/{out_dir}", names)
+
+    filter_sample = partial(native_quality_sample, data_dir, quality_args=quality_args,
+                            amplicon_length=amplicon_length, cache=cache, compress=compress, dereplicate=dereplicate)
+
+    if n_jobs <= 1 or len(names) <= 1:
+        for name in names:
+            filter_sample(name)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(filter_sample, names))
 
 
 ###### CHIMERA FILTER ######
-def chimera_filter(data_dir:str, vsearch_args:list=["1.4", "8", "3", "1.2", "0.2"]):
+def chimera_job(data_dir:str, name:str, vsearch_args:list, threads:list=[], compress:str=None, dereplicate:bool=False) -> dict:
+    """
+    Job (see runner.run_jobs) removing chimeras from one length filtered sample. See chimera_filter for the arguments.
+    """
+
+    in_path = fastx.find(f"{data_dir}/length_filtered", f"{name}.fasta", compress or "")
+    out_path = f"{data_dir}/chimera_filtered/{name}.fasta{compress or ''}"
+    tool_input, feed = fastx.tool_input(in_path, "vsearch", f"{data_dir}/chimera_filtered", scheduler.thread_count(threads))
+
+    vsearch_chimera_call = ["vsearch",
+                         "--uchime_denovo", tool_input,
+                         "--nonchimeras", fastx.tool_output(out_path),
+                         "--dn", f"{vsearch_args[0]}",
+                         "--xn", f"{vsearch_args[1]}",
+                         "--mindiffs", f"{vsearch_args[2]}",
+                         "--mindiv", f"{vsearch_args[3]}",
+                         "--minh", f"{vsearch_args[4]}"]
+
+    # Dereplicated input: uchime weighs parents by abundance, and the sizes are passed on
+    if dereplicate:
+        vsearch_chimera_call += ["--sizein", "--sizeout"]
+
+    return {**fastx.tool_job(vsearch_chimera_call + threads, out_path, [feed], scheduler.thread_count(threads)),
+            "log": f"{data_dir}/chimera_filtered/logs/{name}.log",
+            "name": f"{name}.fasta",
+            "message": f"Chimera filtered {name}.fasta successfully.",
+            "stage": "chimera_filter",
+            "stage_dir": f"{data_dir}/chimera_filtered",
+            "sample": name,
+            "inputs": [in_path],
+            "outputs": [out_path],
+            "args": vsearch_chimera_call,
+            "tools": ["vsearch"]}
+
+
+def chimera_filter(data_dir:str, vsearch_args:list=["1.4", "8", "3", "1.2", "0.2"], n_jobs:int=1, cores:int=None, cache:bool=False, compress:str=None,
+                   dereplicate:bool=False):
     """
     Input:
         - data_dir: string of data directory.
+        - n_jobs: maximum number of samples chimera filtered at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and the vsearch --threads.
+        - cache: skip samples whose length filtered input, vsearch arguments and vsearch version haven't changed.
+        - compress: write the chimera filtered fasta compressed, ".gz" or ".zst" (see merge_pairs).
+        - dereplicate: the length filtered fasta has ";size=N" abundances (see length_filter).
 
     vsearch arguments:
         - [0] -dn: Pseudo-count prior for "no" votes. 
@@ -314,36 +875,250 @@ def chimera_filter(data_dir:str, vsearch_args:list=["1.4", "8", "3", "1.2", "0.2
 
     fasta_suffix = ".fasta"
 
-    # Remove old directory and files 
-    if "chimera_filtered" in os.listdir(data_dir):
+    # Remove old directory and files (only outputs of removed samples when caching)
+    if not cache and "chimera_filtered" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/chimera_filtered/")
 
     # Make directory for quality filtered reads
-    os.makedirs(f"{data_dir}/chimera_filtered/")
+    os.makedirs(f"{data_dir}/chimera_filtered/", exist_ok=True)
+
+    os.makedirs(f"{data_dir}/chimera_filtered/logs", exist_ok=True)
+
+    names = fastx.sample_names(f"{data_dir}/length_filtered", fasta_suffix)
+
+    if cache:
+        stage_cache.prune(f"{data_dir}/chimera_filtered", names)
+
+    # Split the core budget between samples and vsearch threads
+    n_jobs, threads = scheduler.schedule("chimera_filter",
+                                         [fastx.find(f"{data_dir}/length_filtered", f"{name}{fasta_suffix}", compress or "") for name in names],
+                                         cores, n_jobs, f"{data_dir}/schedule.jsonl")
 
-    os.makedirs(f"{data_dir}/chimera_filtered/logs")
+    jobs = []
+    for name in names:
+        job = chimera_job(data_dir, name, vsearch_args, threads, compress, dereplicate)
 
-    for file in os.listdir(f"{data_dir}/length_filtered/"):
-        if "fasta" in file:
-            vsearch_chimera_call = ["vsearch",
-                                 "--uchime_denovo", f"{data_dir}/length_filtered/{file}",
-                                 "--nonchimeras", f"{data_dir}/chimera_filtered/{file}",
-                                 "--dn", f"{vsearch_args[0]}",
-                                 "--xn", f"{vsearch_args[1]}",
-                                 "--mindiffs", f"{vsearch_args[2]}",
-                                 "--mindiv", f"{vsearch_args[3]}",
-                                 "--minh", f"{vsearch_args[4]}"]
+        if cache and stage_cache.check_job(job):
+            continue
 
-            with open(f"{data_dir}/chimera_filtered/logs/{file[0:-len(fasta_suffix)]}.log", "a") as log:
-                try:
-                    subprocess.run(vsearch_chimera_call, stdout=log, stderr=log, check=True)
-                    print(f"\nChimera filtered {file} successfully.\n")
-                except subprocess.CalledProcessError as e:
-                    print(f"\nError processing {file}: {e}\n")
+        jobs.append(job)
+
+    results = runner.run_jobs(jobs, n_jobs)
+    stage_cache.record_jobs(jobs, results)
 
 
 ###### FREQ. FILTER ######
-def frequency_filter(data_dir:str, min_seq_count:int, min_site_occurance:int):
+def count_block(block:bytes) -> Counter:
+    """
+    Occurances of each sequence in a block of fasta records, adding up ";size=N" abundances
+    of dereplicated records. Sequences are keyed by their 2-bit packed form (see seqpack.py).
+    """
+
+    headers, seqs = fastx.fasta_block(block)
+
+    if b";size=" not in block:
+        seq_counts = Counter(seqs)
+    else:
+        seq_counts = Counter()
+        for header, seq in zip(headers, seqs):
+            seq_counts[seq] += fastx.abundance(header)
+
+    # Only the block's unique sequences need packing
+    return Counter(dict(zip(seqpack.encode_many(list(seq_counts)), seq_counts.values())))
+
+
+def count_site(in_file:str, n_jobs:int=1) -> tuple:
+    """
+    Map step of the frequency filter: one site's count table.
+
+    Inputs:
+        - in_file: chimera filtered fasta of the site.
+        - n_jobs: worker processes counting blocks of the file (when sites aren't already counted in parallel).
+
+    Outputs:
+        - Packed keys (see seqpack.py) of the site's unique sequences, most abundant first.
+        - int64 array of their counts.
+    """
+
+    # Wrapped sequences are joined while parsing. Merging the block counts in file
+    # order keeps the first seen order for ties.
+    seq_counts = Counter()
+    for block_counts in fastx_index.map_blocks(count_block, in_file, n_jobs):
+        seq_counts.update(block_counts)
+
+    seq_counts_sorted = seq_counts.most_common()
+    return ([seq for seq, _ in seq_counts_sorted],
+            np.fromiter((count for _, count in seq_counts_sorted), dtype=np.int64, count=len(seq_counts_sorted)))
+
+
+def site_log(site:str, dropped_keys:list, dropped_occurances:list, min_seq_count:int) -> str:
+    """
+    Log lines of a site's dropped sequences (packed keys) and the number of sites each is rare at.
+    """
+
+    return "".join(f"{seq.decode()}\n occured less than {min_seq_count} times at {site} and present at {site_occurances - 1} other sites.\n"
+                   for seq, site_occurances in zip(seqpack.decode_many(dropped_keys), dropped_occurances))
+
+
+def write_site(out_path:str, site:str, kept_keys:list, kept_counts:list, dropped_keys:list, dropped_occurances:list,
+               min_seq_count:int) -> str:
+    """
+    Write step of the frequency filter: one site's fasta of the kept sequences.
+
+    Outputs:
+        - The site's log lines for its dropped sequences, the caller appends them in site order.
+    """
+
+    kept_seqs = seqpack.decode_many(kept_keys)
+
+    with open(out_path, "wb") as out_file:
+        out_file.write(b"".join(b">id=%s_%d;size=%d;\n%s\n" % (site.encode(), i, count, seq)
+                                for i, (seq, count) in enumerate(zip(kept_seqs, kept_counts), 1)))
+
+    return site_log(site, dropped_keys, dropped_occurances, min_seq_count)
+
+
+def frequency_table_filter(in_files:list, out_dir:str, log_path:str, min_seq_count:int, min_site_occurance:int, n_jobs:int=1,
+                           matrix_path:str=None):
+    """
+    In-memory frequency filter of the chimera filtered in_files into out_dir, see frequency_filter.
+
+    Details:
+        Map-reduce over the sites: with n_jobs > 1 and several sites, worker processes count one
+        site each (count_site) and send back its count table. This process merges them into the
+        site x sequence table and applies both rules, then the workers write one site's fasta each
+        (write_site). Rows are given out and logs appended in site order, so the output doesn't
+        depend on which worker finishes first.
+        The site x sequence matrix of the kept counts goes to matrix_path if given (see abundance.py),
+        its columns are the kept sequences in first seen order.
+    """
+
+    fasta_suffix = ".fasta"
+
+    sites = [fastx.sample_name(os.path.basename(in_file), fasta_suffix) for in_file in in_files]
+    parallel_sites = n_jobs > 1 and len(in_files) > 1
+
+    with ProcessPoolExecutor(max_workers=n_jobs) if parallel_sites else nullcontext() as pool:
+        map_sites = pool.map if parallel_sites else map
+
+        # Map: count every site. A lone site is split into blocks between the workers instead.
+        seq_rows = {} # packed unique sequence -> row in the count table
+        site_rows = [] # per site, rows of its sequences, most abundant first
+        site_counts = [] # and their counts
+
+        for keys, counts in map_sites(count_site if parallel_sites else partial(count_site, n_jobs=n_jobs), in_files):
+            site_rows.append(np.fromiter((seq_rows.setdefault(key, len(seq_rows)) for key in keys),
+                                         dtype=np.int64, count=len(keys)))
+            site_counts.append(counts)
+
+        unique_keys = list(seq_rows)
+
+        # Reduce: sites each sequence is too rare at, over the whole table at once
+        rows = np.concatenate(site_rows) if sites else np.zeros(0, dtype=np.int64)
+        counts = np.concatenate(site_counts) if sites else np.zeros(0, dtype=np.int64)
+        too_few = counts < min_seq_count
+        site_occurances = np.bincount(rows[too_few], minlength=len(unique_keys))
+        keep = (site_occurances[rows] >= min_site_occurance) | ~too_few
+
+        site_starts = np.cumsum([0] + [len(site) for site in site_rows])
+
+        kept_keys, kept_counts, dropped_keys, dropped_occurances = [], [], [], []
+        for start_row, end_row in zip(site_starts[:-1], site_starts[1:]):
+            site_keep = keep[start_row:end_row]
+            kept_keys.append([unique_keys[row] for row in rows[start_row:end_row][site_keep].tolist()])
+            kept_counts.append(counts[start_row:end_row][site_keep].tolist())
+            dropped_rows = rows[start_row:end_row][~site_keep]
+            dropped_keys.append([unique_keys[row] for row in dropped_rows.tolist()])
+            dropped_occurances.append(site_occurances[dropped_rows].tolist())
+
+        # Write: every site's fasta, logs in site order
+        with open(log_path, "a") as log_file:
+            for site_log in map_sites(write_site, [f"{out_dir}/{site}{fasta_suffix}" for site in sites], sites,
+                                      kept_keys, kept_counts, dropped_keys, dropped_occurances, [min_seq_count] * len(sites)):
+                log_file.write(site_log)
+
+    if matrix_path is not None:
+        # Columns: sequences kept at one site or more, in row (first seen) order
+        kept_rows = np.flatnonzero(np.bincount(rows[keep], minlength=len(unique_keys)))
+        row_columns = np.full(len(unique_keys), -1, dtype=np.int64)
+        row_columns[kept_rows] = np.arange(len(kept_rows))
+
+        writer = abundance.matrix_writer(matrix_path)
+        for site, start_row, end_row in zip(sites, site_starts[:-1], site_starts[1:]):
+            site_keep = keep[start_row:end_row]
+            writer.add_site(site, row_columns[rows[start_row:end_row][site_keep]], counts[start_row:end_row][site_keep])
+        writer.add_sequences(kept_rows, [unique_keys[row] for row in kept_rows.tolist()])
+        writer.close()
+
+
+def registry_frequency_filter(in_files:list, out_dir:str, log_path:str, min_seq_count:int, min_site_occurance:int,
+                              registry_path:str, n_jobs:int=1, matrix_path:str=None, remove_sites:list=[]):
+    """
+    Incremental frequency filter of the chimera filtered in_files into out_dir with a persistent
+    sequence registry, see registry.py and frequency_filter. remove_sites are dropped from the
+    registry first.
+
+    Details:
+        Only sites the registry hasn't counted from their current file are read (in parallel like
+        frequency_table_filter). Sites from earlier runs, in this data directory or any other sharing
+        the registry, count towards the site occurances without being read again. Fasta files are only
+        rewritten for sites whose output changed, the log is written for every site from the registry.
+        The matrix (if matrix_path is given) is always rewritten, its columns are registry ids.
+    """
+
+    fasta_suffix = ".fasta"
+
+    sites = [fastx.sample_name(os.path.basename(in_file), fasta_suffix) for in_file in in_files]
+    out_paths = [f"{out_dir}/{site}{fasta_suffix}" for site in sites]
+
+    if set(remove_sites) & set(sites):
+        raise ValueError(f"Sites to remove from the registry still have chimera filtered files: {sorted(set(remove_sites) & set(sites))}")
+
+    connection = registry.connect(registry_path)
+    registry.set_thresholds(connection, min_seq_count, min_site_occurance)
+
+    changed = [i for i, (site, in_file) in enumerate(zip(sites, in_files)) if not registry.is_current(connection, site, in_file)]
+    parallel_sites = n_jobs > 1 and len(changed) > 1
+
+    with ProcessPoolExecutor(max_workers=n_jobs) if parallel_sites else nullcontext() as pool:
+        map_sites = pool.map if parallel_sites else map
+
+        site_tables = map_sites(count_site if parallel_sites else partial(count_site, n_jobs=n_jobs), [in_files[i] for i in changed])
+        registry.update_sites(connection, ((sites[i], in_files[i], keys, counts) for i, (keys, counts) in zip(changed, site_tables)),
+                              min_seq_count, min_site_occurance, remove_sites)
+
+        tables = [registry.site_table(connection, site, min_seq_count, min_site_occurance) for site in sites]
+        stale = [i for i, (site, out_path) in enumerate(zip(sites, out_paths))
+                 if registry.is_stale(connection, site) or not os.path.exists(out_path)]
+
+        list(map_sites(write_site, [out_paths[i] for i in stale], [sites[i] for i in stale], *zip(*[tables[i][0:4] for i in stale]),
+                       [min_seq_count] * len(stale)) if stale else [])
+
+    with open(log_path, "w") as log_file:
+        for site, (_, _, dropped_keys, dropped_occurances, _) in zip(sites, tables):
+            log_file.write(site_log(site, dropped_keys, dropped_occurances, min_seq_count))
+
+    if matrix_path is not None:
+        # Columns: the sequences kept at one of these sites, in registry id order
+        id_keys = {}
+        for kept_keys, _, _, _, kept_ids in tables:
+            id_keys.update(zip(kept_ids, kept_keys))
+        ids = np.array(sorted(id_keys), dtype=np.int64)
+
+        writer = abundance.matrix_writer(matrix_path)
+        for site, (_, kept_counts, _, _, kept_ids) in zip(sites, tables):
+            writer.add_site(site, np.searchsorted(ids, np.array(kept_ids, dtype=np.int64)), kept_counts)
+        writer.add_sequences(ids, [id_keys[id] for id in ids.tolist()])
+        writer.close()
+
+    registry.mark_written(connection, [sites[i] for i in stale])
+    connection.close()
+
+    print(f"\n{len(changed)} of {len(sites)} sites counted, {len(stale)} rewritten (registry {registry_path}).\n")
+
+
+def frequency_filter(data_dir:str, min_seq_count:int, min_site_occurance:int, cache:bool=False, n_jobs:int=1,
+                     memory_budget_mb:float=None, registry_path:str=None, remove_sites:list=[], compress:str=None):
     """
     Filter sequences based on their frequency of occurances within and between sites.
 
@@ -352,10 +1127,28 @@ def frequency_filter(data_dir:str, min_seq_count:int, min_site_occurance:int):
         - min_seq_count: Integer, minimum sequence occurance at a site
         - min_site_occurance: minimum number of sites a low abundance sequence
                             must occur at to be retained.
+        - cache: skip the stage if no chimera filtered file and neither threshold changed.
+                All sites are needed for the site occurance rule, so this is all or nothing.
+        - n_jobs: worker processes. Sites are counted and written in parallel (see frequency_table_filter),
+                a single (plain) input file is split into blocks between them instead.
+        - memory_budget_mb: if given, count out-of-core in hash partitioned buckets on disk so peak memory
+                stays around this budget whatever the number of sites (see freq_spill.py). Same output.
+        - registry_path: if given, a persistent sequence registry (SQLite, see registry.py). Sites already
+                counted in it aren't read again, sites of earlier runs (also from other data directories)
+                count towards the site occurances, and only the fasta files whose content changed are
+                rewritten. memory_budget_mb and cache are ignored.
+        - remove_sites: with registry_path, names of sites to drop from the registry, e.g. sites whose
+                chimera filtered file was deleted. A site stays registered (and keeps counting towards
+                the site occurances of every run sharing the registry) until it is removed here.
+        - compress: compression chimera_filter wrote the sites in, that copy is read if a site is on
+                disk in several.
 
     Output: 
         - fasta files with size (seq count) in header in freq_filtered subdirectory.
+            Chimera filtered inputs can be compressed, the outputs are always plain fasta for the denoisers.
         - Formated for input into DnoisE filtering algorithm.
+        - The same counts as a sparse site x sequence matrix in freq_filtered/abundance (see abundance.py),
+            keyed by the registry's stable sequence ids when registry_path is given.
 
     Details:
         A sequence occurance at a site is only dropped if two conditions are met:
@@ -363,125 +1156,210 @@ def frequency_filter(data_dir:str, min_seq_count:int, min_site_occurance:int):
         - The sequence occurs less than a minimum number of times (min_seq_count)
         - And the sequence occurs at less than a minimum number of sites (min_site_occurance).
 
-        A temporary file for each site is created to group duplicate sequences and order them by abundance.
+        Records with a ";size=N" abundance (dereplicated, see length_filter) count N times.
+
+        Sites are occurances below min_seq_count, so a sequence rare everywhere needs to be at
+        min_site_occurance sites to stay.
+
+        Each site file is read once and counted into a site x sequence table: a dict gives each unique
+        sequence (2-bit packed, see seqpack.py) a row, and every site adds its (row, count) pairs in
+        abundance order. Both rules are then numpy operations over the whole table, and every site's
+        fasta is written straight from it (see frequency_table_filter).
         Currently the only information stored in the sequence header is the sequence name (site_name_sequence_id)
         and count of the sequence ("size")
     """
 
     fasta_suffix = ".fasta"
 
-    # Remove old directory and files
-    if "freq_filtered" in os.listdir(data_dir):
+    in_files = [fastx.find(f"{data_dir}/chimera_filtered", f"{site}{fasta_suffix}", compress or "")
+                for site in fastx.sample_names(f"{data_dir}/chimera_filtered", fasta_suffix)]
+
+    # A registry keeps its own record of what changed (and can be changed by other data directories)
+    cache = cache and registry_path is None
+
+    if cache:
+        cache_key = stage_cache.stage_key(in_files, ["frequency_filter", min_seq_count, min_site_occurance])
+        if stage_cache.is_fresh(f"{data_dir}/freq_filtered", "all_sites", cache_key):
+            print(f"\nAll sites are up to date in {data_dir}/freq_filtered, skipping.\n")
+            return
+
+    # Sites and blocks are counted by worker processes with n_jobs > 1, their CPU time is added
+    # once the pools have shut down (frequency_filter runs on its own, after every sample)
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    children_start = metrics.children_cpu()
+
+    # Remove old directory and files (with a registry only the fasta files of removed sites,
+    # the others are rewritten only if they changed)
+    if registry_path is None and "freq_filtered" in os.listdir(data_dir):
         shutil.rmtree(f"{data_dir}/freq_filtered/")
 
+    if registry_path is not None and "freq_filtered" in os.listdir(data_dir):
+        site_files = [f"{fastx.sample_name(os.path.basename(in_file), fasta_suffix)}{fasta_suffix}" for in_file in in_files]
+        for file in os.listdir(f"{data_dir}/freq_filtered"):
+            if file.endswith(fasta_suffix) and file not in site_files:
+                os.remove(f"{data_dir}/freq_filtered/{file}")
+
     # make output directory for frequency filtered files
-    os.makedirs(f"{data_dir}/freq_filtered/")
+    os.makedirs(f"{data_dir}/freq_filtered/", exist_ok=True)
 
     # Make subdirectory for log
-    os.makedirs(f"{data_dir}/freq_filtered/log/")
+    os.makedirs(f"{data_dir}/freq_filtered/log/", exist_ok=True)
+
+    matrix_path = f"{data_dir}/freq_filtered/{abundance.matrix_dir_name}"
+
+    if registry_path is not None:
+        registry_frequency_filter(in_files, f"{data_dir}/freq_filtered", f"{data_dir}/freq_filtered/log/freq_filter.log",
+                                  min_seq_count, min_site_occurance, registry_path, n_jobs, matrix_path, remove_sites)
+    elif memory_budget_mb is not None:
+        freq_spill.spill_frequency_filter(in_files,
+                                          [fastx.sample_name(os.path.basename(in_file), fasta_suffix) for in_file in in_files],
+                                          f"{data_dir}/freq_filtered",
+                                          f"{data_dir}/freq_filtered/log/freq_filter.log",
+                                          min_seq_count, min_site_occurance, memory_budget_mb, n_jobs, matrix_path)
+    else:
+        frequency_table_filter(in_files, f"{data_dir}/freq_filtered", f"{data_dir}/freq_filtered/log/freq_filter.log",
+                               min_seq_count, min_site_occurance, n_jobs, matrix_path)
+
+    out_files = sorted(f"{data_dir}/freq_filtered/{file}" for file in os.listdir(f"{data_dir}/freq_filtered") if "fasta" in file)
+
+    # All sites in one record, reads out are counted over every site
+    metrics.record(f"{data_dir}/freq_filtered", {"stage": "frequency_filter",
+                                                "sample": "all_sites",
+                                                "status": "done",
+                                                "wall_s": round(time.perf_counter() - start, 3),
+                                                "cpu_s": round(time.thread_time() - cpu_start + metrics.children_cpu() - children_start, 3),
+                                                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3),
+                                                **metrics.file_stats(in_files, out_files),
+                                                "reads_out": sum(metrics.count_reads(path) for path in out_files)})
+
+    if cache:
+        stage_cache.record(f"{data_dir}/freq_filtered", "all_sites", cache_key, out_files)
 
-    # make temp directory for sorted counts
-    os.makedirs(f"{data_dir}/freq_filtered/temp/")
-    os.makedirs(f"{data_dir}/freq_filtered/fixed_infiles/")
 
-    too_few_list = []
+###### DENOISE ######
+def denoised_matrix(output_dir:str, registry_path:str=None):
+    """
+    Write the abundance matrix of the denoised fasta files in output_dir (see abundance.py).
+    """
 
-    for file in os.listdir(f"{data_dir}/chimera_filtered/"):
+    denoised_suffix = "_denoised.fasta"
+    denoised_files = sorted(file for file in os.listdir(output_dir) if file.endswith(denoised_suffix))
+    abundance.matrix_from_fastas([f"{output_dir}/{file}" for file in denoised_files],
+                                 [file[0:-len(denoised_suffix)] for file in denoised_files],
+                                 f"{output_dir}/{abundance.matrix_dir_name}", registry_path)
 
-        if "fasta" in file:
-            # Sequence getting split over two lines. Make sequences whole.
-            with open(f"{data_dir}/chimera_filtered/{file}", "r") as infile, open(f"{data_dir}/freq_filtered/fixed_infiles/{file}", "w") as outfile:
-                for line in infile:
-                    if line.startswith(">"):
-                        outfile.write(f"\n{line}")
-                    else:
-                        outfile.write(line.strip())
 
-            temp_file = open(f"{data_dir}/freq_filtered/temp/{file}", "a")
-            in_file = open(f"{data_dir}/freq_filtered/fixed_infiles/{file}", "r")
+def unoise_log(log_path:str, counts:dict, minsize, alpha):
+    with open(log_path, "w") as log_file:
+        log_file.write(f"{counts['uniques']} unique sequences, {counts['discarded']} below minsize {minsize}, "
+                       f"{counts['zotus']} zotus (unoise_alpha {alpha}).\n")
 
-            # Read lines in file into list
-            lines = in_file.readlines()
 
-            # Count occurance of sequences
-            seq_counts = Counter(lines[2::2]) # my fasta file fix introduces an empty first line
+def dnoise_log(log_path:str, counts:dict, min_abund, alpha, entropy:bool):
+    # Entropy lines worded like DnoisE's, calc_ent_ratios.py reads them
+    with open(log_path, "w") as log_file:
+        for name, value in zip(["first", "second", "third"], counts["entropies"]):
+            log_file.write(f"Entropy of {name} codon position: {value:.4f}\n")
+        log_file.write(f"{counts['uniques']} unique sequences, {counts['discarded']} below min_abund {min_abund}, "
+                       f"{counts['correct']} correct sequences (alpha {alpha}, entropy {'yes' if entropy else 'no'}).\n")
 
-            for key in seq_counts:
-                if seq_counts[key] < min_seq_count:
-                    too_few_list.append(key)
 
-            seq_counts_sorted = seq_counts.most_common()
+def native_unoise_site(data_dir:str, output_dir:str, site:str, Unoise_args:list=["1", "2"]) -> bool:
+    """
+    Denoise one site in-process with unoise.py. See denoise (option="unoise_native") for the arguments.
+    """
 
-            for seq in seq_counts_sorted:
-                temp_file.write(f"{seq[1]}\n")
-                temp_file.write(f"{seq[0]}")
+    in_path = f"{data_dir}/{site}.fasta"
+    out_path = f"{output_dir}/{site}_denoised.fasta"
 
-            temp_file.close()
-            in_file.close()
-    
-    # Ones list now contains all sequences seen a minimum number of times.
-    # From these limited sequences, find ones that only occur at a minimum number of sites.
-    site_occurances = Counter(too_few_list)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
 
+    counts = unoise.unoise_fasta(in_path, out_path, alpha=float(Unoise_args[1]), minsize=int(Unoise_args[0]))
 
-    for tmp_file in os.listdir(f"{data_dir}/freq_filtered/temp/"):
-        # Track sequence index
-        i = 1
-        
-        if "fasta" in tmp_file:
+    unoise_log(f"{output_dir}/logs/{site}.log", counts, Unoise_args[0], Unoise_args[1])
+
+    metrics.record_step("denoise_unoise_native", f"{output_dir}/logs", site, True,
+                        {"wall_s": time.perf_counter() - start,
+                         "cpu_s": time.process_time() - cpu_start,
+                         "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                        [in_path], [out_path])
+
+    print(f"\nDenoised {site}.fasta successfully with native Unoise.\n")
+    return True
 
-            with open(f"{data_dir}/freq_filtered/temp/{tmp_file}") as f:
-                out_file = open(f"{data_dir}/freq_filtered/{tmp_file}", "a")
-                log_file = open(f"{data_dir}/freq_filtered/log/freq_filter.log", "a")
 
-                for count, seq in zip(f, f):
-                    if (site_occurances[seq] >= min_site_occurance) or (int(count) >= min_seq_count):
-                        out_file.write(f">id={tmp_file[0:-len(fasta_suffix)]}_{i};size={count.rstrip()};\n")
-                        out_file.write(seq)
-                        i += 1
-                    else:
-                        log_file.write(f"{seq} occured less than {min_seq_count} times at {tmp_file[0:-len(fasta_suffix)]} and present at {site_occurances[seq] - 1} other sites.\n")
+def native_dnoise_site(data_dir:str, output_dir:str, site:str, DnoisE_args:list=["2", "1", "3", "-y"]) -> bool:
+    """
+    Denoise one site in-process with dnoise.py. See denoise (option="dnoise_native") for the arguments.
+    """
 
-                out_file.close()
-    log_file.close()
+    in_path = f"{data_dir}/{site}.fasta"
+    out_path = f"{output_dir}/{site}_denoised.fasta"
+    entropy = len(DnoisE_args) > 3 and DnoisE_args[3] == "-y"
 
+    start = time.perf_counter()
+    cpu_start = time.process_time()
 
-    # Remove temp directories and files
-    if "temp" in os.listdir(f"{data_dir}/freq_filtered"):
-        shutil.rmtree(f"{data_dir}/freq_filtered/temp/")
+    counts = dnoise.dnoise_fasta(in_path, out_path, alpha=float(DnoisE_args[0]), min_abund=int(DnoisE_args[1]),
+                                 first_position=int(DnoisE_args[2]), entropy=entropy)
 
-    if "fixed" in os.listdir(f"{data_dir}/freq_filtered"):
-        shutil.rmtree(f"{data_dir}/freq_filtered/fixed_infiles/") 
+    dnoise_log(f"{output_dir}/logs/{site}.log", counts, DnoisE_args[1], DnoisE_args[0], entropy)
+
+    metrics.record_step("denoise_dnoise_native", f"{output_dir}/logs", site, True,
+                        {"wall_s": time.perf_counter() - start,
+                         "cpu_s": time.process_time() - cpu_start,
+                         "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                        [in_path], [out_path])
+
+    print(f"\nDenoised {site}.fasta successfully with native DnoisE.\n")
+    return True
 
 
-###### DENOISE ######
 def denoise(data_dir:str, 
             output_dir:str, 
             option:str="dnoise", 
             Unoise_args:list=["1", "2"], 
-            DnoisE_args:list=["2", "1", "3", "-y"]):
+            DnoisE_args:list=["2", "1", "3", "-y"],
+            n_jobs:int=1,
+            cores:int=None,
+            timeout:float=None,
+            retries:int=None,
+            registry_path:str=None):
     """
     Denoise using Antich's DnoisE algorithm or Edgar's Unoise3 algorithm.
 
     Inputs:
         - data_dir: Path to data directory.
         - output_dir: Path to output directory.
-        - option: "unoise" or "dnoise"
-
-    DnoisE_args:
+        - option: "unoise", "dnoise", "unoise_native" (unoise.py, in-process instead of usearch) or
+                "dnoise_native" (dnoise.py, in-process instead of dnoise). The native options need
+                sequences of one length.
+        - n_jobs: maximum number of sites denoised at the same time.
+        - cores: total core budget. If given, the scheduler picks n_jobs and the dnoise/usearch
+                thread count, and records the split in output_dir/logs/schedule.jsonl.
+        - timeout: seconds before a site's dnoise/usearch call is killed (runner.default_timeout if None).
+        - retries: extra attempts for a site that failed or timed out (runner.default_retries if None).
+        - registry_path: sequence registry the frequency filter used (see registry.py), to key the
+                abundance matrix by its stable sequence ids.
+
+    DnoisE_args (also for dnoise_native):
         - [0] --alpha: alpha value for Unoise distance calculation.
-        - [1] -x: First codon position in sequence (3 for Jared's amplicon)
-        - [2] --min_abund: Minimum abundance of sequences to include.
+        - [1] --min_abund: Minimum abundance of sequences to include.
                 Abundance filtering has already been applied, so set to 1.
-        - [3] -y: Use entropy? -y for yes, otherwise no flag.
+        - [2] -x: First codon position in sequence (3 for Jared's amplicon)
+        - [3] -y: Use entropy? -y for yes, otherwise no flag (dnoise_native only, dnoise always uses it).
 
-    Unoise_args:
+    Unoise_args (also for unoise_native):
         - [0] --minsize: Minimum abundance of sequences to include.
                 Abundance filtering has already been applied, so set to 1.
         - [1] --unoise_alpha: alpha value for Unoise distance calculation.
 
     Outputs:
         - Denoised fasta files in subdirectory plus csv INFO files.
+        - Per-site metrics in logs/metrics.jsonl (see metrics.py).
+        - Sparse site x sequence matrix of the denoised abundances in output_dir/abundance (see abundance.py).
     """
 
     fasta_suffix = ".fasta"
@@ -496,6 +1374,12 @@ def denoise(data_dir:str,
     # make log subdirectory
     os.makedirs(f"{output_dir}/logs/")
 
+    # Split the core budget between sites and dnoise/usearch threads
+    n_jobs, threads = scheduler.schedule(option,
+                                         [f"{data_dir}/{file}" for file in os.listdir(f"{data_dir}/") if ".fasta" in file],
+                                         cores, n_jobs, f"{output_dir}/logs/schedule.jsonl")
+
+    jobs = []
     for file in os.listdir(f"{data_dir}/"):
 
         if option == "dnoise":
@@ -505,15 +1389,18 @@ def denoise(data_dir:str,
                             "--alpha", str(DnoisE_args[0]),
                             "--min_abund", str(DnoisE_args[1]),
                             "-x", str(DnoisE_args[2]),
-                            "-y"]
+                            "-y"] + threads
             
             if ".fasta" in file:
-                with open(f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log", "a") as log:
-                    try:
-                        subprocess.run(DnoisE_call, stdout=log, stderr=log, check=True)
-                        print(f"\nDenoised {file} successfully with DnoisE.\n")
-                    except subprocess.CalledProcessError as e:
-                        print(f"\nError processing {file}: {e}\n")
+                jobs.append({"call": DnoisE_call,
+                             "log": f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log",
+                             "name": file,
+                             "message": f"Denoised {file} successfully with DnoisE.",
+                             "stage": "denoise_dnoise",
+                             "stage_dir": f"{output_dir}/logs",
+                             "sample": file[0:-len(fasta_suffix)],
+                             "inputs": [f"{data_dir}/{file}"],
+                             "outputs": [f"{output_dir}/{file}_Adcorr_denoised_ratio_d.fasta"]})
             
         if option == "unoise":
             Unoise_call = ["usearch",
@@ -521,16 +1408,35 @@ def denoise(data_dir:str,
                            "--ampout", f"{output_dir}/{file}",
                            "--minsize", str(Unoise_args[0]),
                            "--unoise_alpha", str(Unoise_args[1])
-                           ]
+                           ] + threads
 
             if ".fasta" in file:
-                with open(f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log", "a") as log:
-                    try:
-                        subprocess.run(Unoise_call, stdout=log, stderr=log, check=True)
-                        print(f"\nDenoised {file} successfully with Unoise.\n")
-                    except subprocess.CalledProcessError as e:
-                        print(f"\nError processing {file}: {e}\n")
-                
+                jobs.append({"call": Unoise_call,
+                             "log": f"{output_dir}/logs/{file[0:-len(fasta_suffix)]}.log",
+                             "name": file,
+                             "message": f"Denoised {file} successfully with Unoise.",
+                             "stage": "denoise_unoise",
+                             "stage_dir": f"{output_dir}/logs",
+                             "sample": file[0:-len(fasta_suffix)],
+                             "inputs": [f"{data_dir}/{file}"],
+                             "outputs": [f"{output_dir}/{file}"]})
+
+    if option in ["unoise_native", "dnoise_native"]:
+        sites = [file[0:-len(fasta_suffix)] for file in os.listdir(f"{data_dir}/") if file.endswith(fasta_suffix)]
+        if option == "unoise_native":
+            denoise_site = partial(native_unoise_site, data_dir, output_dir, Unoise_args=Unoise_args)
+        else:
+            denoise_site = partial(native_dnoise_site, data_dir, output_dir, DnoisE_args=DnoisE_args)
+
+        if n_jobs <= 1 or len(sites) <= 1:
+            for site in sites:
+                denoise_site(site)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                list(pool.map(denoise_site, sites))
+    else:
+        runner.run_jobs(jobs, n_jobs, timeout, retries)
+
     # DnoisE fasta output gets stupid names, fix
     stupid_suffix = ".fasta_Adcorr_denoised_ratio_d.fasta"
     if option == "dnoise":
@@ -550,4 +1456,184 @@ def denoise(data_dir:str,
                                 outfile.write(f"\n{line}")
                             else:
                                 outfile.write(line.strip())
-                os.remove(os.path.join(output_dir, file))
\ No newline at end of file
+                os.remove(os.path.join(output_dir, file))
+
+    # Abundances of every site as one matrix, parsed once here instead of by every downstream table
+    denoised_matrix(output_dir, registry_path)
+
+
+def sweep_site(data_dir:str, output_dirs:dict, site:str, option:str="dnoise_native", Unoise_args:list=["1", "2"],
+               DnoisE_args:list=["2", "1", "3", "-y"]) -> bool:
+    """
+    Denoise one site at every alpha with sweep.py. See denoise_sweep for the arguments.
+    """
+
+    in_path = f"{data_dir}/{site}.fasta"
+    out_paths = {alpha: f"{output_dir}/{site}_denoised.fasta" for alpha, output_dir in output_dirs.items()}
+    entropy = len(DnoisE_args) > 3 and DnoisE_args[3] == "-y"
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if option == "unoise_native":
+        alpha_counts = sweep.unoise_sweep_fasta(in_path, out_paths, minsize=int(Unoise_args[0]))
+    else:
+        alpha_counts = sweep.dnoise_sweep_fasta(in_path, out_paths, min_abund=int(DnoisE_args[1]),
+                                                first_position=int(DnoisE_args[2]), entropy=entropy)
+
+    # The shared run's time, split evenly between the alphas
+    usage = {"wall_s": (time.perf_counter() - start) / len(output_dirs),
+             "cpu_s": (time.process_time() - cpu_start) / len(output_dirs),
+             "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    for alpha, output_dir in output_dirs.items():
+        if option == "unoise_native":
+            unoise_log(f"{output_dir}/logs/{site}.log", alpha_counts[alpha], Unoise_args[0], alpha)
+        else:
+            dnoise_log(f"{output_dir}/logs/{site}.log", alpha_counts[alpha], DnoisE_args[1], alpha, entropy)
+
+        metrics.record_step(f"denoise_{option}_sweep", f"{output_dir}/logs", site, True, usage, [in_path], [out_paths[alpha]])
+
+    print(f"\nDenoised {site}.fasta successfully at {len(output_dirs)} alpha values.\n")
+    return True
+
+
+def denoise_sweep(data_dir:str,
+                  output_dirs:dict,
+                  option:str="dnoise_native",
+                  Unoise_args:list=["1", "2"],
+                  DnoisE_args:list=["2", "1", "3", "-y"],
+                  n_jobs:int=1,
+                  cores:int=None,
+                  registry_path:str=None):
+    """
+    denoise with a native option at several alpha values, computing the distances between a site's
+    sequences once for all of them (see sweep.py).
+
+    Inputs:
+        - data_dir: Path to data directory.
+        - output_dirs: dict alpha -> output directory, each written like denoise's output_dir.
+        - option: "unoise_native" or "dnoise_native".
+        - Unoise_args, DnoisE_args: as for denoise, the alpha in them is ignored.
+        - n_jobs: maximum number of sites denoised at the same time.
+        - cores: total core budget, as for denoise (the split is recorded in the first output directory).
+        - registry_path: as for denoise.
+
+    Outputs:
+        - In every output directory, the same files as denoise at that alpha.
+    """
+
+    fasta_suffix = ".fasta"
+
+    if option not in ["unoise_native", "dnoise_native"]:
+        raise ValueError(f"Alpha sweeps need a native option (unoise_native or dnoise_native), got {option}")
+
+    for output_dir in output_dirs.values():
+        if os.path.exists(output_dir):
+            shutil.rmtree(f"{output_dir}/")
+        os.makedirs(f"{output_dir}/logs/")
+
+    sites = [file[0:-len(fasta_suffix)] for file in os.listdir(f"{data_dir}/") if file.endswith(fasta_suffix)]
+    n_jobs, _ = scheduler.schedule(option, [f"{data_dir}/{site}{fasta_suffix}" for site in sites], cores, n_jobs,
+                                   f"{list(output_dirs.values())[0]}/logs/schedule.jsonl")
+    denoise_site = partial(sweep_site, data_dir, output_dirs, option=option, Unoise_args=Unoise_args, DnoisE_args=DnoisE_args)
+
+    if n_jobs <= 1 or len(sites) <= 1:
+        for site in sites:
+            denoise_site(site)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(denoise_site, sites))
+
+    for output_dir in output_dirs.values():
+        denoised_matrix(output_dir, registry_path)
+
+
+def denoise_pooled(data_dir:str,
+                   output_dir:str,
+                   option:str="unoise_native",
+                   Unoise_args:list=["1", "2"],
+                   DnoisE_args:list=["2", "1", "3", "-y"],
+                   registry_path:str=None):
+    """
+    Denoise every site's sequences together with a native option and map each site's reads to the
+    resulting ASVs (see pooled.py), instead of denoising each site on its own like denoise.
+
+    Inputs:
+        - data_dir: Path to data directory (frequency filtered sites).
+        - output_dir: Path to output directory.
+        - option: "unoise_native" or "dnoise_native".
+        - Unoise_args, DnoisE_args: as for denoise, minsize / min_abund apply to the pooled abundances.
+        - registry_path: as for denoise.
+
+    Outputs:
+        - {site}_denoised.fasta: the site's ASVs with its own read counts, headers naming the pooled ASV.
+        - pooled/asvs.fasta: every ASV with its total reads, numbered like the headers.
+        - Pooled and per-site logs, metrics, and the abundance matrix (columns are the ASVs, in order).
+    """
+
+    fasta_suffix = ".fasta"
+
+    if option not in ["unoise_native", "dnoise_native"]:
+        raise ValueError(f"Pooled denoising needs a native option (unoise_native or dnoise_native), got {option}")
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(f"{output_dir}/")
+    os.makedirs(f"{output_dir}/logs/")
+    os.makedirs(f"{output_dir}/pooled/")
+
+    sites = sorted(file[0:-len(fasta_suffix)] for file in os.listdir(f"{data_dir}/") if file.endswith(fasta_suffix))
+    in_paths = [f"{data_dir}/{site}{fasta_suffix}" for site in sites]
+    out_paths = [f"{output_dir}/{site}_denoised.fasta" for site in sites]
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    seqs, sizes, site_rows = pooled.pool_sites(in_paths)
+
+    entropy = len(DnoisE_args) > 3 and DnoisE_args[3] == "-y"
+    if option == "unoise_native":
+        assignment = unoise.unoise(seqs, sizes, alpha=float(Unoise_args[1]), minsize=int(Unoise_args[0]))
+    else:
+        assignment, entropies = dnoise.dnoise(seqs, sizes, alpha=float(DnoisE_args[0]), min_abund=int(DnoisE_args[1]),
+                                              first_position=int(DnoisE_args[2]), entropy=entropy)
+
+    asvs, totals, row_asv = pooled.asv_numbers(assignment, sizes)
+    asv_seqs = [seqs[row] for row in asvs.tolist()]
+    pooled.write_asvs(f"{output_dir}/pooled/asvs.fasta", asv_seqs, totals)
+
+    # Log of the pooled run, worded like the per-site logs of denoise
+    counts = {"uniques": len(seqs), "discarded": int((assignment < 0).sum())}
+    if option == "unoise_native":
+        unoise_log(f"{output_dir}/logs/pooled.log", {**counts, "zotus": len(asvs)}, Unoise_args[0], Unoise_args[1])
+    else:
+        dnoise_log(f"{output_dir}/logs/pooled.log", {**counts, "correct": len(asvs), "entropies": entropies.tolist()},
+                   DnoisE_args[1], DnoisE_args[0], entropy)
+
+    writer = abundance.matrix_writer(f"{output_dir}/{abundance.matrix_dir_name}")
+
+    for site, (site_table, site_counts), out_path in zip(sites, site_rows, out_paths):
+        site_asvs, asv_counts, discarded = pooled.site_asv_counts(site_table, site_counts, row_asv)
+        pooled.write_site(out_path, site, site_asvs, asv_counts, asv_seqs)
+        writer.add_site(site, site_asvs, asv_counts)
+
+        with open(f"{output_dir}/logs/{site}.log", "w") as log_file:
+            log_file.write(f"{len(site_table)} unique sequences, {len(site_asvs)} ASVs, "
+                           f"{discarded} reads in discarded sequences.\n")
+
+    keys = seqpack.encode_many(asv_seqs)
+    ids = np.arange(len(keys), dtype=np.int64)
+    if registry_path is not None:
+        connection = registry.connect(registry_path)
+        ids = np.array([-1 if id is None else id for id in registry.sequence_ids(connection, keys)], dtype=np.int64)
+        connection.close()
+    writer.add_sequences(ids, keys)
+    writer.close()
+
+    metrics.record_step(f"denoise_{option}_pooled", f"{output_dir}/logs", "pooled", True,
+                        {"wall_s": time.perf_counter() - start,
+                         "cpu_s": time.process_time() - cpu_start,
+                         "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                        in_paths, out_paths)
+
+    print(f"\nDenoised {len(sites)} sites successfully as one pool ({len(asvs)} ASVs).\n")
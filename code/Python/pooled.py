@@ -0,0 +1,99 @@
+import numpy as np
+import unoise
+
+# Pooled denoising (pipeline.denoise_pooled): every site's unique sequences are merged into one
+# table with their summed abundance, denoised once, and each site's reads are then mapped to the
+# ASVs (amplicon sequence variants, the correct sequences) their sequences ended up in.
+#
+# A sequence only has to be evaluated once however many sites hold it, and a true haplotype that is
+# rare at one site but common elsewhere keeps its reads at that site, where a per-site run would
+# take it for an error of a more abundant neighbour or drop it below minsize.
+
+
+def pool_sites(paths:list) -> tuple:
+    """
+    Merge ";size=N" annotated fasta files into one unique sequence table.
+
+    Outputs:
+        - Unique sequences (bytes) in first seen order and their summed abundances.
+        - For each file, the table row of each of its sequences and its count there.
+    """
+
+    rows = {} # sequence -> table row
+    site_rows = []
+
+    for path in paths:
+        _, seqs, counts = unoise.read_uniques(path)
+
+        site_table = np.fromiter((rows.setdefault(seq, len(rows)) for seq in seqs), dtype=np.int64, count=len(seqs))
+
+        # A sequence twice in a file (not after frequency_filter, but cheap to allow) adds up
+        site_table, inverse = np.unique(site_table, return_inverse=True)
+        site_counts = np.bincount(inverse, weights=counts, minlength=len(site_table)).astype(np.int64)
+        site_rows.append((site_table, site_counts))
+
+    sizes = np.zeros(len(rows), dtype=np.int64)
+    for site_table, site_counts in site_rows:
+        sizes[site_table] += site_counts
+
+    return list(rows), sizes, site_rows
+
+
+def asv_numbers(assignment:np.ndarray, sizes:np.ndarray) -> tuple:
+    """
+    Number the ASVs of a pooled assignment (see unoise.unoise) by their total reads, most first.
+
+    Outputs:
+        - Table row of each ASV.
+        - Total reads of each ASV (its own and the ones joined to it).
+        - For each table row, the number of its ASV, -1 if it was discarded.
+    """
+
+    kept = assignment >= 0
+    totals = np.bincount(assignment[kept], weights=sizes[kept], minlength=len(sizes)).astype(np.int64)
+
+    asvs = np.flatnonzero(assignment == np.arange(len(sizes)))
+    asvs = asvs[np.argsort(-totals[asvs], kind="stable")]
+
+    number = np.full(len(sizes), -1, dtype=np.int64)
+    number[asvs] = np.arange(len(asvs))
+    row_asv = np.where(kept, number[np.maximum(assignment, 0)], -1)
+
+    return asvs, totals[asvs], row_asv
+
+
+def site_asv_counts(site_table:np.ndarray, site_counts:np.ndarray, row_asv:np.ndarray) -> tuple:
+    """
+    A site's reads per ASV.
+
+    Outputs:
+        - ASV numbers the site has reads in, most reads first (ties in ASV order).
+        - Their read counts.
+        - Reads of the site in discarded sequences.
+    """
+
+    asv = row_asv[site_table]
+    kept = asv >= 0
+
+    counts = np.bincount(asv[kept], weights=site_counts[kept], minlength=row_asv.max(initial=-1) + 1).astype(np.int64)
+    present = np.flatnonzero(counts)
+    present = present[np.argsort(-counts[present], kind="stable")]
+
+    return present, counts[present], int(site_counts[~kept].sum())
+
+
+def write_site(out_path:str, site:str, asvs:np.ndarray, counts:np.ndarray, asv_seqs:list):
+    """
+    Write a site's ASVs with its own read counts, in the frequency_filter record layout,
+    each header naming its pooled ASV.
+    """
+
+    with open(out_path, "wb") as out_file:
+        out_file.write(b"".join(b">id=%s_%d;asv=%d;size=%d;\n%s\n" % (site.encode(), i, asv + 1, count, asv_seqs[asv])
+                                for i, (asv, count) in enumerate(zip(asvs.tolist(), counts.tolist()), start=1)))
+
+
+def write_asvs(out_path:str, asv_seqs:list, totals:np.ndarray):
+    with open(out_path, "wb") as out_file:
+        out_file.write(b"".join(b">asv=%d;size=%d;\n%s\n" % (asv, total, seq)
+                                for asv, (seq, total) in enumerate(zip(asv_seqs, totals.tolist()), start=1)))
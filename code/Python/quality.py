@@ -0,0 +1,76 @@
+import numpy as np
+
+# Error probability of every quality character (Phred+33). Characters below "!" aren't valid
+# qualities, they get probability 1 so a broken read never passes.
+phred_offset = 33
+error_lut = np.ones(256, dtype=np.float64)
+error_lut[phred_offset:] = 10 ** (-np.arange(256 - phred_offset) / 10)
+
+
+def per_read_sums(values:np.ndarray, lengths:np.ndarray) -> np.ndarray:
+    """
+    Sum a flat array of per-base values back into one value per read.
+    """
+
+    sums = np.zeros(len(lengths), dtype=values.dtype)
+    nonempty = lengths > 0
+    if not nonempty.any():
+        return sums
+
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # reduceat can't express an empty segment, so only the non-empty reads are summed
+    sums[nonempty] = np.add.reduceat(values, starts[nonempty])
+    return sums
+
+
+def expected_errors(quals:list) -> np.ndarray:
+    """
+    Expected number of errors (sum of error probabilities) of each read.
+
+    Inputs:
+        - quals: list of quality strings as bytes (Phred+33).
+
+    Outputs:
+        - float64 array, one value per read.
+    """
+
+    lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+    scores = np.frombuffer(b"".join(quals), dtype=np.uint8)
+    # take is a good deal faster than fancy indexing for a table lookup
+    return per_read_sums(error_lut.take(scores), lengths)
+
+
+def count_ns(seqs:list) -> np.ndarray:
+    """
+    Number of N bases in each read.
+    """
+
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    bases = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+
+    # N's are rare, so find them and count them per read rather than summing every base
+    positions = np.flatnonzero((bases == ord("N")) | (bases == ord("n")))
+    reads = np.searchsorted(np.cumsum(lengths), positions, side="right")
+    return np.bincount(reads, minlength=len(seqs))
+
+
+def keep_mask(seqs:list, quals:list, maxee:float, maxns:int, amplicon_length:int=None) -> np.ndarray:
+    """
+    Which reads of a batch pass the quality filter (and length check).
+
+    Inputs:
+        - seqs, quals: sequence and quality strings (bytes) of a batch of reads.
+        - maxee: maximum expected errors, like vsearch --fastq_maxee.
+        - maxns: maximum number of N's, like vsearch --fastq_maxns.
+        - amplicon_length: if given, reads also have to be exactly this long (see pipeline.length_filter).
+
+    Outputs:
+        - Boolean array, True for the reads to keep.
+    """
+
+    keep = (expected_errors(quals) <= maxee) & (count_ns(seqs) <= maxns)
+
+    if amplicon_length is not None:
+        keep &= np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)) == amplicon_length
+
+    return keep
@@ -0,0 +1,186 @@
+import sqlite3
+import stage_cache
+
+# Persistent sequence registry (SQLite) for adding sites to a frequency filtered run without
+# re-reading the sites already counted (pipeline.frequency_filter with registry_path=path).
+# Sites are dropped from it with frequency_filter's remove_sites.
+#
+# - sequences: every unique sequence ever counted (2-bit packed key, see seqpack.py) with a
+#   stable id. Ids are never reused, so the same sequence has the same id in every run.
+# - sites: one row per site with the fingerprint of the chimera filtered file it was counted from,
+#   and whether its freq_filtered output is out of date.
+# - site_counts: each site's count of each of its sequences, in the site's output order.
+# - rare: number of sites each sequence occurs at less than min_seq_count times
+#   ("site occurance" in frequency_filter), kept up to date as sites are added and removed.
+#
+# When sites change, only the sequences they hold are re-evaluated. A site whose output has to
+# change (a sequence of it crossed min_site_occurance) is marked stale, even if it belongs to
+# another data directory sharing the registry, and is rewritten the next time it is filtered.
+# Site names have to be unique within a registry.
+
+schema = """
+CREATE TABLE IF NOT EXISTS sequences (id INTEGER PRIMARY KEY AUTOINCREMENT, key BLOB NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS sites (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE,
+                                  fingerprint TEXT NOT NULL, stale INTEGER NOT NULL DEFAULT 1);
+CREATE TABLE IF NOT EXISTS site_counts (site_id INTEGER NOT NULL, rank INTEGER NOT NULL, seq_id INTEGER NOT NULL,
+                                        count INTEGER NOT NULL, PRIMARY KEY (site_id, rank)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rare (seq_id INTEGER PRIMARY KEY, sites INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+
+def connect(path:str) -> sqlite3.Connection:
+    """
+    Open (creating it if needed) the registry at path.
+    """
+
+    connection = sqlite3.connect(path)
+    connection.executescript(schema)
+    # One writer at a time, and a crash loses at most the last run, which is simply redone
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+def is_current(connection:sqlite3.Connection, site:str, path:str) -> bool:
+    """
+    True if the site was counted from the file at path as it is now.
+    """
+
+    row = connection.execute("SELECT fingerprint FROM sites WHERE name = ?", (site,)).fetchone()
+    return row is not None and row[0] == stage_cache.fingerprint(path)
+
+
+def set_thresholds(connection:sqlite3.Connection, min_seq_count:int, min_site_occurance:int):
+    """
+    Record the filter thresholds. If they changed since the last run, the rare counts are rebuilt
+    (for a new min_seq_count) and every site is marked stale.
+    """
+
+    settings = dict(connection.execute("SELECT name, value FROM settings"))
+
+    with connection:
+        if settings.get("min_seq_count") != min_seq_count:
+            connection.execute("DELETE FROM rare")
+            connection.execute("INSERT INTO rare SELECT seq_id, COUNT(*) FROM site_counts WHERE count < ? GROUP BY seq_id",
+                               (min_seq_count,))
+
+        if settings.get("min_seq_count") != min_seq_count or settings.get("min_site_occurance") != min_site_occurance:
+            connection.execute("UPDATE sites SET stale = 1")
+
+        connection.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                               [("min_seq_count", min_seq_count), ("min_site_occurance", min_site_occurance)])
+
+
+def remove_site_counts(connection:sqlite3.Connection, site_id:int, min_seq_count:int):
+    # Sequences rare at the site lose a site occurance
+    connection.execute("""INSERT OR IGNORE INTO touched SELECT c.seq_id, r.sites FROM site_counts c JOIN rare r ON r.seq_id = c.seq_id
+                          WHERE c.site_id = ? AND c.count < ?""", (site_id, min_seq_count))
+    connection.execute("""UPDATE rare SET sites = sites - 1
+                          WHERE seq_id IN (SELECT seq_id FROM site_counts WHERE site_id = ? AND count < ?)""", (site_id, min_seq_count))
+    connection.execute("DELETE FROM site_counts WHERE site_id = ?", (site_id,))
+
+
+def update_sites(connection:sqlite3.Connection, site_tables, min_seq_count:int, min_site_occurance:int,
+                 removed:list=[]):
+    """
+    Add or recount sites and remove others, then mark the sites whose output changed as stale.
+
+    Inputs:
+        - site_tables: iterable of (site, path of the counted file, packed keys most abundant first, their counts)
+                like pipeline.count_site, consumed one site at a time.
+        - min_seq_count, min_site_occurance: thresholds, already recorded with set_thresholds.
+        - removed: names of sites to drop from the registry.
+
+    Details:
+        The rare count of every sequence a changed site holds (or held) below min_seq_count is
+        updated in place, and its count before the update is kept. Sequences whose count ended up
+        on the other side of min_site_occurance are kept or dropped differently now, so the sites
+        holding them below min_seq_count are marked stale.
+    """
+
+    with connection:
+        connection.execute("CREATE TEMP TABLE touched (seq_id INTEGER PRIMARY KEY, before INTEGER NOT NULL)")
+
+        for site in removed:
+            row = connection.execute("SELECT id FROM sites WHERE name = ?", (site,)).fetchone()
+            if row is not None:
+                remove_site_counts(connection, row[0], min_seq_count)
+                connection.execute("DELETE FROM sites WHERE id = ?", row)
+
+        for site, path, keys, counts in site_tables:
+            connection.execute("""INSERT INTO sites (name, fingerprint, stale) VALUES (?, ?, 1)
+                                  ON CONFLICT (name) DO UPDATE SET fingerprint = excluded.fingerprint, stale = 1""",
+                               (site, stage_cache.fingerprint(path)))
+            site_id = connection.execute("SELECT id FROM sites WHERE name = ?", (site,)).fetchone()[0]
+            remove_site_counts(connection, site_id, min_seq_count)
+
+            # New sequences get the next ids in the site's order
+            connection.execute("CREATE TEMP TABLE site_keys (rank INTEGER PRIMARY KEY, key BLOB NOT NULL, count INTEGER NOT NULL)")
+            connection.executemany("INSERT INTO site_keys VALUES (?, ?, ?)", zip(range(len(keys)), keys, counts.tolist()))
+            connection.execute("INSERT OR IGNORE INTO sequences (key) SELECT key FROM site_keys ORDER BY rank")
+            connection.execute("""INSERT INTO site_counts SELECT ?, k.rank, s.id, k.count
+                                  FROM site_keys k JOIN sequences s ON s.key = k.key""", (site_id,))
+            connection.execute("DROP TABLE site_keys")
+
+            # Sequences rare at the site gain a site occurance
+            connection.execute("""INSERT OR IGNORE INTO touched SELECT c.seq_id, COALESCE(r.sites, 0)
+                                  FROM site_counts c LEFT JOIN rare r ON r.seq_id = c.seq_id WHERE c.site_id = ? AND c.count < ?""",
+                               (site_id, min_seq_count))
+            connection.execute("""INSERT INTO rare SELECT seq_id, 1 FROM site_counts WHERE site_id = ? AND count < ?
+                                  ON CONFLICT (seq_id) DO UPDATE SET sites = sites + 1""", (site_id, min_seq_count))
+
+        connection.execute("""UPDATE sites SET stale = 1 WHERE id IN (
+                                  SELECT DISTINCT c.site_id FROM site_counts c
+                                  JOIN touched t ON t.seq_id = c.seq_id JOIN rare r ON r.seq_id = c.seq_id
+                                  WHERE c.count < ? AND (t.before >= ?) != (r.sites >= ?))""",
+                           (min_seq_count, min_site_occurance, min_site_occurance))
+        connection.execute("DROP TABLE touched")
+
+
+def site_table(connection:sqlite3.Connection, site:str, min_seq_count:int, min_site_occurance:int) -> tuple:
+    """
+    The filtered table of a site, in its output order.
+
+    Outputs:
+        - kept packed keys and their counts.
+        - dropped packed keys and the number of sites each is rare at.
+        - sequence ids of the kept keys.
+    """
+
+    kept_keys, kept_counts, dropped_keys, dropped_occurances, kept_ids = [], [], [], [], []
+
+    for seq_id, key, count, rare_sites in connection.execute("""SELECT s.id, s.key, c.count, COALESCE(r.sites, 0) FROM sites t
+                                                                JOIN site_counts c ON c.site_id = t.id JOIN sequences s ON s.id = c.seq_id
+                                                                LEFT JOIN rare r ON r.seq_id = c.seq_id
+                                                                WHERE t.name = ? ORDER BY c.rank""", (site,)):
+        if count >= min_seq_count or rare_sites >= min_site_occurance:
+            kept_keys.append(key)
+            kept_counts.append(count)
+            kept_ids.append(seq_id)
+        else:
+            dropped_keys.append(key)
+            dropped_occurances.append(rare_sites)
+
+    return kept_keys, kept_counts, dropped_keys, dropped_occurances, kept_ids
+
+
+def is_stale(connection:sqlite3.Connection, site:str) -> bool:
+    row = connection.execute("SELECT stale FROM sites WHERE name = ?", (site,)).fetchone()
+    return row is None or bool(row[0])
+
+
+def mark_written(connection:sqlite3.Connection, sites:list):
+    with connection:
+        connection.executemany("UPDATE sites SET stale = 0 WHERE name = ?", [(site,) for site in sites])
+
+
+def sequence_ids(connection:sqlite3.Connection, keys:list) -> list:
+    """
+    Stable ids of packed sequences (see seqpack.encode_many), None for sequences never registered.
+    """
+
+    ids = {}
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        ids.update(connection.execute(f"SELECT key, id FROM sequences WHERE key IN ({','.join('?' * len(batch))})", batch))
+    return [ids.get(key) for key in keys]
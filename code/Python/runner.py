@@ -0,0 +1,283 @@
+import os, re, time, asyncio, subprocess
+import metrics
+
+# Defaults for every job that doesn't set its own "timeout" / "retries".
+# Set them once for a whole run, e.g. runner.default_timeout = 6 * 3600 in main.py.
+default_timeout = None # seconds, None for no limit
+default_retries = 0 # extra attempts after a failure or timeout
+retry_delay = 5 # seconds before the first retry, doubled for each further one
+progress_interval = 60 # seconds between progress lines while jobs run, 0 for none
+
+# Progress lines of vsearch ("Merging reads 45%"), cutadapt and usearch ("00:01 4.2Mb 37.5% ...")
+progress_pattern = re.compile(rb"(\d{1,3}(?:\.\d+)?)%")
+
+
+def wait_with_usage(proc:subprocess.Popen):
+    """
+    Wait for a child process and collect its resource usage.
+
+    Outputs:
+        - exit code, cpu seconds (user + system), peak resident memory in MB.
+    """
+
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in KB on linux
+    return proc.returncode, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024
+
+
+async def stream_to_log(pipe, log, state:dict):
+    """
+    Copy a child's output pipe into the log as it arrives, keeping the last progress percentage
+    seen in state["progress"]. Progress bars redraw with carriage returns, so chunks are scanned
+    rather than waiting for whole lines.
+    """
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+
+    try:
+        while True:
+            chunk = await reader.read(1 << 16)
+            if not chunk:
+                break
+            log.write(chunk)
+            log.flush()
+
+            found = progress_pattern.findall(chunk)
+            if found:
+                state["progress"] = float(found[-1])
+    finally:
+        transport.close()
+
+
+async def run_calls(calls:list, log_path:str, timeout:float=None, state:dict=None, stdout:str=None, feeds:list=[]):
+    """
+    Run one or more tool calls connected by OS pipes and stream their output to the log.
+
+    Inputs:
+        - calls: list of tool commands. stdout of each call is the stdin of the next.
+        - log_path: per-sample log, stderr of every call and stdout of the last are appended to it.
+        - timeout: seconds before every call is killed, None for no limit.
+        - state: optional dict, gets the latest "progress" percentage.
+        - stdout: optional file the last call's stdout is written to instead of the log.
+        - feeds: optional list of {"call", "fifo"}: each call's stdout goes into a named pipe
+                that one of the calls reads as an input file (e.g. zstd decompressing for vsearch).
+
+    Outputs:
+        - list of (exit code, cpu seconds, peak MB) per call, and whether the timeout hit.
+
+    Details:
+        The children are started with Popen rather than asyncio's subprocess helpers so they
+        can be reaped with os.wait4 (in a worker thread) and keep their resource usage.
+        Their stderr/stdout pipes are read on the event loop.
+    """
+
+    loop = asyncio.get_running_loop()
+    state = state if state is not None else {}
+
+    with open(log_path, "ab") as log:
+        procs = []
+        feed_procs = []
+        stdin = None
+        try:
+            for feed in feeds:
+                if os.path.exists(feed["fifo"]):
+                    os.remove(feed["fifo"])
+                os.mkfifo(feed["fifo"])
+                # Read-write open doesn't block waiting for the reader, the child keeps the only copy
+                fifo = os.open(feed["fifo"], os.O_RDWR)
+                try:
+                    feed_procs.append(subprocess.Popen(feed["call"], stdout=fifo, stderr=subprocess.PIPE))
+                finally:
+                    os.close(fifo)
+
+            for i, call in enumerate(calls):
+                if i < len(calls) - 1 or stdout is None:
+                    out = subprocess.PIPE
+                else:
+                    out = open(stdout, "wb")
+                proc = subprocess.Popen(call, stdin=stdin, stdout=out, stderr=subprocess.PIPE)
+                if out is not subprocess.PIPE:
+                    out.close()
+                # Close our copy of the pipe so the upstream call gets SIGPIPE if this one dies
+                if stdin is not None:
+                    stdin.close()
+                procs.append(proc)
+                stdin = proc.stdout if i < len(calls) - 1 else None
+        except OSError:
+            # Don't leave the calls already started waiting on a pipe nobody reads
+            for started in feed_procs + procs:
+                started.kill()
+                started.wait()
+            for feed in feeds:
+                if os.path.exists(feed["fifo"]):
+                    os.remove(feed["fifo"])
+            raise
+
+        pipes = [proc.stderr for proc in feed_procs + procs] + ([procs[-1].stdout] if stdout is None else [])
+        streams = [asyncio.ensure_future(stream_to_log(pipe, log, state)) for pipe in pipes]
+        waits = [loop.run_in_executor(None, wait_with_usage, proc) for proc in procs]
+        feed_waits = [loop.run_in_executor(None, wait_with_usage, proc) for proc in feed_procs]
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.gather(*waits)), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+
+        results = await asyncio.gather(*waits)
+
+        # A feed still running means its reader stopped early, it would block on the full pipe forever
+        for proc in feed_procs:
+            if proc.returncode is None:
+                proc.kill()
+        feed_results = await asyncio.gather(*feed_waits)
+        await asyncio.gather(*streams)
+
+        for feed in feeds:
+            os.remove(feed["fifo"])
+
+        if timed_out:
+            log.write(f"\nKilled after {timeout} s timeout.\n".encode())
+
+    return feed_results + results, timed_out
+
+
+async def run_job_async(job:dict, timeout:float=None, retries:int=0, state:dict=None) -> bool:
+    """
+    Run one job dict (see run_jobs), retrying failed or timed out attempts.
+    Jobs that carry a "stage_dir" get a metrics record (see metrics.py) for their last attempt.
+    """
+
+    calls = job["calls"] if "calls" in job else [job["call"]]
+    feeds = job.get("feeds", [])
+    timeout = job.get("timeout", timeout)
+    retries = job.get("retries", retries)
+    state = state if state is not None else {}
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            delay = retry_delay * 2 ** (attempt - 1)
+            print(f"\nRetrying {job['name']} in {delay} s (attempt {attempt + 1} of {retries + 1}).\n")
+            await asyncio.sleep(delay)
+
+        start = time.perf_counter()
+        state["progress"] = 0
+        try:
+            results, timed_out = await run_calls(calls, job["log"], timeout, state, job.get("stdout"), feeds)
+        except OSError as e:
+            # The tool can't be started, retrying won't help
+            print(f"\nError processing {job['name']}: {e}\n")
+            return False
+
+        usage = {"wall_s": time.perf_counter() - start,
+                 "cpu_s": sum(cpu for _, cpu, _ in results),
+                 "max_rss_mb": max(max_rss for _, _, max_rss in results)}
+
+        failed = [(call[0], returncode) for call, (returncode, _, _) in zip([feed["call"] for feed in feeds] + calls, results) if returncode != 0]
+        success = not failed and not timed_out
+
+        if "stage_dir" in job:
+            metrics.record_step(job["stage"], job["stage_dir"], job["sample"], success,
+                                {**usage, "attempts": attempt + 1}, job["inputs"], job["outputs"])
+
+        if success:
+            print(f"\n{job['message']}\n")
+            return True
+
+        if timed_out:
+            print(f"\nError processing {job['name']}: killed after {timeout} s timeout\n")
+        else:
+            print(f"\nError processing {job['name']}: {', '.join(f'{tool} exited with {code}' for tool, code in failed)}\n")
+
+    return False
+
+
+async def report_progress(states:dict):
+    while True:
+        await asyncio.sleep(progress_interval)
+        running = [f"{name} {state['progress']:.0f}%" for name, state in states.items() if state.get("running")]
+        done = sum(1 for state in states.values() if state.get("done"))
+        print(f"\nProgress: {done}/{len(states)} done, running: {', '.join(running) if running else 'none'}\n")
+
+
+async def run_jobs_async(jobs:list, n_jobs:int=1, timeout:float=None, retries:int=0) -> list:
+    """
+    Run jobs on the event loop with at most n_jobs running at once. See run_jobs.
+    """
+
+    semaphore = asyncio.Semaphore(max(1, n_jobs))
+    states = {job["name"]: {} for job in jobs}
+
+    async def limited(job):
+        async with semaphore:
+            states[job["name"]]["running"] = True
+            try:
+                return await run_job_async(job, timeout, retries, states[job["name"]])
+            finally:
+                states[job["name"]].update({"running": False, "done": True})
+
+    reporter = asyncio.ensure_future(report_progress(states)) if progress_interval and len(jobs) > 1 else None
+    try:
+        return await asyncio.gather(*[limited(job) for job in jobs])
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+
+
+def run_job(job:dict, timeout:float=None, retries:int=None) -> bool:
+    """
+    Run one job dict (see run_jobs), either a single call or a piped chain of calls.
+    """
+
+    timeout = timeout if timeout is not None else default_timeout
+    retries = retries if retries is not None else default_retries
+    return asyncio.run(run_job_async(job, timeout, retries))
+
+
+def run_jobs(jobs:list, n_jobs:int=1, timeout:float=None, retries:int=None) -> list:
+    """
+    Run per-sample tool calls with at most n_jobs running at the same time.
+
+    Inputs:
+        - jobs: list of dicts, each with:
+            - "call": tool command as a list, or
+            - "calls": list of tool commands connected by OS pipes like a shell "a | b | c"
+                    (stdout of each call is the stdin of the next, see run_calls).
+            - "log": path to the per-sample log file, stderr of every call is appended to it.
+            - "name": sample (or file) name used in error messages.
+            - "message": success message printed once every call finishes.
+          and optionally:
+            - "timeout", "retries": override the values below for this job.
+            - "stdout": file for the last call's stdout (e.g. the output of a compressor, see fastx.tool_job).
+            - "feeds": decompressors feeding named pipes, see run_calls.
+            - "stage", "stage_dir", "sample", "inputs", "outputs", "args", "tools": for the stage cache and metrics.
+        - n_jobs: maximum number of jobs running at once.
+        - timeout: seconds before a job's tools are killed (default_timeout if None).
+        - retries: extra attempts for a failed or timed out job (default_retries if None).
+
+    Outputs:
+        - List of booleans (success or not) in the same order as jobs.
+
+    Details:
+        The jobs run as asyncio tasks on one event loop, bounded by a semaphore. The heavy
+        lifting happens in the child processes; the loop just copies their output into the
+        per-sample logs as it arrives and picks up progress percentages, which are printed
+        every progress_interval seconds.
+        A job that hangs is killed at its timeout without touching the others, then retried
+        with a growing delay if it has retries left.
+    """
+
+    if not jobs:
+        return []
+
+    timeout = timeout if timeout is not None else default_timeout
+    retries = retries if retries is not None else default_retries
+
+    return asyncio.run(run_jobs_async(jobs, n_jobs, timeout, retries))
@@ -0,0 +1,124 @@
+import os, json, time
+from statistics import median
+import fastx
+
+# How well each stage's tool call uses extra threads.
+#   - max_threads: threads past this point do not speed up a single call.
+#                  vsearch --fastx_filter and --uchime_denovo are single threaded.
+#   - mb_per_thread: roughly how much input (MB) one thread is worth.
+#                    Small inputs finish before extra threads pay off.
+STAGE_PROFILES = {"merge_pairs": {"max_threads": 8, "mb_per_thread": 50},
+                  "trim_primers": {"max_threads": 8, "mb_per_thread": 50},
+                  "quality_filter": {"max_threads": 1, "mb_per_thread": 50},
+                  "chimera_filter": {"max_threads": 1, "mb_per_thread": 50},
+                  "dnoise": {"max_threads": 4, "mb_per_thread": 1},
+                  "unoise": {"max_threads": 4, "mb_per_thread": 1},
+                  "unoise_native": {"max_threads": 1, "mb_per_thread": 1},
+                  "dnoise_native": {"max_threads": 1, "mb_per_thread": 1}}
+
+# Command line flag each tool uses for its thread count.
+THREAD_FLAGS = {"merge_pairs": "--threads",
+                "trim_primers": "-j",
+                "quality_filter": "--threads",
+                "chimera_filter": "--threads",
+                "dnoise": "-c",
+                "unoise": "-threads"}
+
+
+def plan_stage(stage:str, input_files:list, cores:int) -> dict:
+    """
+    Split a core budget between concurrent samples and threads per tool call.
+
+    Inputs:
+        - stage: name of the stage, key of STAGE_PROFILES.
+        - input_files: paths to the per-sample input files of the stage.
+        - cores: total number of cores the stage may use.
+
+    Outputs:
+        - Dict with the chosen split:
+            - n_jobs: number of samples running at the same time.
+            - threads: threads given to each tool call.
+            - plus the stage, cores, sample count and median input size it was based on.
+
+    Details:
+        Threads per call are set from the median input size (mb_per_thread) and
+        capped at max_threads, so big merge_pairs inputs run few-but-wide and small
+        chimera_filter fastas run many-but-narrow. n_jobs is whatever is left of the
+        budget. If there are fewer samples than job slots the spare cores are handed
+        back to the tool calls (up to max_threads).
+    """
+
+    profile = STAGE_PROFILES[stage]
+    cores = max(1, cores)
+    n_samples = max(1, len(input_files))
+
+    # Compressed inputs are sized as uncompressed fastq (about 4x for gz and zst)
+    sizes_mb = [os.path.getsize(file) / 1e6 * (4 if fastx.compression(file) else 1) for file in input_files if os.path.exists(file)]
+    median_mb = median(sizes_mb) if sizes_mb else 0
+
+    threads = max(1, int(median_mb // profile["mb_per_thread"]))
+    threads = min(threads, profile["max_threads"], cores)
+
+    n_jobs = min(max(1, cores // threads), n_samples)
+
+    # Fewer samples than slots, widen each call with the unused cores.
+    if n_jobs == n_samples:
+        threads = min(max(threads, cores // n_jobs), profile["max_threads"])
+
+    return {"stage": stage,
+            "cores": cores,
+            "n_samples": len(input_files),
+            "median_mb": round(median_mb, 2),
+            "n_jobs": n_jobs,
+            "threads": threads}
+
+
+def thread_args(stage:str, threads:int) -> list:
+    """
+    Command line arguments that set the thread count of a stage's tool call
+    (none for in-process stages, which only use n_jobs).
+    """
+    if stage not in THREAD_FLAGS:
+        return []
+    return [THREAD_FLAGS[stage], str(threads)]
+
+
+def thread_count(threads:list):
+    """
+    Thread count in the arguments from thread_args, None if there are none.
+    Used for the job's compression pipes (see fastx.compressor_call).
+    """
+    return int(threads[-1]) if threads else None
+
+
+def record_plan(plan:dict, log_path:str):
+    """
+    Append a chosen split as one json line, so splits can be compared when tuning.
+    """
+    with open(log_path, "a") as log:
+        log.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), **plan}) + "\n")
+
+
+def schedule(stage:str, input_files:list, cores:int, n_jobs:int, log_path:str):
+    """
+    Pick n_jobs and the tool thread arguments for a stage.
+
+    Inputs:
+        - stage: name of the stage, key of STAGE_PROFILES.
+        - input_files: paths to the per-sample input files of the stage.
+        - cores: total core budget. None leaves n_jobs as given and the tool's own threading alone.
+        - n_jobs: number of concurrent samples to use when no core budget is given.
+        - log_path: json lines file the chosen split is appended to.
+
+    Outputs:
+        - n_jobs, list of extra thread arguments for the tool call.
+    """
+
+    if not cores:
+        return n_jobs, []
+
+    plan = plan_stage(stage, input_files, cores)
+    record_plan(plan, log_path)
+    print(f"\n{stage}: {plan['n_jobs']} samples at a time with {plan['threads']} threads each ({cores} cores).\n")
+
+    return plan["n_jobs"], thread_args(stage, plan["threads"])
@@ -0,0 +1,141 @@
+import numpy as np
+
+# 2-bit packed nucleotide sequences, used as compact dict keys when counting sequences.
+#
+# A sequence of only A, C, G and T packs 4 bases per byte. Its key is the packed bytes plus a
+# trailer byte with length % 4 (0-3), so a 142 bp amplicon is 36 + 1 bytes instead of 142.
+# Anything else (N's and other ambiguity codes, lowercase, gaps) is rare, and such a sequence
+# is kept as is with a 0xff trailer. Every key decodes back to exactly the sequence it came from.
+
+bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# Packed byte -> its 4 bases as one uint32, decodes a whole byte per lookup
+byte_bases = np.ascontiguousarray(bases[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]).view(np.uint32).ravel()
+
+raw_trailer = 0xff
+
+
+def packed_width(length:int) -> int:
+    return (length + 3) // 4
+
+
+def pack(seqs:list, length:int):
+    """
+    Pack sequences of the same length into a fixed width array, 4 bases per byte.
+
+    Inputs:
+        - seqs: list of bytes sequences, all length long.
+        - length: their length.
+
+    Outputs:
+        - uint8 array of shape (len(seqs), packed_width(length)), first base in the top bits.
+        - Boolean array, True for sequences with a base other than A, C, G or T
+            (their packed row is meaningless).
+    """
+
+    letters = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+
+    # A, C, G, T (65, 67, 71, 84) -> 0, 1, 2, 3 with shifts instead of a table lookup, a good deal faster
+    codes = (((letters >> 1) ^ (letters >> 2)) & 3).reshape(len(seqs), length)
+    valid = (letters == ord("A")) | (letters == ord("C")) | (letters == ord("G")) | (letters == ord("T"))
+    if valid.all():
+        ambiguous = np.zeros(len(seqs), dtype=bool)
+    else:
+        ambiguous = ~valid.reshape(len(seqs), length).all(axis=1)
+
+    # Pad to whole bytes, the padding bases pack as A's
+    padded = np.zeros((len(seqs), packed_width(length) * 4), dtype=np.uint8)
+    padded[:, 0:length] = codes
+
+    # Each group of 4 codes read as one little endian uint32 (c0 in the low byte),
+    # and shifted into c0 c1 c2 c3 from the top bits of a byte
+    quads = padded.view("<u4")
+    packed = ((quads << 6) | (quads >> 4) | (quads >> 14) | (quads >> 24)).astype(np.uint8)
+    return packed, ambiguous
+
+
+def unpack(packed:np.ndarray, length:int) -> list:
+    """
+    Sequences (bytes) of a fixed width array from pack.
+    """
+
+    letters = byte_bases.take(packed).view(np.uint8)[:, 0:length].tobytes()
+    return [letters[i:i + length] for i in range(0, len(letters), length)] if length else [b""] * len(packed)
+
+
+def encode_many(seqs:list) -> list:
+    """
+    Packed keys of a list of sequences (bytes), see the top of the module.
+
+    Details:
+        Sequences are packed in one numpy pass per distinct length, amplicons all have the same
+        length so that is usually a single pass.
+    """
+
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    keys = [None] * len(seqs)
+
+    for length in np.unique(lengths).tolist():
+        rows = np.flatnonzero(lengths == length).tolist()
+        group = seqs if len(rows) == len(seqs) else [seqs[row] for row in rows]
+
+        packed, ambiguous = pack(group, length)
+
+        # Trailer column with length % 4, then one bytes key per row
+        width = packed.shape[1] + 1
+        keyed = np.empty((len(group), width), dtype=np.uint8)
+        keyed[:, 0:-1] = packed
+        keyed[:, -1] = length % 4
+        buffer = keyed.tobytes()
+        group_keys = [buffer[i:i + width] for i in range(0, len(buffer), width)]
+
+        if len(rows) == len(seqs):
+            keys = group_keys
+        else:
+            for row, key in zip(rows, group_keys):
+                keys[row] = key
+
+        for i in np.flatnonzero(ambiguous).tolist():
+            keys[rows[i]] = group[i] + bytes([raw_trailer])
+
+    return keys
+
+
+def decode_many(keys:list) -> list:
+    """
+    Sequences (bytes) of a list of keys from encode_many.
+    """
+
+    # Usually every key is a packed sequence of the same length, unpack them in one go
+    if keys and len(set(map(len, keys))) == 1:
+        keyed = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(len(keys), len(keys[0]))
+        trailer = keys[0][-1]
+        if trailer != raw_trailer and (keyed[:, -1] == trailer).all():
+            return unpack(keyed[:, 0:-1], (len(keys[0]) - 1) * 4 if trailer == 0 else (len(keys[0]) - 2) * 4 + trailer)
+
+    seqs = [None] * len(keys)
+
+    # Group packed keys by their length in bases
+    groups = {}
+    for i, key in enumerate(keys):
+        if key[-1] == raw_trailer:
+            seqs[i] = key[0:-1]
+        else:
+            length = (len(key) - 1) * 4 if key[-1] == 0 else (len(key) - 2) * 4 + key[-1]
+            groups.setdefault(length, []).append(i)
+
+    for length, rows in groups.items():
+        width = packed_width(length) + 1
+        keyed = np.frombuffer(b"".join([keys[row] for row in rows]), dtype=np.uint8).reshape(len(rows), width)
+        for row, seq in zip(rows, unpack(keyed[:, 0:-1], length)):
+            seqs[row] = seq
+
+    return seqs
+
+
+def encode(seq:bytes) -> bytes:
+    return encode_many([seq])[0]
+
+
+def decode(key:bytes) -> bytes:
+    return decode_many([key])[0]
@@ -0,0 +1,175 @@
+import os, json, hashlib, subprocess
+import fastx
+from functools import lru_cache
+
+# Each stage keeps one small manifest per sample in {stage_dir}/.cache/{name}.json:
+#   - key: hash of the sample's input fingerprints, the tool arguments and the tool version.
+#   - outputs: fingerprints of the files the sample produced.
+# A sample is skipped when its key matches and its outputs are still on disk untouched.
+
+cache_dir_name = ".cache"
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool:str) -> str:
+    """
+    First line printed by "tool --version", or "unknown" if the tool can't be run.
+    vsearch prints its version to stderr, cutadapt to stdout, so both are checked.
+    """
+    try:
+        result = subprocess.run([tool, "--version"], capture_output=True, text=True)
+    except OSError:
+        return "unknown"
+
+    lines = [line.strip() for line in (result.stdout + result.stderr).splitlines() if line.strip()]
+    return lines[0] if lines else "unknown"
+
+
+def fingerprint(path:str, content:bool=False) -> str:
+    """
+    Fingerprint of a file.
+
+    Inputs:
+        - path: path to the file.
+        - content: hash the file contents (slow for big fastq files) instead of using size and
+                modification time.
+
+    Outputs:
+        - String fingerprint. "missing" if the file doesn't exist.
+    """
+
+    if not os.path.exists(path):
+        return "missing"
+
+    if content:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def stage_key(inputs:list, args:list, tools:list=[], content:bool=False) -> str:
+    """
+    Hash everything a sample's output depends on.
+
+    Inputs:
+        - inputs: paths to the sample's input files.
+        - args: tool call or arguments (anything json serialisable). Leave out thread counts,
+                they don't change the output.
+        - tools: names of the external tools, their versions go into the hash. Empty for in-process stages.
+        - content: fingerprint inputs by content instead of size and modification time.
+
+    Outputs:
+        - Hex digest string.
+    """
+
+    parts = {"inputs": [[path, fingerprint(path, content)] for path in inputs],
+             "args": [str(arg) for arg in args],
+             "tools": [tool_version(tool) for tool in tools]}
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def is_fresh(stage_dir:str, name:str, key:str) -> bool:
+    """
+    True if the sample was completed with the same key and its outputs haven't changed since.
+    """
+
+    manifest_path = f"{stage_dir}/{cache_dir_name}/{name}.json"
+    if not os.path.exists(manifest_path):
+        return False
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest["key"] != key:
+        return False
+
+    return all(fingerprint(path) == recorded for path, recorded in manifest["outputs"])
+
+
+def record(stage_dir:str, name:str, key:str, outputs:list):
+    """
+    Mark a sample as completed with the given key and output files. Outputs of the previous run
+    that it didn't write again (e.g. under another compress) are removed like prune does, and so
+    are copies of the outputs in other compressions: later stages would see them as samples too.
+    """
+
+    manifest_path = f"{stage_dir}/{cache_dir_name}/{name}.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        for path, _ in manifest["outputs"]:
+            if path not in outputs and os.path.exists(path):
+                os.remove(path)
+
+    for path in outputs:
+        fastx.remove_other_compressions(path)
+
+    os.makedirs(f"{stage_dir}/{cache_dir_name}", exist_ok=True)
+
+    with open(manifest_path, "w") as manifest_file:
+        json.dump({"key": key, "outputs": [[path, fingerprint(path)] for path in outputs]}, manifest_file)
+
+
+def prune(stage_dir:str, names):
+    """
+    Remove outputs and manifests of samples that are no longer among the inputs,
+    so later stages don't pick up their old files.
+    """
+
+    manifest_dir = f"{stage_dir}/{cache_dir_name}"
+    if not os.path.exists(manifest_dir):
+        return
+
+    for manifest_name in os.listdir(manifest_dir):
+        if manifest_name[0:-len(".json")] in names:
+            continue
+
+        with open(f"{manifest_dir}/{manifest_name}") as manifest_file:
+            manifest = json.load(manifest_file)
+
+        for path, _ in manifest["outputs"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        os.remove(f"{manifest_dir}/{manifest_name}")
+
+
+def check_job(job:dict) -> bool:
+    """
+    Check whether a sample's tool job can be skipped.
+
+    Inputs:
+        - job: job dict for runner.run_jobs, built by one of the pipeline.<stage>_job functions.
+                Uses its "stage_dir", "sample", "inputs", "args", "tools" entries.
+                If the sample has to run, its key is stored under "cache" so record_jobs
+                can mark it completed afterwards.
+
+    Outputs:
+        - True if the sample is up to date and the job should be skipped.
+    """
+
+    key = stage_key(job["inputs"], job["args"], job["tools"])
+
+    if is_fresh(job["stage_dir"], job["sample"], key):
+        print(f"\n{job['sample']} is up to date in {job['stage_dir']}, skipping.\n")
+        return True
+
+    job["cache"] = key
+    return False
+
+
+def record_jobs(jobs:list, results:list):
+    """
+    Record every successful job that was checked with check_job.
+    """
+
+    for job, success in zip(jobs, results):
+        if success and "cache" in job:
+            record(job["stage_dir"], job["sample"], job["cache"], job["outputs"])
@@ -0,0 +1,309 @@
+import numpy as np
+import unoise, dnoise, kmer_index
+
+# Alpha sweeps for the native denoisers (pipeline.denoise_sweep), e.g. the alpha x method grid of
+# benchmarking_main.py.
+#
+# The distances between sequences don't depend on alpha, only the abundance ratio they are
+# compared with does. A sequence Q can only join a more abundant M at distance d if
+#     size(M) / size(Q) >= 2^(alpha * d + 1)
+# which holds at every alpha only if it holds at the smallest one. So the greedy passes of all
+# alphas go through the sequences together, batch by batch like unoise.unoise: each batch's
+# distances are computed once, against every sequence that is correct at one alpha or more, and
+# only the pairs passing at the smallest alpha are kept for the per-alpha decisions. Every alpha
+# gets the same result as its own unoise.unoise or dnoise.dnoise run. Like those, the correct
+# sequences can be looked up in a kmer_index.pigeonhole_index, sized from the smallest alpha's reach.
+
+
+def reach(parent_size:int, child_size:int, alpha:float) -> float:
+    """
+    Largest distance at which a parent parent_size abundant can pass the test with a child child_size abundant
+    (2^(alpha * d + 1) <= parent_size / child_size), a little over to be safe from rounding.
+    """
+    if alpha <= 0:
+        return np.inf
+    return (np.log2(parent_size / child_size) - 1) / alpha + 1e-9
+
+
+def sweep(order:np.ndarray, sizes:np.ndarray, distance, passes, alphas:list, min_distance:float, step:int,
+          score=None, letters:np.ndarray=None, pair_distance=None) -> dict:
+    """
+    Greedy denoising of the sequences in order at every alpha.
+
+    Inputs:
+        - order: the sequences (row numbers) to denoise, most abundant first.
+        - sizes: abundance of every sequence.
+        - distance: function (queries, targets) -> distance array, like unoise.distances.
+        - passes: function (child sizes, parent sizes, distances, alpha) -> True where the child can
+                join the parent.
+        - alphas: alpha values.
+        - min_distance: smallest distance two different sequences can be at, to limit the parents
+                compared with a batch.
+        - step: parents compared with a batch at a time.
+        - score: function like passes returning the ratio_d score, a child then joins the passing
+                parent with the lowest score (DnoisE) instead of the most abundant one (UNOISE).
+        - letters, pair_distance: letters of the sequences (see unoise.packed_words) and a function
+                (queries, targets) -> distances of pairs, like unoise.pair_distances. If given, the
+                queries that no correct sequence can take at more than a few differences are only
+                compared with the correct sequences sharing a pigeonhole block with them (see
+                kmer_index.py), like in unoise.unoise.
+
+    Outputs:
+        - Dict alpha -> int64 array, for each sequence the row of its parent (its own row for a
+            correct sequence), -1 for sequences not in order.
+    """
+
+    min_alpha = min(alphas)
+    assignments = {alpha: np.full(len(sizes), -1, dtype=np.int64) for alpha in alphas}
+
+    # Sequences correct at one alpha or more, in order, and the smallest alpha each is correct at
+    union = np.empty(len(order), dtype=np.int64)
+    union_alpha = np.empty(len(order))
+    n_union = 0
+
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    # Differences far enough to need a check at the smallest alpha: up to the ones the rarest query
+    # could be at from the most abundant (a difference is at least min_distance)
+    if letters is not None and len(order) and min_alpha > 0:
+        max_differences = reach(sizes[order[0]], sizes[order[-1]], min_alpha) / min_distance
+        union_index = kmer_index.pigeonhole_index(letters, kmer_index.index_distance(letters.shape[1], max_differences))
+    else:
+        union_index = None
+
+    for start in range(0, len(order), unoise.batch_size):
+        batch = order[start:start + unoise.batch_size]
+        batch_sizes = sizes[batch]
+
+        # Pairs passing at the smallest alpha with earlier correct sequences
+        limit = np.searchsorted(-sizes[union[0:n_union]], -batch_sizes.min() * 2.0 ** (min_alpha * min_distance + 1), side="right")
+        dense = np.ones(len(batch), dtype=bool)
+
+        pair_rows, pair_parents, pair_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+
+        # Queries no correct sequence can take at more differences than the index covers: only the
+        # pairs sharing a pigeonhole block, through the index. Sequences correct at any alpha crowd
+        # together more than one alpha's centroids, so give up sooner than unoise.unoise
+        if union_index is not None and limit:
+            rows = np.flatnonzero(np.floor(reach(sizes[union[0]], batch_sizes, min_alpha) / min_distance) <= union_index.max_distance)
+            pairs = union_index.candidates(batch[rows], limit, max_pairs=len(rows) * limit // 64) if len(rows) else None
+            if pairs is not None:
+                query_index, positions = pairs
+                parents = union[positions]
+                distances = pair_distance(batch[rows[query_index]], parents)
+                keep = passes(batch_sizes[rows[query_index]], sizes[parents], distances, min_alpha)
+                pair_rows.append(rows[query_index[keep]])
+                pair_parents.append(parents[keep])
+                pair_distances.append(distances[keep])
+                dense[rows] = False
+
+        # The other queries with the earlier correct sequences abundant enough for the least abundant
+        # of them at the smallest alpha they are correct at
+        dense_rows = np.flatnonzero(dense)
+        dense_min = batch_sizes[dense_rows].min() if len(dense_rows) else np.inf
+        candidates = union[0:limit][sizes[union[0:limit]] >= dense_min * 2.0 ** (union_alpha[0:limit] * min_distance + 1)]
+
+        for chunk in range(0, len(candidates), step):
+            targets = candidates[chunk:chunk + step]
+            distances = distance(batch[dense_rows], targets)
+
+            # The exact test only where the distance is in reach of the most abundant target
+            rows, columns = np.nonzero(distances <= reach(sizes[targets[0]], dense_min, min_alpha))
+            keep = passes(batch_sizes[dense_rows[rows]], sizes[targets[columns]], distances[rows, columns], min_alpha)
+            pair_rows.append(dense_rows[rows[keep]])
+            pair_parents.append(targets[columns[keep]])
+            pair_distances.append(distances[rows[keep], columns[keep]])
+
+        pair_rows = np.concatenate(pair_rows)
+        pair_parents = np.concatenate(pair_parents)
+        pair_distances = np.concatenate(pair_distances)
+
+        # Within the batch, for the sequences it adds
+        inside = distance(batch, batch)
+        first_alpha = np.full(len(batch), np.inf)
+
+        for alpha in alphas:
+            assignment = assignments[alpha]
+            best = np.full(len(batch), -1, dtype=np.int64)
+            best_score = np.full(len(batch), np.inf)
+
+            arguments = (batch_sizes[pair_rows], sizes[pair_parents], pair_distances, alpha)
+            chosen = passes(*arguments) & (assignment[pair_parents] == pair_parents)
+            rows = pair_rows[chosen]
+            parents = pair_parents[chosen]
+
+            # Each row's most abundant parent, or the lowest scoring one
+            if score is None:
+                pick = np.lexsort((rank[parents], rows))
+            else:
+                scores = score(*arguments)[chosen]
+                pick = np.lexsort((rank[parents], scores, rows))
+            if len(pick):
+                first = pick[np.unique(rows[pick], return_index=True)[1]]
+                best[rows[first]] = parents[first]
+                if score is not None:
+                    best_score[rows[first]] = scores[first]
+
+            # Rows left against each other, in order: a row with no passing earlier row is correct,
+            # the others join one of the earlier rows that turned out correct
+            left = np.flatnonzero(best < 0)
+            hits = np.zeros((len(left), len(left)), dtype=bool)
+            if len(left):
+                rows, columns = np.nonzero((inside[left][:, left] <= reach(batch_sizes[left[0]], batch_sizes[left[-1]], alpha))
+                                           & np.tri(len(left), k=-1, dtype=bool))
+                arguments = (batch_sizes[left[rows]], batch_sizes[left[columns]], inside[left[rows], left[columns]], alpha)
+                hit = passes(*arguments)
+                hits[rows[hit], columns[hit]] = True
+                if score is not None:
+                    left_scores = np.full(hits.shape, np.inf)
+                    left_scores[rows[hit], columns[hit]] = score(*arguments)[hit]
+
+            correct = ~hits.any(axis=1)
+            for i in np.flatnonzero(~correct).tolist():
+                earlier = np.flatnonzero(hits[i] & correct)
+                if not len(earlier):
+                    correct[i] = True
+                elif score is None:
+                    best[left[i]] = batch[left[earlier[0]]]
+                else:
+                    j = earlier[left_scores[i, earlier].argmin()]
+                    best[left[i]] = batch[left[j]]
+                    best_score[left[i]] = left_scores[i, j]
+
+            new = left[correct]
+            best[new] = batch[new]
+            best_score[new] = -np.inf
+
+            # With ratio_d the others may score lower with one of those (they are less abundant, so after it)
+            rows = np.flatnonzero(best != batch)
+            if score is not None and len(new) and len(rows):
+                arguments = (batch_sizes[rows][:, None], batch_sizes[new][None, :], inside[rows][:, new], alpha)
+                row_scores = np.where(passes(*arguments), score(*arguments), np.inf)
+                new_best = row_scores.argmin(axis=1)
+                new_score = row_scores[np.arange(len(rows)), new_best]
+
+                better = new_score < best_score[rows]
+                best[rows[better]] = batch[new[new_best[better]]]
+
+            assignment[batch] = best
+            first_alpha[new] = np.minimum(first_alpha[new], alpha)
+
+        added = np.flatnonzero(first_alpha < np.inf)
+        union[n_union:n_union + len(added)] = batch[added]
+        union_alpha[n_union:n_union + len(added)] = first_alpha[added]
+        n_union += len(added)
+
+        if union_index is not None:
+            union_index.add(union[union_index.size:n_union])
+
+    return assignments
+
+
+def unoise_sweep(seqs:list, sizes:np.ndarray, alphas:list, minsize:int=unoise.default_minsize, index:bool=True) -> dict:
+    """
+    unoise.unoise at every alpha, with each distance computed once. index: look up candidate
+    centroids in a kmer_index.pigeonhole_index.
+
+    Outputs:
+        - Dict alpha -> assignment (see unoise.unoise).
+    """
+
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(seqs):
+        return {alpha: np.zeros(0, dtype=np.int64) for alpha in alphas}
+
+    words, letters, ambiguous = unoise.packed_words(seqs)
+
+    order = np.argsort(-sizes, kind="stable")
+    order = order[sizes[order] >= minsize]
+
+    def distance(queries, targets):
+        return unoise.distances(words, letters, ambiguous, queries, targets)
+
+    def pair_distance(queries, targets):
+        return unoise.pair_distances(words, letters, ambiguous, queries, targets)
+
+    # The test of unoise.unoise
+    def passes(child_sizes, parent_sizes, distances, alpha):
+        return parent_sizes >= child_sizes * 2.0 ** (alpha * distances + 1)
+
+    step = max(1, unoise.block_elements // (unoise.batch_size * words.shape[1]))
+
+    with np.errstate(over="ignore"):
+        return sweep(order, sizes, distance, passes, alphas, 1, step,
+                     letters=letters if index else None, pair_distance=pair_distance)
+
+
+def dnoise_sweep(seqs:list, sizes:np.ndarray, alphas:list, min_abund:int=dnoise.default_min_abund,
+                 first_position:int=1, entropy:bool=True, index:bool=True) -> tuple:
+    """
+    dnoise.dnoise at every alpha, with each distance computed once. index: look up candidate
+    mothers in a kmer_index.pigeonhole_index.
+
+    Outputs:
+        - Dict alpha -> assignment (see dnoise.dnoise).
+        - Mean entropy of codon positions 1, 2 and 3.
+    """
+
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(seqs):
+        return {alpha: np.zeros(0, dtype=np.int64) for alpha in alphas}, np.zeros(3)
+
+    words, letters, ambiguous = unoise.packed_words(seqs)
+    positions, entropies, weights, masks, min_weight = dnoise.distance_weights(words, letters, first_position, entropy)
+
+    order = np.argsort(-sizes, kind="stable")
+    order = order[sizes[order] >= min_abund]
+
+    def distance(queries, targets):
+        return dnoise.weighted_distances(words, letters, ambiguous, masks, positions, weights, queries, targets)
+
+    def pair_distance(queries, targets):
+        return dnoise.weighted_pair_distances(words, letters, ambiguous, masks, positions, weights, queries, targets)
+
+    # ratio_d of dnoise.dnoise, a mother when <= 0
+    def score(child_sizes, parent_sizes, distances, alpha):
+        return np.log2(child_sizes / parent_sizes) + alpha * distances + 1
+
+    def passes(child_sizes, parent_sizes, distances, alpha):
+        return score(child_sizes, parent_sizes, distances, alpha) <= 0
+
+    step = max(1, unoise.block_elements // (unoise.batch_size * words.shape[1] * 3))
+
+    return sweep(order, sizes, distance, passes, alphas, min_weight, step, score,
+                 letters if index else None, pair_distance), entropies
+
+
+def unoise_sweep_fasta(in_path:str, out_paths:dict, minsize:int=unoise.default_minsize) -> dict:
+    """
+    unoise.unoise_fasta at every alpha.
+
+    Inputs:
+        - out_paths: dict alpha -> output fasta.
+
+    Outputs:
+        - Dict alpha -> counts of unoise.write_centroids.
+    """
+
+    headers, seqs, sizes = unoise.read_uniques(in_path)
+    assignments = unoise_sweep(seqs, sizes, list(out_paths), minsize)
+    return {alpha: unoise.write_centroids(out_path, headers, seqs, sizes, assignments[alpha]) for alpha, out_path in out_paths.items()}
+
+
+def dnoise_sweep_fasta(in_path:str, out_paths:dict, min_abund:int=dnoise.default_min_abund, first_position:int=1,
+                       entropy:bool=True) -> dict:
+    """
+    dnoise.dnoise_fasta at every alpha.
+
+    Inputs:
+        - out_paths: dict alpha -> output fasta.
+
+    Outputs:
+        - Dict alpha -> counts of dnoise.dnoise_fasta.
+    """
+
+    headers, seqs, sizes = unoise.read_uniques(in_path)
+    assignments, entropies = dnoise_sweep(seqs, sizes, list(out_paths), min_abund, first_position, entropy)
+    return {alpha: {**dnoise.write_mothers(out_path, headers, seqs, sizes, assignments[alpha]), "entropies": entropies.tolist()}
+            for alpha, out_path in out_paths.items()}
@@ -1,7 +1,10 @@
 import subprocess, os, re
+from functools import partial
 from Bio import AlignIO
 from Bio.Seq import Seq
 import matplotlib.pyplot as plt
+import fastx_index
+import denoising_stats
 
 # Got amino acid sequences from supplementary materials of
 # Pentinsaari paper "Molecular evolution of a widely-adopted 
@@ -164,7 +167,7 @@ def get_conserved_base_positions(data_dir:str, fully_aligned_file:str):
     return codon_1, codon_2, codon_3
 
 
-def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list)->list:
+def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list, n_jobs:int=1)->list:
     """
     Get number of errors and total sequences in a fasta file.
 
@@ -172,6 +175,7 @@ def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list
         - data_dir: path to directory
         - fasta: Name of fasta (no path)
         - codon_1, 2, & 3: Lists of three base positions of each codon.
+        - n_jobs: worker processes splitting the file between them (see fastx_index.map_blocks).
 
     Outputs:
         - List containing: 
@@ -180,51 +184,23 @@ def check_seqs(data_dir:str, fasta:str, codon_1:list, codon_2:list, codon_3:list
             [2]: error_rate
     """
 
-    codon_dict = {"H": ["CAC", "CAT"], "G": ["GGA", "GGT", "GGC", "GGG"], "N": ["AAC", "AAT"]}
-    stop_seqs = ["TAA", "TGA", "TAG"]
-
-    with open(f"{data_dir}/{fasta}") as file:
-        num_errors = 0
-        num_seqs = 0
-        for rawline in file.readlines():
-            num_seqs += 1
-            if (rawline.strip()) and (">" not in rawline):
-                # Two N's added to match reading frame
-                seq = "NN" + rawline.rstrip()
-                first_codon = "".join([seq[i] for i in codon_1])
-                second_codon = "".join([seq[i] for i in codon_2])
-                third_codon = "".join([seq[i] for i in codon_3])
-
-                if ((first_codon != codon_dict["H"][0]) and 
-                    (first_codon != codon_dict["H"][1])):
-                    num_errors += 1
-
-                if ((second_codon != codon_dict["G"][0]) and 
-                    (second_codon != codon_dict["G"][1]) and
-                    (second_codon != codon_dict["G"][2]) and
-                    (second_codon != codon_dict["G"][3])):
-                    num_errors += 1
-
-                if ((third_codon != codon_dict["N"][0]) and 
-                    (third_codon != codon_dict["N"][1])):
-                    num_errors += 1
-                
-                for codon in [seq[i:i+3] for i in range(0, len(seq), 3)]:
-                    if (codon == stop_seqs[0] or 
-                        codon == stop_seqs[1] or 
-                        codon == stop_seqs[2]):
-                        num_errors += 1
-
-        error_rate = num_errors / num_seqs
-
-        return [num_errors, num_seqs, error_rate]
+    num_errors = 0
+    num_seqs = 0
+    for block_errors, block_lines in fastx_index.map_blocks(partial(denoising_stats.check_block, codon_1, codon_2, codon_3),
+                                                            f"{data_dir}/{fasta}", n_jobs):
+        num_errors += block_errors
+        num_seqs += block_lines
+
+    error_rate = num_errors / num_seqs
+
+    return [num_errors, num_seqs, error_rate]
     
 
 def get_method_avgs(denoised_dir, o, a, c1, c2, c3):
     method_stats = []
     for file in os.listdir(f"{denoised_dir}/{o}_alpha_{a}"):
 
-        if (".csv" not in file) and ("log" not in file):
+        if (".csv" not in file) and ("log" not in file) and os.path.isfile(f"{denoised_dir}/{o}_alpha_{a}/{file}"):
             file_stats = check_seqs(data_dir=f"{denoised_dir}/{o}_alpha_{a}", 
                                                      fasta=file, 
                                                      codon_1=c1, 
@@ -242,7 +218,7 @@ def get_method_avgs(denoised_dir, o, a, c1, c2, c3):
     return avg_err_rate, avg_seq_counts, avg_err_count
 
 
-def make_plot(stat, stats):
+def make_plot(stat, stats, label=None):
     fig, ax = plt.subplots()
 
     x = [int(*re.findall(r'\d+', item[0])) for item in stats if "dnoise" in item[0]]
@@ -259,11 +235,11 @@ def make_plot(stat, stats):
 
     ax.plot(x, y1, label="Entropy Correction")
     ax.plot(x, y2, linestyle="dashed", label="No Entropy")
-    ax.set_title(f"{stat}")
+    ax.set_title(f"{stat} ({label})" if label else f"{stat}")
     ax.set_xlabel("alpha value")
     ax.set_ylabel(f"{stat}")
     ax.legend()
-    plt.savefig(f"../../tmp_plots/{stat}.png")
+    plt.savefig(f"../../tmp_plots/{stat}_{label}.png" if label else f"../../tmp_plots/{stat}.png")
     print(f"{stat} plot saved in tmp_plots directory.")
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import numpy as np
+import fastx, seqpack, kmer_index
+
+# Native UNOISE3 (Edgar 2016) for amplicons that all have the same length, in place of
+# usearch --unoise3 (pipeline.denoise with option="unoise_native").
+#
+# Unique sequences are visited from the most abundant down. A sequence Q becomes noise of the
+# first (most abundant) centroid C it is d differences from with
+#     size(Q) / size(C) <= 1 / 2^(alpha * d + 1)
+# and is a new centroid (ZOTU) otherwise. Sequences less abundant than minsize are discarded first.
+# The length filter leaves every read amplicon_length long, so d is the Hamming distance. It is
+# computed on 2-bit packed sequences (see seqpack.py) as XOR and popcount over uint64 words.
+# Unlike usearch, there is no chimera check (uchime3), the pipeline's chimera_filter has done that.
+
+default_alpha = 2.0
+default_minsize = 8
+
+# Queries compared against the centroids at a time, and elements of the query x centroid x word
+# array computed at once (bounds memory to a few tens of MB)
+batch_size = 256
+block_elements = 1 << 21
+
+# Two bit codes differ where either bit of their XOR is set, one flag per base in the low bit
+low_bits = np.uint64(0x5555555555555555)
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    byte_bits = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+    def popcount(words:np.ndarray) -> np.ndarray:
+        return byte_bits.take(words.view(np.uint8)).reshape(*words.shape, 8).sum(axis=-1)
+
+
+def read_uniques(path:str) -> tuple:
+    """
+    Headers, sequences and ";size=N" abundances of a (frequency filtered) fasta file.
+    """
+
+    headers = []
+    seqs = []
+    for block in fastx.record_blocks(path):
+        block_headers, block_seqs = fastx.fasta_block(block)
+        headers += block_headers
+        seqs += block_seqs
+
+    sizes = np.fromiter(map(fastx.abundance, headers), dtype=np.int64, count=len(headers))
+    return headers, seqs, sizes
+
+
+def packed_words(seqs:list) -> tuple:
+    """
+    Sequences of one length as rows of uint64 words, 32 bases per word.
+
+    Outputs:
+        - uint64 array (len(seqs), words).
+        - Raw letters as a uint8 array (len(seqs), length), for the ambiguous sequences.
+        - Boolean array, True for sequences with a base other than A, C, G or T.
+    """
+
+    lengths = set(map(len, seqs))
+    if len(lengths) > 1:
+        raise ValueError(f"Native unoise needs sequences of one length (see length_filter), got lengths {sorted(lengths)}")
+    length = lengths.pop() if seqs else 0
+
+    packed, ambiguous = seqpack.pack(seqs, length)
+
+    # Pad to whole words, the padding is equal (A's) in every sequence
+    words = -(-packed.shape[1] // 8)
+    padded = np.zeros((len(seqs), words * 8), dtype=np.uint8)
+    padded[:, 0:packed.shape[1]] = packed
+
+    letters = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), length)
+    return padded.view(np.uint64), letters, ambiguous
+
+
+def distances(words:np.ndarray, letters:np.ndarray, ambiguous:np.ndarray, queries:np.ndarray, targets:np.ndarray) -> np.ndarray:
+    """
+    Hamming distances between the query and target sequences (row numbers), shape (queries, targets).
+    """
+
+    differences = words[queries][:, None, :] ^ words[targets][None, :, :]
+    distance = popcount((differences | (differences >> np.uint64(1))) & low_bits).sum(axis=2, dtype=np.int64)
+
+    # The packing of an ambiguous sequence is meaningless, those pairs are compared letter by letter
+    rows = np.flatnonzero(ambiguous[queries])
+    columns = np.flatnonzero(ambiguous[targets])
+    if len(rows):
+        distance[rows] = (letters[queries[rows]][:, None, :] != letters[targets][None, :, :]).sum(axis=2)
+    if len(columns):
+        distance[:, columns] = (letters[queries][:, None, :] != letters[targets[columns]][None, :, :]).sum(axis=2)
+
+    return distance
+
+
+def pair_distances(words:np.ndarray, letters:np.ndarray, ambiguous:np.ndarray, queries:np.ndarray, targets:np.ndarray) -> np.ndarray:
+    """
+    Hamming distances between queries[i] and targets[i] (row numbers), like distances for a list of pairs.
+    """
+
+    differences = words[queries] ^ words[targets]
+    distance = popcount((differences | (differences >> np.uint64(1))) & low_bits).sum(axis=1, dtype=np.int64)
+
+    pairs = np.flatnonzero(ambiguous[queries] | ambiguous[targets])
+    if len(pairs):
+        distance[pairs] = (letters[queries[pairs]] != letters[targets[pairs]]).sum(axis=1)
+
+    return distance
+
+
+def unoise(seqs:list, sizes:np.ndarray, alpha:float=default_alpha, minsize:int=default_minsize, index:bool=True) -> np.ndarray:
+    """
+    Denoise unique sequences, see the top of the module.
+
+    Inputs:
+        - seqs: unique sequences (bytes), all the same length.
+        - sizes: their abundances.
+        - alpha: unoise_alpha, higher lets less abundant sequences stay centroids.
+        - minsize: sequences less abundant than this are discarded.
+        - index: look up candidate centroids in a kmer_index.pigeonhole_index.
+
+    Outputs:
+        - int64 array, for each sequence the row of its centroid (its own row for a centroid),
+            -1 for discarded sequences.
+
+    Details:
+        Queries are taken batch_size at a time in abundance order. A batch is compared against the
+        centroids found so far in one vectorized pass, only against those abundant enough to take
+        its least abundant query at distance 1 (centroids are kept in abundance order, so that's a
+        prefix). The queries left are compared with each other and resolved in order against the
+        centroids the batch itself adds, so the result is the same as visiting every query in turn.
+        With the index, a query abundant enough that it can only join centroids within a few
+        differences is compared with the centroids sharing a pigeonhole block with it instead,
+        unless that's most of the prefix anyway.
+    """
+
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if not len(seqs):
+        return np.zeros(0, dtype=np.int64)
+
+    words, letters, ambiguous = packed_words(seqs)
+
+    # Most abundant first, ties in input order
+    order = np.argsort(-sizes, kind="stable")
+    order = order[sizes[order] >= minsize]
+
+    assignment = np.full(len(seqs), -1, dtype=np.int64)
+    centroids = np.empty(len(order), dtype=np.int64)
+    n_centroids = 0
+
+    # Distances far enough to need a check: up to the one the rarest query could be at from the most abundant
+    if index and len(order) and alpha > 0:
+        reach = (np.log2(sizes[order[0]] / sizes[order[-1]]) - 1) / alpha
+        centroid_index = kmer_index.pigeonhole_index(letters, kmer_index.index_distance(letters.shape[1], reach))
+    else:
+        centroid_index = None
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        batch_sizes = sizes[batch]
+        absorbed_by = np.full(len(batch), -1, dtype=np.int64)
+        dense = np.ones(len(batch), dtype=bool)
+
+        # Centroids at least 2^(alpha + 1) times as abundant as the batch's least abundant query
+        centroid_sizes = sizes[centroids[0:n_centroids]]
+        limit = np.searchsorted(-centroid_sizes, -batch_sizes.min() * 2 ** (alpha + 1), side="right")
+        step = max(1, block_elements // (len(batch) * words.shape[1]))
+
+        # Queries that can only join centroids within the index's distance, through the index
+        if centroid_index is not None and limit:
+            rows = np.flatnonzero(np.floor((np.log2(centroid_sizes[0] / batch_sizes) - 1) / alpha + 1e-9) <= centroid_index.max_distance)
+            pairs = centroid_index.candidates(batch[rows], limit, max_pairs=len(rows) * limit // 4) if len(rows) else None
+            if pairs is not None:
+                query_index, positions = pairs
+                targets = centroids[positions]
+                distance = pair_distances(words, letters, ambiguous, batch[rows[query_index]], targets)
+                takes = np.flatnonzero(sizes[targets] >= batch_sizes[rows[query_index]] * 2.0 ** (alpha * distance + 1))
+
+                # The first (lowest numbered) centroid taking each query
+                hit_rows, first = np.unique(query_index[takes], return_index=True)
+                absorbed_by[rows[hit_rows]] = targets[takes[first]]
+                dense[rows] = False
+
+        for chunk in range(0, limit, step):
+            open_rows = np.flatnonzero((absorbed_by < 0) & dense)
+            if not len(open_rows):
+                break
+
+            targets = centroids[chunk:min(chunk + step, limit)]
+            distance = distances(words, letters, ambiguous, batch[open_rows], targets)
+            takes = sizes[targets][None, :] >= batch_sizes[open_rows][:, None] * 2.0 ** (alpha * distance + 1)
+
+            hit = takes.any(axis=1)
+            absorbed_by[open_rows[hit]] = targets[takes[hit].argmax(axis=1)]
+
+        # Queries left against each other, in order: one no earlier query left could take is a
+        # centroid, the others join the first earlier one that turned out a centroid
+        left = np.flatnonzero(absorbed_by < 0)
+        distance = distances(words, letters, ambiguous, batch[left], batch[left])
+        takes = (batch_sizes[left][None, :] >= batch_sizes[left][:, None] * 2.0 ** (alpha * distance + 1)) & np.tri(len(left), k=-1, dtype=bool)
+
+        is_centroid = ~takes.any(axis=1)
+        for i in np.flatnonzero(~is_centroid).tolist():
+            earlier = np.flatnonzero(takes[i] & is_centroid)
+            if len(earlier):
+                absorbed_by[left[i]] = batch[left[earlier[0]]]
+            else:
+                is_centroid[i] = True
+
+        new = batch[left[is_centroid]]
+        absorbed_by[left[is_centroid]] = new
+        centroids[n_centroids:n_centroids + len(new)] = new
+        n_centroids += len(new)
+
+        if centroid_index is not None:
+            centroid_index.add(centroids[centroid_index.size:n_centroids])
+        assignment[batch] = absorbed_by
+
+    return assignment
+
+
+def write_centroids(out_path:str, headers:list, seqs:list, sizes:np.ndarray, assignment:np.ndarray) -> dict:
+    """
+    Write the centroids of an assignment (see unoise), most abundant first, with their input headers,
+    in the layout of pipeline.denoise's reformatted usearch output (each record after a newline, none at the end).
+
+    Outputs:
+        - Dict with the number of unique sequences, discarded ones and centroids, for the log.
+    """
+
+    centroids = np.flatnonzero(assignment == np.arange(len(seqs)))
+    centroids = centroids[np.argsort(-sizes[centroids], kind="stable")]
+
+    with open(out_path, "wb") as out_file:
+        out_file.write(b"".join(b"\n>%s\n%s" % (headers[row], seqs[row]) for row in centroids.tolist()))
+
+    return {"uniques": len(seqs), "discarded": int((assignment < 0).sum()), "zotus": len(centroids)}
+
+
+def unoise_fasta(in_path:str, out_path:str, alpha:float=default_alpha, minsize:int=default_minsize) -> dict:
+    """
+    Denoise a ";size=N" annotated fasta file (e.g. frequency_filter output) into a fasta of its centroids
+    (see write_centroids).
+    """
+
+    headers, seqs, sizes = read_uniques(in_path)
+    return write_centroids(out_path, headers, seqs, sizes, unoise(seqs, sizes, alpha, minsize))